@@ -0,0 +1,33 @@
+"""Image work for the media pipeline, run in a separate process pool.
+
+Kept out of server.py so spawned workers import only Pillow, not the app.
+"""
+from typing import Dict, List, Optional, Tuple
+
+
+def render_variants(source: str, targets: List[Tuple[int, str]]) -> Optional[Dict]:
+    """Decode ``source`` once and write a JPEG per (max_side, dest) target.
+
+    Returns the original dimensions and the size of every variant written,
+    or None when the file is not an image Pillow can decode.
+    """
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    try:
+        with Image.open(source) as original:
+            original.load()
+            image = ImageOps.exif_transpose(original)
+    except (UnidentifiedImageError, OSError):
+        return None
+
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    variants = {}
+    # Largest first so each step downsamples the previous, smaller result
+    for max_side, dest in sorted(targets, reverse=True):
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        image.save(dest, "JPEG", quality=85, optimize=True, progressive=True)
+        variants[str(max_side)] = {"width": image.width, "height": image.height}
+
+    return {"width": original.width, "height": original.height, "variants": variants}
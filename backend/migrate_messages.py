@@ -0,0 +1,39 @@
+"""Migrate chat history from the flat db.messages layout into message buckets.
+
+Run from the backend directory with the same environment as the server:
+
+    python migrate_messages.py                 # every chat
+    python migrate_messages.py --chat CHAT_ID  # a single chat
+
+The migration is resumable and safe to run while the app serves traffic. Set
+MESSAGE_STORAGE=bucketed on every server before running it: once a chat is
+migrated it is marked messages_bucketed and reads no longer look in
+db.messages, so messages a flat-storage server appends afterwards would not
+be shown.
+"""
+import argparse
+import asyncio
+import time
+
+import server
+
+
+async def migrate(chat_id, pause):
+    started = time.time()
+    await server.db.message_buckets.create_index("id", unique=True)
+    await server.db.message_buckets.create_index([("chat_id", 1), ("end_ts", -1)])
+    migrated = await server.bucketed_messages.migrate_from_flat(chat_id=chat_id, pause=pause)
+    print(f"✅ Migrated {migrated} messages into buckets of {server.MESSAGE_BUCKET_SIZE} "
+          f"in {time.time() - started:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chat", help="only migrate this chat")
+    parser.add_argument("--pause", type=float, default=0.05, help="seconds to sleep between buckets")
+    args = parser.parse_args()
+    asyncio.run(migrate(args.chat, args.pause))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,18 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, status
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.routing import APIRoute
+from fastapi.datastructures import DefaultPlaceholder
+from bson import ObjectId
+import bson
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import monitoring, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import gridfs
 from pydantic import BaseModel, Field
-from typing import List, Dict, Optional, Any
-from datetime import datetime, timedelta
+from typing import List, Dict, Optional, Any, Type
+from datetime import datetime, date, timedelta, timezone
 from dotenv import load_dotenv
 import os
 import json
@@ -13,8 +21,25 @@ import bcrypt
 import uuid
 import asyncio
 import logging
+import time
 from pathlib import Path
 import secrets
+import functools
+import bisect
+import threading
+import contextvars
+from collections import OrderedDict, deque
+import zlib
+import base64
+import re
+import random
+import math
+import hashlib
+import hmac
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import media_worker
 # Email imports commented out for now - using mock email functionality
 # import smtplib
 # from email.mime.text import MimeText
@@ -24,13 +49,255 @@ import secrets
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Metrics
+DB_ROUNDTRIP_WARN_THRESHOLD = int(os.environ.get('DB_ROUNDTRIP_WARN_THRESHOLD', '20'))
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROUNDTRIP_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+FANOUT_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """In-process counters, gauges and histograms rendered as Prometheus text.
+
+    Mongo command events arrive on Motor's executor threads, so updates are
+    guarded by a lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds: Dict[str, str] = {}
+        self.helps: Dict[str, str] = {}
+        self.buckets: Dict[str, tuple] = {}
+        self.series: Dict[str, Dict[tuple, Any]] = {}
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: tuple = LATENCY_BUCKETS):
+        self.kinds[name] = kind
+        self.helps[name] = help_text
+        self.buckets[name] = buckets
+        self.series[name] = {}
+
+    @staticmethod
+    def _key(labels: Optional[Dict[str, str]]) -> tuple:
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None, value: float = 1):
+        key = self._key(labels)
+        with self.lock:
+            series = self.series[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        with self.lock:
+            self.series[name][self._key(labels)] = value
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        key = self._key(labels)
+        with self.lock:
+            series = self.series[name]
+            if key not in series:
+                series[key] = Histogram(self.buckets[name])
+            series[key].observe(value)
+
+    @staticmethod
+    def _format_labels(pairs) -> str:
+        if not pairs:
+            return ""
+        escaped = (
+            f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(10), " ").replace(chr(34), chr(92) + chr(34))}"'
+            for k, v in pairs
+        )
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name, series in self.series.items():
+                kind = self.kinds[name]
+                lines.append(f"# HELP {name} {self.helps[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in series.items():
+                    if kind != "histogram":
+                        lines.append(f"{name}{self._format_labels(key)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(value.buckets, value.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._format_labels(key + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_bucket{self._format_labels(key + (('le', '+Inf'),))} {value.count}")
+                    lines.append(f"{name}_sum{self._format_labels(key)} {value.sum}")
+                    lines.append(f"{name}_count{self._format_labels(key)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.describe("http_requests_total", "counter", "HTTP requests by route and status")
+metrics.describe("http_request_duration_seconds", "histogram", "HTTP request latency by route")
+metrics.describe("http_request_db_roundtrips", "histogram", "MongoDB commands issued per HTTP request", ROUNDTRIP_BUCKETS)
+metrics.describe("http_request_db_seconds_total", "counter", "Time spent in MongoDB commands per route")
+metrics.describe("mongo_command_duration_seconds", "histogram", "MongoDB command round-trip time by command")
+metrics.describe("mongo_command_errors_total", "counter", "Failed MongoDB commands by command")
+metrics.describe("websocket_active_connections", "gauge", "Currently connected WebSocket clients")
+metrics.describe("websocket_reaped_total", "counter", "WebSocket connections closed for missing heartbeats")
+metrics.describe("websocket_frames_in_total", "counter", "WebSocket frames received by type")
+metrics.describe("websocket_frames_out_total", "counter", "WebSocket frames sent by type")
+metrics.describe("websocket_bytes_out_total", "counter", "WebSocket payload bytes sent by encoding, before compression")
+metrics.describe("websocket_send_seconds", "histogram", "Time to write one WebSocket frame")
+metrics.describe("ai_queue_wait_seconds", "histogram", "Time LLM calls waited for a concurrency slot")
+metrics.describe("ai_upstream_seconds", "histogram", "LLM provider round-trip time")
+metrics.describe("fanout_recipients", "histogram", "Connected recipients per fanned-out frame", FANOUT_BUCKETS)
+metrics.describe("fanout_send_failures_total", "counter", "Fanned-out frames that could not be delivered")
+metrics.describe("rate_limited_total", "counter", "Requests and WebSocket frames rejected by rate limits")
+metrics.describe("media_upload_bytes_total", "counter", "Attachment bytes received by upload purpose")
+metrics.describe("media_dedup_hits_total", "counter", "Completed uploads whose content was already stored")
+metrics.describe("media_thumbnail_seconds", "histogram", "Time to render the thumbnails of one image")
+
+class RequestStats:
+    __slots__ = ("db_calls", "db_seconds")
+
+    def __init__(self):
+        self.db_calls = 0
+        self.db_seconds = 0.0
+
+# Motor copies the calling context into its executor, so command events can
+# be attributed to the request that issued them.
+current_request_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "current_request_stats", default=None
+)
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        metrics.inc("mongo_command_errors_total", {"command": event.command_name})
+        self._record(event)
+
+    def _record(self, event):
+        seconds = event.duration_micros / 1_000_000
+        metrics.observe("mongo_command_duration_seconds", seconds, {"command": event.command_name})
+        stats = current_request_stats.get()
+        if stats is not None:
+            stats.db_calls += 1
+            stats.db_seconds += seconds
+
+class MetricsMiddleware:
+    """Records per-route latency and attributes MongoDB round-trips to each request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request_stats.set(stats)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request_stats.reset(token)
+            # Label by route template, not raw path, to keep cardinality bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            labels = {"method": scope["method"], "route": route}
+            metrics.inc("http_requests_total", {**labels, "status": str(status_code)})
+            metrics.observe("http_request_duration_seconds", elapsed, labels)
+            metrics.observe("http_request_db_roundtrips", stats.db_calls, labels)
+            metrics.inc("http_request_db_seconds_total", labels, stats.db_seconds)
+            if stats.db_calls > DB_ROUNDTRIP_WARN_THRESHOLD:
+                logging.warning(
+                    f"{scope['method']} {route} made {stats.db_calls} MongoDB round-trips "
+                    f"({stats.db_seconds * 1000:.1f} ms in DB, {elapsed * 1000:.1f} ms total)"
+                )
+
 # MongoDB setup
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandMetrics()])
 db = client[os.environ['DB_NAME']]
 
+# Serialization
+try:
+    import orjson
+except ImportError:  # stdlib fallback keeps the app runnable without orjson
+    orjson = None
+
+# Projections that keep Mongo's ObjectId (and secrets) out of query results
+NO_ID = {"_id": 0}
+USER_PUBLIC = {"_id": 0, "password_hash": 0}
+
+def _json_default(value: Any):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, BaseModel):
+        return value.dict()
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(content: Any) -> bytes:
+    """Serialize Mongo documents, ObjectId and datetime to JSON bytes in one pass."""
+    if orjson is not None:
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_json_default, separators=(",", ":")).encode("utf-8")
+
+def dumps_text(content: Any) -> str:
+    return dumps(content).decode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+class FastJSONRoute(APIRoute):
+    """Routes without a response_model render their result directly with dumps().
+
+    FastAPI otherwise walks the whole payload through jsonable_encoder before
+    rendering; handing back a Response skips that second pass.
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        response_model = kwargs.get("response_model")
+        if response_model is None or (isinstance(response_model, DefaultPlaceholder) and response_model.value is None):
+            endpoint = self._render_directly(endpoint, kwargs.get("status_code"))
+        super().__init__(path, endpoint, **kwargs)
+
+    @staticmethod
+    def _render_directly(endpoint, status_code: Optional[int]):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            result = await endpoint(*args, **kwargs)
+            if isinstance(result, Response):
+                return result
+            return FastJSONResponse(result, status_code=status_code or 200)
+        return wrapper
+
 # FastAPI app
-app = FastAPI(title="WeChat Clone API", version="1.0.0")
+app = FastAPI(title="WeChat Clone API", version="1.0.0", default_response_class=FastJSONResponse)
+app.router.route_class = FastJSONRoute
 
 app.add_middleware(
     CORSMiddleware,
@@ -38,10 +305,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+app.add_middleware(MetricsMiddleware)
 
 # Security
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 SECRET_KEY = os.environ.get('SECRET_KEY', 'your-secret-key')
 ALGORITHM = "HS256"
 
@@ -77,16 +347,25 @@ class Message(BaseModel):
     message_type: str = "text"  # text, image, voice, payment, location
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     metadata: Optional[Dict[str, Any]] = None
+    client_message_id: Optional[str] = None  # sender-chosen id that makes resends idempotent
 
 class Chat(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
-    chat_type: str = "private"  # private, group
-    participants: List[str]
+    chat_type: str = "private"  # private, group, channel
+    participants: List[str]  # private chats only; groups use db.chat_members
+    member_count: int = 0
     created_by: str
     created_at: datetime = Field(default_factory=datetime.utcnow)
     last_message: Optional[str] = None
     last_activity: datetime = Field(default_factory=datetime.utcnow)
+    messages_bucketed: bool = False  # every message lives in db.message_buckets, none in db.messages
+
+class AddChatMembers(BaseModel):
+    user_ids: List[str]
+
+class UpdateChatMember(BaseModel):
+    role: str  # admin, member
 
 class Friend(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -97,12 +376,20 @@ class Friend(BaseModel):
 
 class PaymentRequest(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    from_user: str
-    to_user: str
+    from_user: str  # the requester, who is paid
+    to_user: str  # the payer
     amount: float
+    currency: str = "TZS"
     description: str
-    status: str = "pending"  # pending, completed, failed
+    status: str = "pending"  # pending, settling, completed, declined, cancelled
+    transfer_id: Optional[str] = None  # ledger transfer, set when the payer accepts
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    settled_at: Optional[datetime] = None
+
+class CreatePaymentRequest(BaseModel):
+    to_user: str
+    amount: float
+    description: str = "Payment request"
 
 class ForgotPasswordRequest(BaseModel):
     email: str
@@ -120,16 +407,19 @@ class NewsPost(BaseModel):
     image_url: Optional[str] = None
     category: str = "general"  # general, tech, sports, entertainment, etc.
     likes: List[str] = []  # user IDs who liked
+    comment_count: int = 0  # kept in step with db.comments, replies included
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 class Comment(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     post_id: str
+    parent_id: Optional[str] = None  # top-level comment this replies to
     author_id: str
     author_name: str
     content: str
     likes: List[str] = []  # user IDs who liked
+    reply_count: int = 0
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class CreateNewsPost(BaseModel):
@@ -140,6 +430,7 @@ class CreateNewsPost(BaseModel):
 
 class CreateComment(BaseModel):
     content: str
+    parent_id: Optional[str] = None
 
 class Product(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -158,6 +449,7 @@ class Product(BaseModel):
     tags: List[str] = []
     views: int = 0
     likes: List[str] = []  # user IDs who liked
+    like_count: int = 0  # len(likes), stored so popularity can be sorted on an index
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -167,6 +459,7 @@ class CreateProduct(BaseModel):
     price: float
     category: str
     images: List[str] = []
+    media_ids: List[str] = []  # uploaded attachments, resolved to image URLs
     stock_quantity: int = 1
     condition: str = "new"
     location: str
@@ -209,49 +502,623 @@ class PaymentTransaction(BaseModel):
     amount: float
     currency: str = "TZS"
     payment_method: str
-    status: str = "pending"  # pending, completed, failed, refunded
-    reference: Optional[str] = None
+    status: str = "pending"  # pending, initiating, completed, failed, refund_pending, refunding, refunded
+    provider: Optional[str] = None
+    reference: Optional[str] = None  # the provider's id, set once collection starts
     created_at: datetime = Field(default_factory=datetime.utcnow)
     completed_at: Optional[datetime] = None
 
+class CreateUpload(BaseModel):
+    filename: str
+    content_type: str
+    size: int
+    purpose: str = "chat"  # chat, product, avatar
+
+class ProfilePictureUpdate(BaseModel):
+    media_id: Optional[str] = None
+
+class PrivacySettings(BaseModel):
+    last_seen_online: bool = True
+    profile_photo_visible: bool = True
+    phone_visible: bool = False
+    email_visible: bool = False
+    search_by_phone: bool = True
+    search_by_email: bool = True
+    read_receipts: bool = True
+    typing_indicators: bool = True
+
+class UpdatePrivacySettings(BaseModel):
+    # Fields left out are unchanged; unknown keys are ignored
+    last_seen_online: Optional[bool] = None
+    profile_photo_visible: Optional[bool] = None
+    phone_visible: Optional[bool] = None
+    email_visible: Optional[bool] = None
+    search_by_phone: Optional[bool] = None
+    search_by_email: Optional[bool] = None
+    read_receipts: Optional[bool] = None
+    typing_indicators: Optional[bool] = None
+
+# Response models
+# Slim views of stored documents. Every field is optional so that a sparse
+# ?fields= request validates; routes set response_model_exclude_unset so
+# only fields that were actually projected are sent.
+class ProductSummary(BaseModel):
+    id: Optional[str] = None
+    seller_id: Optional[str] = None
+    seller_name: Optional[str] = None
+    name: Optional[str] = None
+    description: Optional[str] = None
+    price: Optional[float] = None
+    currency: Optional[str] = None
+    category: Optional[str] = None
+    images: Optional[List[str]] = None
+    stock_quantity: Optional[int] = None
+    condition: Optional[str] = None
+    location: Optional[str] = None
+    is_active: Optional[bool] = None
+    tags: Optional[List[str]] = None
+    views: Optional[int] = None
+    likes_count: Optional[int] = None
+    liked_by_me: Optional[bool] = None
+    created_at: Optional[datetime] = None
+
+class NewsPostSummary(BaseModel):
+    id: Optional[str] = None
+    author_id: Optional[str] = None
+    author_name: Optional[str] = None
+    title: Optional[str] = None
+    content: Optional[str] = None
+    image_url: Optional[str] = None
+    category: Optional[str] = None
+    likes_count: Optional[int] = None
+    liked_by_me: Optional[bool] = None
+    comment_count: Optional[int] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+class CartProduct(BaseModel):
+    id: Optional[str] = None
+    seller_id: Optional[str] = None
+    seller_name: Optional[str] = None
+    name: Optional[str] = None
+    price: Optional[float] = None
+    currency: Optional[str] = None
+    images: Optional[List[str]] = None
+    stock_quantity: Optional[int] = None
+    is_active: Optional[bool] = None
+
+class CartItemView(BaseModel):
+    id: Optional[str] = None
+    product_id: Optional[str] = None
+    quantity: Optional[int] = None
+    added_at: Optional[datetime] = None
+    product: Optional[CartProduct] = None
+
+class OrderSummary(BaseModel):
+    id: Optional[str] = None
+    buyer_id: Optional[str] = None
+    buyer_name: Optional[str] = None
+    seller_id: Optional[str] = None
+    seller_name: Optional[str] = None
+    products: Optional[List[dict]] = None
+    total_amount: Optional[float] = None
+    currency: Optional[str] = None
+    status: Optional[str] = None
+    payment_method: Optional[str] = None
+    payment_reference: Optional[str] = None
+    shipping_address: Optional[dict] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+class FriendSummary(BaseModel):
+    id: Optional[str] = None
+    username: Optional[str] = None
+    display_name: Optional[str] = None
+    avatar_url: Optional[str] = None
+    status: Optional[str] = None
+    last_seen: Optional[datetime] = None
+
+def build_projection(model: Type[BaseModel], fields: Optional[str] = None,
+                     computed: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """MongoDB projection for a response model, optionally narrowed by ?fields=a,b,c.
+
+    ``computed`` maps model fields to aggregation expressions (e.g. likes_count)
+    that replace a plain inclusion.
+    """
+    names = list(model.model_fields)
+    if fields:
+        requested = [name.strip() for name in fields.split(",") if name.strip()]
+        unknown = sorted(set(requested) - set(names))
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+        # id is always returned so clients can key their lists
+        names = ["id"] + [name for name in requested if name != "id"]
+    computed = computed or {}
+    projection: Dict[str, Any] = {"_id": 0}
+    for name in names:
+        projection[name] = computed.get(name, 1)
+    return projection
+
+def likes_projection(current_user: Optional[str]) -> Dict[str, Any]:
+    likes = {"$ifNull": ["$likes", []]}
+    return {
+        "likes_count": {"$size": likes},
+        "liked_by_me": {"$in": [current_user, likes]} if current_user else {"$literal": False},
+    }
+
+# WebSocket encodings
+# Clients choose an encoding through the WebSocket subprotocol, listing them
+# in order of preference (new WebSocket(url, ["msgpack", "json"])). JSON text
+# frames are the default. permessage-deflate is negotiated by the server
+# (uvicorn --ws-per-message-deflate, on by default) independently of this.
+try:
+    import msgpack
+except ImportError:  # without it only JSON is offered
+    msgpack = None
+
+class JSONCodec:
+    name = "json"
+    binary = False
+
+    @staticmethod
+    def encode(message: Any) -> str:
+        return dumps_text(message)
+
+    @staticmethod
+    def decode(data) -> Any:
+        return orjson.loads(data) if orjson is not None else json.loads(data)
+
+class MsgPackCodec:
+    name = "msgpack"
+    binary = True
+
+    @staticmethod
+    def encode(message: Any) -> bytes:
+        # Same value mapping as JSON: datetimes as ISO strings, models as dicts
+        return msgpack.packb(message, default=_json_default, use_bin_type=True)
+
+    @staticmethod
+    def decode(data) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+WS_CODECS = {"json": JSONCodec()}
+if msgpack is not None:
+    WS_CODECS["msgpack"] = MsgPackCodec()
+
+def negotiate_codec(websocket: WebSocket):
+    """The first encoding the client offered that we support; JSON if none."""
+    for subprotocol in websocket.scope.get("subprotocols", []):
+        if subprotocol in WS_CODECS:
+            return WS_CODECS[subprotocol], subprotocol
+    return WS_CODECS["json"], None
+
+def decode_frame(websocket: WebSocket, message: dict) -> Any:
+    """Decode one received ASGI websocket message with the connection's codec.
+
+    Text frames are always JSON, so a client may fall back to them at any time.
+    """
+    if message.get("bytes") is not None:
+        codec = getattr(websocket.state, "codec", WS_CODECS["json"])
+        return codec.decode(message["bytes"])
+    return WS_CODECS["json"].decode(message["text"])
+
+class OutboundFrame:
+    """A message serialized lazily, at most once per encoding, however many sockets it goes to."""
+
+    __slots__ = ("message", "type", "encoded")
+
+    def __init__(self, message: dict):
+        self.message = message
+        self.type = message.get("type", "unknown")
+        self.encoded: Dict[str, Any] = {}
+
+    def encode(self, codec):
+        data = self.encoded.get(codec.name)
+        if data is None:
+            data = self.encoded[codec.name] = codec.encode(self.message)
+        return data
+
 # WebSocket Connection Manager
+# Clients must answer {"type": "ping"} with {"type": "pong"}; any inbound frame
+# counts as a sign of life.
+WS_HEARTBEAT_INTERVAL_SECONDS = float(os.environ.get('WS_HEARTBEAT_INTERVAL_SECONDS', '25'))
+WS_IDLE_TIMEOUT_SECONDS = float(os.environ.get('WS_IDLE_TIMEOUT_SECONDS', '75'))
+WS_DRAIN_WINDOW_SECONDS = float(os.environ.get('WS_DRAIN_WINDOW_SECONDS', '30'))
+WS_RECONNECT_JITTER_MS = int(os.environ.get('WS_RECONNECT_JITTER_MS', '2000'))
+WS_CLOSE_TIMEOUT_SECONDS = 5
+WS_CLOSE_REPLACED = 4000
+WS_CLOSE_IDLE = 4008
+WS_CLOSE_SERVICE_RESTART = 1012
+WS_CLOSE_ACCOUNT_DELETED = 4001
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, WebSocket] = {}
         self.user_status: Dict[str, str] = {}
+        self.draining = False
+        self.supervisor: Optional[asyncio.Task] = None
+        self.drain_task: Optional[asyncio.Task] = None
 
     async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
+        websocket.state.codec, subprotocol = negotiate_codec(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        self.touch(websocket)
+        previous = self.active_connections.get(user_id)
         self.active_connections[user_id] = websocket
         self.user_status[user_id] = "online"
+        metrics.set("websocket_active_connections", len(self.active_connections))
+        if previous is not None and previous is not websocket:
+            # One socket per user: the newer connection wins
+            await self.close(previous, WS_CLOSE_REPLACED)
         await self.update_user_status(user_id, "online")
 
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-        self.user_status[user_id] = "offline"
-        asyncio.create_task(self.update_user_status(user_id, "offline"))
+    def disconnect(self, user_id: str, websocket: Optional[WebSocket] = None, mark_offline: bool = True):
+        """Forget a user's socket. A no-op if ``websocket`` has already been replaced by a newer one."""
+        current = self.active_connections.get(user_id)
+        if current is None or (websocket is not None and current is not websocket):
+            return
+        del self.active_connections[user_id]
+        metrics.set("websocket_active_connections", len(self.active_connections))
+        if mark_offline:
+            self.user_status[user_id] = "offline"
+            asyncio.create_task(self.update_user_status(user_id, "offline"))
+
+    @staticmethod
+    def touch(websocket: WebSocket):
+        websocket.state.last_seen = time.monotonic()
+
+    @staticmethod
+    async def close(websocket: WebSocket, code: int):
+        # A dead peer may never finish the closing handshake
+        try:
+            await asyncio.wait_for(websocket.close(code=code), WS_CLOSE_TIMEOUT_SECONDS)
+        except Exception:
+            pass
+
+    async def supervise(self):
+        """Ping quiet connections and reap the ones that stopped answering."""
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL_SECONDS)
+            try:
+                now = time.monotonic()
+                quiet, dead = [], []
+                for user_id, websocket in list(self.active_connections.items()):
+                    idle = now - getattr(websocket.state, "last_seen", now)
+                    if idle > WS_IDLE_TIMEOUT_SECONDS:
+                        dead.append((user_id, websocket))
+                    elif idle >= WS_HEARTBEAT_INTERVAL_SECONDS:
+                        quiet.append(user_id)
+                for user_id, websocket in dead:
+                    self.disconnect(user_id, websocket)
+                if dead:
+                    metrics.inc("websocket_reaped_total", value=len(dead))
+                    await asyncio.gather(*(self.close(websocket, WS_CLOSE_IDLE) for _, websocket in dead))
+                if quiet:
+                    await fanout.publish(quiet, OutboundFrame({"type": "ping"}))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"WebSocket supervisor pass failed: {e}")
+
+    @staticmethod
+    def reconnect_frame() -> OutboundFrame:
+        # Jitter keeps clients closed in the same instant from reconnecting in lockstep
+        return OutboundFrame({"type": "reconnect", "delay_ms": random.randint(0, WS_RECONNECT_JITTER_MS)})
+
+    async def drain(self, window: float = WS_DRAIN_WINDOW_SECONDS) -> int:
+        """Stop taking sockets, flush queued frames, then send everyone elsewhere.
+
+        Closes are spread evenly over ``window`` seconds so the fleet does not
+        see every client reconnect at once. Users are not marked offline; they
+        are expected back on another instance.
+        """
+        self.draining = True
+        await fanout.flush(min(window, 10))
+        connections = list(self.active_connections.items())
+        random.shuffle(connections)
+        started = time.monotonic()
+        step = window / max(len(connections), 1)
+        for n, (user_id, websocket) in enumerate(connections):
+            await asyncio.sleep(max(0.0, started + n * step - time.monotonic()))
+            if self.active_connections.get(user_id) is not websocket:
+                continue
+            try:
+                await asyncio.wait_for(self._send(websocket, self.reconnect_frame()), WS_CLOSE_TIMEOUT_SECONDS)
+            except Exception:
+                pass
+            self.disconnect(user_id, websocket, mark_offline=False)
+            await self.close(websocket, WS_CLOSE_SERVICE_RESTART)
+        return len(connections)
+
+    def start(self):
+        if self.supervisor is None:
+            self.supervisor = asyncio.create_task(self.supervise())
+
+    async def stop(self):
+        for task in (self.supervisor, self.drain_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.supervisor = self.drain_task = None
+
+    async def _send(self, websocket: WebSocket, frame: OutboundFrame):
+        codec = getattr(websocket.state, "codec", WS_CODECS["json"])
+        data = frame.encode(codec)
+        started = time.perf_counter()
+        if codec.binary:
+            await websocket.send_bytes(data)
+        else:
+            await websocket.send_text(data)
+        metrics.observe("websocket_send_seconds", time.perf_counter() - started)
+        metrics.inc("websocket_frames_out_total", {"type": frame.type})
+        metrics.inc("websocket_bytes_out_total", {"encoding": codec.name}, len(data))
 
-    async def send_personal_message(self, message: str, user_id: str):
+    async def send_personal_message(self, message: dict, user_id: str):
         if user_id in self.active_connections:
-            await self.active_connections[user_id].send_text(message)
+            await self._send(self.active_connections[user_id], OutboundFrame(message))
+
+    def online(self, user_ids: frozenset) -> List[str]:
+        # Walk whichever side is smaller: a 10k-member group with few users online, or the reverse
+        if len(user_ids) <= len(self.active_connections):
+            return [uid for uid in user_ids if uid in self.active_connections]
+        return [uid for uid in self.active_connections if uid in user_ids]
 
-    async def send_to_chat(self, message: dict, chat_id: str):
-        # Get chat participants
-        chat = await get_chat_by_id(chat_id)
-        if chat:
-            for participant_id in chat.get('participants', []):
-                if participant_id in self.active_connections:
-                    await self.active_connections[participant_id].send_text(json.dumps(message))
+    async def send_to_chat(self, message: dict, chat_id: str, audience: Optional["ChatAudience"] = None):
+        audience = audience or await chat_audiences.get(chat_id)
+        if audience:
+            # Serialized once per encoding in use, not once per recipient
+            recipients = self.online(audience.members)
+            if recipients:
+                await fanout.publish(recipients, OutboundFrame(message))
 
     async def update_user_status(self, user_id: str, status: str):
         await db.users.update_one(
             {"id": user_id},
             {"$set": {"status": status, "last_seen": datetime.utcnow()}}
         )
+        profile_cache.invalidate(user_id)
 
 manager = ConnectionManager()
 
+# Group membership and fan-out
+# Private chats keep their two participants embedded; group and channel
+# membership lives in db.chat_members so large groups never rewrite the chat
+# document. Channels are groups where only admins post.
+MEMBER_CACHE_TTL_SECONDS = float(os.environ.get('MEMBER_CACHE_TTL_SECONDS', '30'))
+MEMBER_CACHE_MAX_CHATS = int(os.environ.get('MEMBER_CACHE_MAX_CHATS', '2000'))
+FANOUT_SHARDS = int(os.environ.get('FANOUT_SHARDS', '4'))
+FANOUT_QUEUE_SIZE = int(os.environ.get('FANOUT_QUEUE_SIZE', '10000'))
+FANOUT_BATCH_SIZE = 500
+FANOUT_SEND_TIMEOUT_SECONDS = float(os.environ.get('FANOUT_SEND_TIMEOUT_SECONDS', '5'))
+TYPING_FANOUT_MAX_MEMBERS = int(os.environ.get('TYPING_FANOUT_MAX_MEMBERS', '200'))
+CHAT_TYPES = {"private", "group", "channel"}
+ADMIN_ROLES = {"owner", "admin"}
+
+class ChatAudience:
+    """Who receives (members) and who may post (posters) to one chat."""
+
+    __slots__ = ("chat_type", "members", "admins", "loaded_at")
+
+    def __init__(self, chat_type: str, members: frozenset, admins: frozenset):
+        self.chat_type = chat_type
+        self.members = members
+        self.admins = admins
+        self.loaded_at = time.monotonic()
+
+    def can_post(self, user_id: str) -> bool:
+        if self.chat_type == "channel":
+            return user_id in self.admins
+        return user_id in self.members
+
+class ChatAudienceCache:
+    """LRU of member sets per chat, reloaded after MEMBER_CACHE_TTL_SECONDS.
+
+    Changes made through this process invalidate immediately; other
+    processes see them once their entry expires.
+    """
+
+    def __init__(self, max_chats: int = MEMBER_CACHE_MAX_CHATS):
+        self.max_chats = max_chats
+        self.entries: "OrderedDict[str, ChatAudience]" = OrderedDict()
+        self.loading: Dict[str, asyncio.Future] = {}
+
+    async def _load(self, chat_id: str) -> Optional[ChatAudience]:
+        chat = await db.chats.find_one({"id": chat_id}, {"_id": 0, "chat_type": 1, "participants": 1})
+        if not chat:
+            return None
+        chat_type = chat.get("chat_type", "private")
+        members = set(chat.get("participants", []))
+        admins = set()
+        if chat_type != "private":
+            cursor = db.chat_members.find({"chat_id": chat_id}, {"_id": 0, "user_id": 1, "role": 1}).batch_size(5000)
+            async for member in cursor:
+                members.add(member["user_id"])
+                if member.get("role") in ADMIN_ROLES:
+                    admins.add(member["user_id"])
+        return ChatAudience(chat_type, frozenset(members), frozenset(admins))
+
+    async def get(self, chat_id: str) -> Optional[ChatAudience]:
+        entry = self.entries.get(chat_id)
+        if entry is not None and time.monotonic() - entry.loaded_at < MEMBER_CACHE_TTL_SECONDS:
+            self.entries.move_to_end(chat_id)
+            return entry
+        # One load per chat at a time; a busy group would otherwise stampede on expiry
+        pending = self.loading.get(chat_id)
+        if pending is not None:
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise  # this caller was cancelled
+                # The loading caller was cancelled; load it here instead
+                return await self.get(chat_id)
+        future = asyncio.get_running_loop().create_future()
+        self.loading[chat_id] = future
+        try:
+            entry = await self._load(chat_id)
+            future.set_result(entry)
+        except Exception as e:
+            future.set_exception(e)
+            # Mark retrieved so a failure nobody else awaited is not logged as unhandled
+            future.exception()
+            raise
+        finally:
+            del self.loading[chat_id]
+            if not future.done():
+                # Cancelled mid-load: release the waiters rather than leave them hanging
+                future.cancel()
+        if entry is not None:
+            self.entries[chat_id] = entry
+            self.entries.move_to_end(chat_id)
+            while len(self.entries) > self.max_chats:
+                self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, chat_id: str):
+        self.entries.pop(chat_id, None)
+
+chat_audiences = ChatAudienceCache()
+
+class FanoutDispatcher:
+    """Delivers one serialized frame to many connected users from sharded workers.
+
+    A recipient always maps to the same shard, so frames reach each user in
+    the order they were published. Queues are bounded: when delivery falls
+    behind, publishers wait instead of buffering without limit.
+    """
+
+    def __init__(self, shards: int = FANOUT_SHARDS):
+        self.shards = shards
+        self.queues: List[asyncio.Queue] = []
+        self.tasks: List[asyncio.Task] = []
+
+    async def publish(self, recipients: List[str], frame: OutboundFrame):
+        metrics.observe("fanout_recipients", len(recipients))
+        if not self.tasks:
+            # Workers not running (e.g. during shutdown): deliver inline
+            await self._deliver(recipients, frame)
+            return
+        batches: List[List[str]] = [[] for _ in range(self.shards)]
+        for user_id in recipients:
+            batches[zlib.crc32(user_id.encode()) % self.shards].append(user_id)
+        for shard, batch in enumerate(batches):
+            for start in range(0, len(batch), FANOUT_BATCH_SIZE):
+                await self.queues[shard].put((batch[start:start + FANOUT_BATCH_SIZE], frame))
+
+    async def _deliver(self, recipients: List[str], frame: OutboundFrame):
+        for user_id in recipients:
+            websocket = manager.active_connections.get(user_id)
+            if websocket is None:
+                continue
+            try:
+                await asyncio.wait_for(manager._send(websocket, frame), FANOUT_SEND_TIMEOUT_SECONDS)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # One dead or stalled socket must not hold up the rest of the batch
+                metrics.inc("fanout_send_failures_total", {"type": frame.type})
+                logging.debug(f"Fan-out to {user_id} failed: {e!r}")
+
+    async def _work(self, queue: asyncio.Queue):
+        while True:
+            recipients, frame = await queue.get()
+            try:
+                await self._deliver(recipients, frame)
+            finally:
+                queue.task_done()
+
+    async def flush(self, timeout: float):
+        """Wait until everything queued so far has been handed to the sockets."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Fan-out queues not flushed within {timeout}s")
+
+    def start(self):
+        if not self.tasks:
+            self.queues = [asyncio.Queue(FANOUT_QUEUE_SIZE) for _ in range(self.shards)]
+            self.tasks = [asyncio.create_task(self._work(queue)) for queue in self.queues]
+
+    async def stop(self):
+        tasks, self.tasks = self.tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+fanout = FanoutDispatcher()
+
+@app.on_event("startup")
+async def start_fanout():
+    await db.chat_members.create_index([("chat_id", 1), ("user_id", 1)], unique=True)
+    await db.chat_members.create_index([("user_id", 1), ("chat_id", 1)])
+    migrated = await migrate_legacy_groups()
+    if migrated:
+        logging.info(f"Moved the members of {migrated} legacy groups into chat_members")
+    fanout.start()
+    manager.start()
+
+@app.on_event("shutdown")
+async def stop_fanout():
+    await manager.stop()
+    await fanout.stop()
+
+async def add_chat_members(chat_id: str, user_ids: List[str], role: str = "member") -> int:
+    """Add members to a group or channel; returns how many were new."""
+    now = datetime.utcnow()
+    docs = [{"chat_id": chat_id, "user_id": uid, "role": role, "joined_at": now} for uid in dict.fromkeys(user_ids)]
+    if not docs:
+        return 0
+    error = None
+    try:
+        added = len((await db.chat_members.insert_many(docs, ordered=False)).inserted_ids)
+    except BulkWriteError as e:
+        added = e.details.get("nInserted", 0)
+        # Existing members hit the unique index; anything else is a real failure,
+        # raised once the members that did go in are counted
+        if e.details.get("writeConcernErrors") or any(
+                err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            error = e
+    if added:
+        await db.chats.update_one({"id": chat_id}, {"$inc": {"member_count": added}})
+    chat_audiences.invalidate(chat_id)
+    if error is not None:
+        raise error
+    return added
+
+async def remove_chat_member(chat_id: str, user_id: str) -> bool:
+    removed = (await db.chat_members.delete_one({"chat_id": chat_id, "user_id": user_id})).deleted_count
+    if removed:
+        await db.chats.update_one({"id": chat_id}, {"$inc": {"member_count": -1}})
+    # A group not yet moved over by migrate_legacy_groups still embeds its members
+    legacy = (await db.chats.update_one(
+        {"id": chat_id, "chat_type": {"$in": ["group", "channel"]}, "participants": user_id},
+        {"$pull": {"participants": user_id}}
+    )).modified_count
+    chat_audiences.invalidate(chat_id)
+    return bool(removed or legacy)
+
+async def migrate_legacy_groups() -> int:
+    """Move the embedded participants of groups from before db.chat_members into it.
+
+    The creator becomes the owner. Members are added before they are pulled
+    from the chat document, so an interrupted run is finished by the next one.
+    """
+    migrated = 0
+    cursor = db.chats.find(
+        {"chat_type": {"$in": ["group", "channel"]}, "participants.0": {"$exists": True}},
+        {"_id": 0, "id": 1, "participants": 1, "created_by": 1}
+    )
+    async for chat in cursor:
+        if chat.get("created_by") in chat["participants"]:
+            await add_chat_members(chat["id"], [chat["created_by"]], role="owner")
+        await add_chat_members(chat["id"], chat["participants"])
+        await db.chats.update_one({"id": chat["id"]}, {"$pullAll": {"participants": chat["participants"]}})
+        migrated += 1
+    return migrated
+
 # Helper functions
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -269,231 +1136,1214 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def is_active_user(user_id: str) -> bool:
+    # A valid token is not enough once the account is deleted; the cached
+    # profile lookup leaves deleted users out and saves a query per request
+    return user_id in await profile_cache.get_many([user_id])
+
+async def get_token_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
+    """The user id in a valid token, whether or not the account still exists.
+
+    Only for endpoints a deleted account still needs; everything else uses
+    get_current_user.
+    """
     try:
         payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid authentication")
-        return user_id
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication")
+    return user_id
 
-async def get_chat_by_id(chat_id: str) -> Optional[dict]:
-    return await db.chats.find_one({"id": chat_id})
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    user_id = await get_token_user(credentials)
+    if not await is_active_user(user_id):
+        raise HTTPException(status_code=401, detail="Invalid authentication")
+    return user_id
 
-def generate_reset_token() -> str:
-    return secrets.token_urlsafe(32)
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')  # enables /api/admin/* and /api/metrics
 
-async def send_reset_email(email: str, token: str, user_name: str):
-    """
-    Send password reset email - Mock implementation
-    In production, integrate with SendGrid, AWS SES, or similar service
-    """
-    try:
-        # Mock email sending - replace with actual email service
-        print(f"=== PASSWORD RESET EMAIL ===")
-        print(f"To: {email}")
-        print(f"Subject: Reset your SISI Chat password")
-        print(f"")
-        print(f"Hi {user_name},")
-        print(f"")
-        print(f"You requested to reset your password for SISI Chat.")
-        print(f"Your reset token is: {token}")
-        print(f"")
-        print(f"Copy this token and paste it in the reset password form.")
-        print(f"This token will expire in 1 hour.")
-        print(f"")
-        print(f"If you didn't request this, please ignore this email.")
-        print(f"")
-        print(f"Best regards,")
-        print(f"SISI Chat Team")
-        print(f"===========================")
-        
-        # In production, use this structure with real email service:
-        """
-        # Example with SendGrid
-        from sendgrid import SendGridAPIClient
-        from sendgrid.helpers.mail import Mail
-        
-        message = Mail(
-            from_email='noreply@sisichat.com',
-            to_emails=email,
-            subject='Reset your SISI Chat password',
-            html_content=f'''
-            <h2>Reset your password</h2>
-            <p>Hi {user_name},</p>
-            <p>You requested to reset your password for SISI Chat.</p>
-            <p><strong>Reset Token: {token}</strong></p>
-            <p>Copy this token and paste it in the reset password form.</p>
-            <p>This token will expire in 1 hour.</p>
-            <p>If you didn't request this, please ignore this email.</p>
-            '''
-        )
-        
-        sg = SendGridAPIClient(api_key=os.environ.get('SENDGRID_API_KEY'))
-        response = sg.send(message)
-        """
-        
-        return True
-    except Exception as e:
-        logging.error(f"Failed to send reset email: {e}")
-        return False
+async def require_admin(request: Request):
+    """For operator endpoints; send ADMIN_TOKEN in an X-Admin-Token header."""
+    token = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN or not secrets.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Not allowed")
 
-# AI Integration for message suggestions and translation
-async def get_ai_suggestions(message: str, context: str = "") -> List[str]:
+async def get_optional_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)) -> Optional[str]:
+    if credentials is None:
+        return None
     try:
-        from emergentintegrations.llm.chat import LlmChat, UserMessage
-        
-        chat = LlmChat(
-            api_key=os.environ.get('EMERGENT_LLM_KEY'),
-            session_id=f"suggestions-{uuid.uuid4()}",
-            system_message="Generate 3 short, helpful message suggestions based on the context. Return only the suggestions, one per line."
-        ).with_model("openai", "gpt-4o-mini")
-        
-        prompt = f"Context: {context}\nMessage: {message}\nGenerate 3 helpful response suggestions:"
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
-        
-        suggestions = [s.strip() for s in response.split('\n') if s.strip()][:3]
-        return suggestions
-    except Exception as e:
-        logging.error(f"AI suggestions error: {e}")
-        return ["Thanks!", "Got it", "Let me check"]
+        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        user_id = payload.get("sub")
+    except jwt.PyJWTError:
+        return None
+    return user_id if user_id and await is_active_user(user_id) else None
 
-async def translate_message(message: str, target_language: str = "en") -> str:
-    try:
-        from emergentintegrations.llm.chat import LlmChat, UserMessage
-        
-        chat = LlmChat(
-            api_key=os.environ.get('EMERGENT_LLM_KEY'),
-            session_id=f"translate-{uuid.uuid4()}",
-            system_message=f"Translate the given text to {target_language}. Return only the translation, no extra text."
-        ).with_model("openai", "gpt-4o-mini")
-        
-        user_message = UserMessage(text=f"Translate: {message}")
-        response = await chat.send_message(user_message)
-        return response.strip()
-    except Exception as e:
-        logging.error(f"Translation error: {e}")
-        return message
+async def get_chat_by_id(chat_id: str) -> Optional[dict]:
+    return await db.chats.find_one({"id": chat_id}, NO_ID)
 
-# Authentication endpoints
-@app.post("/api/auth/register")
-async def register_user(user_data: UserCreate):
-    # Check if user exists
-    existing_user = await db.users.find_one(
-        {"$or": [{"username": user_data.username}, {"email": user_data.email}]}
-    )
-    if existing_user:
-        raise HTTPException(status_code=400, detail="User already exists")
-    
-    # Create new user
-    hashed_password = hash_password(user_data.password)
-    user = User(
-        username=user_data.username,
-        email=user_data.email,
-        password_hash=hashed_password,
-        display_name=user_data.display_name,
-        phone=user_data.phone
-    )
-    
-    await db.users.insert_one(user.dict())
-    
-    # Create access token
-    access_token = create_access_token(data={"sub": user.id})
-    
-    return {
-        "access_token": access_token,
-        "token_type": "bearer",
-        "user": {
-            "id": user.id,
-            "username": user.username,
-            "display_name": user.display_name,
-            "email": user.email
-        }
-    }
+def generate_reset_token() -> str:
+    return secrets.token_urlsafe(32)
 
-@app.post("/api/auth/login")
-async def login_user(user_data: UserLogin):
-    user = await db.users.find_one({"username": user_data.username})
-    if not user or not verify_password(user_data.password, user["password_hash"]):
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    access_token = create_access_token(data={"sub": user["id"]})
-    
+def reset_email(user_name: str, token: str) -> Dict[str, str]:
+    """Subject and plain-text body of the password reset email."""
     return {
-        "access_token": access_token,
-        "token_type": "bearer",
-        "user": {
-            "id": user["id"],
-            "username": user["username"],
-            "display_name": user["display_name"],
-            "email": user["email"]
-        }
+        "subject": "Reset your SISI Chat password",
+        "body": (
+            f"Hi {user_name},\n\n"
+            "You requested to reset your password for SISI Chat.\n"
+            f"Your reset token is: {token}\n\n"
+            "Copy this token and paste it in the reset password form.\n"
+            f"This token will expire in {PASSWORD_RESET_TTL_MINUTES} minutes.\n\n"
+            "If you didn't request this, please ignore this email.\n\n"
+            "Best regards,\n"
+            "SISI Chat Team\n"
+        ),
     }
 
-@app.post("/api/auth/forgot-password")
-async def forgot_password(request: ForgotPasswordRequest):
-    # Find user by email
-    user = await db.users.find_one({"email": request.email})
-    if not user:
-        # Don't reveal if email exists or not for security
-        return {"message": "If your email is registered, you will receive a reset link"}
-    
-    # Generate reset token
-    reset_token = generate_reset_token()
-    expires_at = datetime.utcnow() + timedelta(hours=1)  # Token expires in 1 hour
-    
-    # Store reset token in database
+# Password reset tokens
+# Only a SHA-256 of each token is stored, so a leaked collection cannot be
+# used to reset anyone's password. A user holds at most
+# PASSWORD_RESET_MAX_ACTIVE unused tokens (issuing another drops the oldest),
+# and a TTL index on expires_at removes expired documents. Redeeming is one
+# find_one_and_update, so a token can never be used twice.
+PASSWORD_RESET_TTL_MINUTES = int(os.environ.get('PASSWORD_RESET_TTL_MINUTES', '60'))
+PASSWORD_RESET_MAX_ACTIVE = int(os.environ.get('PASSWORD_RESET_MAX_ACTIVE', '3'))
+
+def hash_reset_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+async def issue_reset_token(user_id: str) -> str:
+    token = generate_reset_token()
+    now = datetime.utcnow()
     await db.password_resets.insert_one({
-        "user_id": user["id"],
-        "email": user["email"],
-        "token": reset_token,
-        "expires_at": expires_at,
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "token_hash": hash_reset_token(token),
+        "expires_at": now + timedelta(minutes=PASSWORD_RESET_TTL_MINUTES),
         "used": False,
-        "created_at": datetime.utcnow()
+        "created_at": now
     })
-    
-    # Send reset email
-    email_sent = await send_reset_email(user["email"], reset_token, user["display_name"])
-    
-    if not email_sent:
-        raise HTTPException(status_code=500, detail="Failed to send reset email")
-    
-    return {"message": "Password reset email sent successfully"}
+    surplus = await db.password_resets.find(
+        {"user_id": user_id, "used": False}, {"_id": 0, "id": 1}
+    ).sort([("created_at", -1), ("_id", -1)]).skip(PASSWORD_RESET_MAX_ACTIVE).to_list(None)
+    if surplus:
+        await db.password_resets.delete_many({"id": {"$in": [doc["id"] for doc in surplus]}})
+    return token
 
-@app.post("/api/auth/reset-password")
-async def reset_password(request: ResetPasswordRequest):
-    # Find valid reset token
-    reset_record = await db.password_resets.find_one({
-        "token": request.token,
-        "used": False,
-        "expires_at": {"$gt": datetime.utcnow()}
-    })
-    
-    if not reset_record:
-        raise HTTPException(status_code=400, detail="Invalid or expired reset token")
-    
-    # Hash new password
-    new_password_hash = hash_password(request.new_password)
-    
-    # Update user password
-    await db.users.update_one(
-        {"id": reset_record["user_id"]},
-        {"$set": {"password_hash": new_password_hash, "updated_at": datetime.utcnow()}}
-    )
-    
-    # Mark token as used
-    await db.password_resets.update_one(
-        {"_id": reset_record["_id"]},
-        {"$set": {"used": True, "used_at": datetime.utcnow()}}
+async def redeem_reset_token(token: str) -> Optional[dict]:
+    """Mark a valid token used and return its record, or None if it is invalid, used or expired."""
+    now = datetime.utcnow()
+    return await db.password_resets.find_one_and_update(
+        {"token_hash": hash_reset_token(token), "used": False, "expires_at": {"$gt": now}},
+        {"$set": {"used": True, "used_at": now}},
+        projection=NO_ID
     )
-    
-    return {"message": "Password reset successfully"}
 
-# User search endpoint
-@app.get("/api/users/search")
+@app.on_event("startup")
+async def create_password_reset_indexes():
+    # Tokens from before hashing were stored in the clear; they expire within the hour anyway
+    await db.password_resets.delete_many({"token": {"$exists": True}})
+    await db.password_resets.create_index("token_hash", unique=True)
+    await db.password_resets.create_index([("user_id", 1), ("created_at", -1)])
+    await db.password_resets.create_index("expires_at", expireAfterSeconds=0)
+
+# Delivery outbox
+# Email and web-push messages are written to db.outbox by the handler that
+# causes them and delivered by a pool of background workers, so no request
+# waits on a third-party service. Each worker claims a batch under a lease
+# (a crashed worker's batch is picked up again when the lease runs out),
+# hands it to the channel's provider, and records every outcome in one bulk
+# write. Claiming counts as an attempt, so a message that keeps crashing its
+# worker still runs out of attempts. Failures retry with exponential backoff
+# and jitter; a message that uses up OUTBOX_MAX_ATTEMPTS, or fails
+# permanently, is dead-lettered with status "dead" and kept for inspection.
+EMAIL_PROVIDER = os.environ.get('EMAIL_PROVIDER', 'log')  # log, smtp
+PUSH_PROVIDER = os.environ.get('PUSH_PROVIDER', 'log')  # log, webpush
+EMAIL_FROM = os.environ.get('EMAIL_FROM', 'SISI Chat <noreply@sisichat.com>')
+SMTP_HOST = os.environ.get('SMTP_HOST', 'localhost')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', '587'))
+SMTP_USER = os.environ.get('SMTP_USER', '')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', '')
+VAPID_PRIVATE_KEY = os.environ.get('VAPID_PRIVATE_KEY', '')
+VAPID_SUBJECT = os.environ.get('VAPID_SUBJECT', 'mailto:noreply@sisichat.com')
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', '4'))
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_POLL_SECONDS = float(os.environ.get('OUTBOX_POLL_SECONDS', '2'))
+OUTBOX_LEASE_SECONDS = float(os.environ.get('OUTBOX_LEASE_SECONDS', '60'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_BACKOFF_SECONDS = float(os.environ.get('OUTBOX_BACKOFF_SECONDS', '5'))
+OUTBOX_BACKOFF_MAX_SECONDS = float(os.environ.get('OUTBOX_BACKOFF_MAX_SECONDS', '3600'))
+OUTBOX_SENT_RETENTION_HOURS = float(os.environ.get('OUTBOX_SENT_RETENTION_HOURS', '24'))
+OUTBOX_DEAD_RETENTION_DAYS = float(os.environ.get('OUTBOX_DEAD_RETENTION_DAYS', '14'))
+OUTBOX_FAKE_FAILURE_RATE = float(os.environ.get('OUTBOX_FAKE_FAILURE_RATE', '0'))
+
+try:
+    from pywebpush import webpush, WebPushException
+except ImportError:  # only needed for PUSH_PROVIDER=webpush
+    webpush = None
+
+metrics.describe("outbox_deliveries_total", "counter", "Outbox delivery attempts, by channel and outcome")
+
+class DeliveryError(Exception):
+    def __init__(self, message: str, permanent: bool = False):
+        super().__init__(message)
+        self.permanent = permanent
+
+class LogEmailProvider:
+    """Local stand-in that logs emails instead of sending them.
+
+    The last messages are kept in ``sent``; OUTBOX_FAKE_FAILURE_RATE makes
+    a share of sends fail so retries can be exercised.
+    """
+
+    channel = "email"
+
+    def __init__(self):
+        self.sent = deque(maxlen=100)
+
+    async def send_batch(self, messages: List[dict]) -> Dict[str, Optional[DeliveryError]]:
+        results = {}
+        for message in messages:
+            if random.random() < OUTBOX_FAKE_FAILURE_RATE:
+                results[message["id"]] = DeliveryError("Simulated failure")
+                continue
+            payload = message["payload"]
+            logging.info(f"Email to {message['to']}: {payload['subject']}\n{payload['body']}")
+            self.sent.append(message)
+            results[message["id"]] = None
+        return results
+
+class SmtpEmailProvider:
+    """Sends a batch over one SMTP connection, on a thread."""
+
+    channel = "email"
+
+    def _send(self, messages: List[dict]) -> Dict[str, Optional[DeliveryError]]:
+        import smtplib
+        from email.message import EmailMessage
+
+        results = {}
+        smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+        try:
+            smtp.starttls()
+            if SMTP_USER:
+                smtp.login(SMTP_USER, SMTP_PASSWORD)
+            for message in messages:
+                try:
+                    email = EmailMessage()
+                    email["From"] = EMAIL_FROM
+                    email["To"] = message["to"]
+                    email["Subject"] = message["payload"]["subject"]
+                    email.set_content(message["payload"]["body"])
+                    smtp.send_message(email)
+                    results[message["id"]] = None
+                except smtplib.SMTPRecipientsRefused as e:
+                    results[message["id"]] = DeliveryError(str(e), permanent=True)
+                except Exception as e:
+                    # Only this message failed so far; the ones already sent must not be resent
+                    results[message["id"]] = DeliveryError(str(e))
+        finally:
+            try:
+                smtp.quit()
+            except Exception:
+                pass  # what was sent is already accepted
+        return results
+
+    async def send_batch(self, messages: List[dict]) -> Dict[str, Optional[DeliveryError]]:
+        try:
+            return await asyncio.to_thread(self._send, messages)
+        except Exception as e:
+            # Could not connect or log in: the whole batch retries
+            return {message["id"]: DeliveryError(str(e)) for message in messages}
+
+class LogPushProvider:
+    """Local stand-in for web push; logs each notification."""
+
+    channel = "push"
+
+    def __init__(self):
+        self.sent = deque(maxlen=100)
+
+    async def send_batch(self, messages: List[dict]) -> Dict[str, Optional[DeliveryError]]:
+        results = {}
+        for message in messages:
+            if random.random() < OUTBOX_FAKE_FAILURE_RATE:
+                results[message["id"]] = DeliveryError("Simulated failure")
+                continue
+            logging.info(f"Push to {message['to']}: {message['payload'].get('title')}")
+            self.sent.append(message)
+            results[message["id"]] = None
+        return results
+
+class WebPushProvider:
+    """Delivers to the browser push subscription stored for the user (VAPID)."""
+
+    channel = "push"
+
+    def __init__(self):
+        if webpush is None:
+            raise ValueError("PUSH_PROVIDER=webpush requires the pywebpush package")
+        if not VAPID_PRIVATE_KEY:
+            raise ValueError("PUSH_PROVIDER=webpush requires VAPID_PRIVATE_KEY")
+
+    def _send(self, message: dict) -> Optional[DeliveryError]:
+        try:
+            webpush(
+                subscription_info=message["subscription"],
+                data=json.dumps(message["payload"]),
+                vapid_private_key=VAPID_PRIVATE_KEY,
+                vapid_claims={"sub": VAPID_SUBJECT},
+                timeout=10
+            )
+            return None
+        except WebPushException as e:
+            status_code = getattr(e.response, "status_code", None)
+            # 404/410: the browser dropped the subscription
+            return DeliveryError(str(e), permanent=status_code in (404, 410))
+
+    async def send_batch(self, messages: List[dict]) -> Dict[str, Optional[DeliveryError]]:
+        errors = await asyncio.gather(*(asyncio.to_thread(self._send, m) for m in messages))
+        return {message["id"]: error for message, error in zip(messages, errors)}
+
+EMAIL_PROVIDERS = {"log": LogEmailProvider, "smtp": SmtpEmailProvider}
+PUSH_PROVIDERS = {"log": LogPushProvider, "webpush": WebPushProvider}
+if EMAIL_PROVIDER not in EMAIL_PROVIDERS:
+    raise ValueError(f"EMAIL_PROVIDER must be one of: {', '.join(EMAIL_PROVIDERS)}")
+if PUSH_PROVIDER not in PUSH_PROVIDERS:
+    raise ValueError(f"PUSH_PROVIDER must be one of: {', '.join(PUSH_PROVIDERS)}")
+
+class Outbox:
+    """Durable queue of outgoing email and push messages, drained by a worker pool."""
+
+    def __init__(self, providers: Dict[str, Any], workers: int = OUTBOX_WORKERS):
+        self.providers = providers
+        self.workers = workers
+        self.wakeup = asyncio.Event()
+        self.tasks: List[asyncio.Task] = []
+
+    async def enqueue(self, channel: str, user_id: str, to: str, payload: Dict[str, Any]) -> str:
+        """Queue one message; ``to`` is an email address, or the user id for push."""
+        now = datetime.utcnow()
+        message_id = str(uuid.uuid4())
+        await db.outbox.insert_one({
+            "id": message_id,
+            "channel": channel,
+            "user_id": user_id,
+            "to": to,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "lease_until": None,
+            "last_error": None,
+            "created_at": now,
+        })
+        self.wakeup.set()
+        return message_id
+
+    async def claim(self) -> List[dict]:
+        now = datetime.utcnow()
+        # The lease ran out on the last attempt (the worker crashed or the provider raised)
+        await db.outbox.update_many(
+            {"status": "sending", "lease_until": {"$lt": now}, "attempts": {"$gte": OUTBOX_MAX_ATTEMPTS}},
+            {"$set": {"status": "dead", "last_error": "Delivery did not finish before the lease ran out",
+                      "expires_at": now + timedelta(days=OUTBOX_DEAD_RETENTION_DAYS)}}
+        )
+        due = {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "sending", "lease_until": {"$lt": now}, "attempts": {"$lt": OUTBOX_MAX_ATTEMPTS}},
+        ]}
+        candidates = await db.outbox.find(due, {"_id": 0, "id": 1}).limit(OUTBOX_BATCH_SIZE).to_list(OUTBOX_BATCH_SIZE)
+        if not candidates:
+            return []
+        # Another worker may take some of these first; the claim token tells us which are ours
+        claim = str(uuid.uuid4())
+        await db.outbox.update_many(
+            {"$and": [{"id": {"$in": [c["id"] for c in candidates]}}, due]},
+            {"$set": {"status": "sending", "claim": claim, "lease_until": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)},
+             "$inc": {"attempts": 1}}
+        )
+        return await db.outbox.find({"claim": claim, "status": "sending"}, NO_ID).to_list(None)
+
+    async def _attach_subscriptions(self, messages: List[dict]) -> List[dict]:
+        subscriptions = {
+            doc["user_id"]: doc["subscription"]
+            async for doc in db.push_subscriptions.find(
+                {"user_id": {"$in": [m["to"] for m in messages]}}, {"_id": 0, "user_id": 1, "subscription": 1}
+            )
+        }
+        for message in messages:
+            message["subscription"] = subscriptions.get(message["to"])
+        return messages
+
+    async def deliver(self, batch: List[dict]):
+        results: Dict[str, Optional[DeliveryError]] = {}
+        skipped = set()
+        by_channel: Dict[str, List[dict]] = {}
+        for message in batch:
+            by_channel.setdefault(message["channel"], []).append(message)
+        for channel, messages in by_channel.items():
+            provider = self.providers.get(channel)
+            if provider is None:
+                results.update({m["id"]: DeliveryError(f"No provider for {channel}", permanent=True) for m in messages})
+                continue
+            if channel == "push":
+                messages = await self._attach_subscriptions(messages)
+                skipped.update(m["id"] for m in messages if not m["subscription"])
+                messages = [m for m in messages if m["subscription"]]
+            if messages:
+                try:
+                    results.update(await provider.send_batch(messages))
+                except Exception as e:
+                    logging.error(f"Outbox {channel} provider failed: {e}")
+                    results.update({m["id"]: DeliveryError(str(e)) for m in messages})
+
+        now = datetime.utcnow()
+        ops = []
+        for message in batch:
+            claimed = {"id": message["id"], "claim": message["claim"]}
+            if message["id"] in skipped:
+                outcome = "skipped"
+                update = {"$set": {"status": "skipped", "expires_at": now + timedelta(hours=OUTBOX_SENT_RETENTION_HOURS)},
+                          "$unset": {"payload": ""}}
+            elif message["id"] not in results:
+                continue  # lease runs out and the message is retried
+            elif results[message["id"]] is None:
+                outcome = "sent"
+                # The payload may hold secrets such as reset tokens; drop it once delivered
+                update = {"$set": {"status": "sent", "sent_at": now,
+                                   "expires_at": now + timedelta(hours=OUTBOX_SENT_RETENTION_HOURS)},
+                          "$unset": {"payload": ""}}
+            else:
+                error = results[message["id"]]
+                attempts = message["attempts"]  # this one was counted when claimed
+                if error.permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+                    outcome = "dead"
+                    update = {"$set": {"status": "dead", "last_error": str(error)[:500],
+                                       "expires_at": now + timedelta(days=OUTBOX_DEAD_RETENTION_DAYS)}}
+                    if error.permanent and message["channel"] == "push":
+                        await db.push_subscriptions.delete_one({"user_id": message["to"]})
+                else:
+                    outcome = "retry"
+                    delay = min(OUTBOX_BACKOFF_MAX_SECONDS, OUTBOX_BACKOFF_SECONDS * 2 ** (attempts - 1))
+                    update = {"$set": {"status": "pending", "last_error": str(error)[:500],
+                                       "next_attempt_at": now + timedelta(seconds=delay * random.uniform(0.5, 1.0)),
+                                       "lease_until": None}}
+            ops.append(UpdateOne(claimed, update))
+            metrics.inc("outbox_deliveries_total", {"channel": message["channel"], "outcome": outcome})
+        if ops:
+            await db.outbox.bulk_write(ops, ordered=False)
+
+    async def run(self):
+        while True:
+            try:
+                batch = await self.claim()
+                if batch:
+                    await self.deliver(batch)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Outbox delivery failed: {e}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self.run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        for task in self.tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.tasks = []
+
+outbox = Outbox({"email": EMAIL_PROVIDERS[EMAIL_PROVIDER](), "push": PUSH_PROVIDERS[PUSH_PROVIDER]()})
+
+@app.on_event("startup")
+async def start_outbox():
+    await db.outbox.create_index("id", unique=True)
+    await db.outbox.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.outbox.create_index([("status", 1), ("lease_until", 1)])
+    await db.outbox.create_index("claim")
+    await db.outbox.create_index("user_id")
+    await db.outbox.create_index("expires_at", expireAfterSeconds=0)
+    outbox.start()
+
+@app.on_event("shutdown")
+async def stop_outbox():
+    await outbox.stop()
+
+# Rate limiting
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # memory, redis
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0')
+# Only honour X-Forwarded-For behind a proxy that sets it; otherwise clients pick their own key
+RATE_LIMIT_TRUST_FORWARDED = os.environ.get('RATE_LIMIT_TRUST_FORWARDED', 'false').lower() == 'true'
+RATE_LIMIT_MAX_KEYS = 100_000
+WS_FRAME_RATE = float(os.environ.get('WS_FRAME_RATE', '20'))  # inbound frames per second per connection
+WS_FRAME_BURST = int(os.environ.get('WS_FRAME_BURST', '40'))
+WS_MAX_THROTTLED_FRAMES = int(os.environ.get('WS_MAX_THROTTLED_FRAMES', '50'))
+WS_CLOSE_RATE_LIMITED = 4029
+
+# Budget name -> (burst capacity, seconds to refill it). Override with
+# RATE_LIMITS="search=60/30,ai=10/60".
+RATE_LIMITS = {
+    "login": (10, 60),            # per client IP
+    "login_account": (5, 60),     # per username, whichever IP it comes from
+    "register": (5, 600),
+    "password_reset": (5, 900),
+    "search": (30, 30),
+    "suggestions": (10, 60),
+    "ai": (20, 60),
+    "upload": (30, 60),
+    "chat_message": (30, 10),
+    "ws_connect": (20, 60),
+}
+for _override in filter(None, os.environ.get('RATE_LIMITS', '').split(',')):
+    _name, _, _budget = _override.partition('=')
+    _capacity, _, _period = _budget.partition('/')
+    RATE_LIMITS[_name.strip()] = (int(_capacity), float(_period))
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # only needed for RATE_LIMIT_BACKEND=redis
+    aioredis = None
+
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, cost: float = 1) -> float:
+        """Spend ``cost`` tokens; returns 0 on success, else seconds until they are available."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def full_at(self) -> float:
+        return self.updated + (self.capacity - self.tokens) / self.rate
+
+class MemoryRateLimitBackend:
+    """Token buckets in this process; limits are per worker."""
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self.buckets: Dict[str, TokenBucket] = {}
+
+    def _prune(self):
+        # A bucket that has refilled is the same as no bucket at all
+        now = time.monotonic()
+        for key in [key for key, bucket in self.buckets.items() if bucket.full_at() <= now]:
+            del self.buckets[key]
+        if len(self.buckets) >= self.max_keys:
+            for key in list(self.buckets)[:self.max_keys // 10]:
+                del self.buckets[key]
+
+    async def acquire(self, key: str, capacity: int, period: float) -> float:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self._prune()
+            bucket = self.buckets[key] = TokenBucket(capacity, capacity / period)
+        return bucket.take()
+
+class RedisRateLimitBackend:
+    """Token buckets shared by every worker, updated atomically by a Lua script."""
+
+    # Uses the Redis clock so workers with skewed clocks agree
+    SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        if aioredis is None:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis needs the redis package")
+        self.redis = aioredis.from_url(url)
+        self.script = self.redis.register_script(self.SCRIPT)
+
+    async def acquire(self, key: str, capacity: int, period: float) -> float:
+        return float(await self.script(keys=[key], args=[capacity, capacity / period]))
+
+class RateLimiter:
+    """Charges requests against named budgets, keyed by user or client IP.
+
+    If the shared backend is unreachable the limiter falls back to per-process
+    buckets rather than failing requests.
+    """
+
+    def __init__(self, shared=None):
+        self.local = MemoryRateLimitBackend()
+        self.shared = shared
+        self.last_shared_error = 0.0
+
+    async def hit(self, budget: str, key: str) -> float:
+        """0 if the call may proceed, otherwise the seconds to wait before retrying."""
+        if not RATE_LIMIT_ENABLED:
+            return 0.0
+        capacity, period = RATE_LIMITS[budget]
+        bucket_key = f"rl:{budget}:{key}"
+        if self.shared is not None:
+            try:
+                return await self.shared.acquire(bucket_key, capacity, period)
+            except Exception as e:
+                if time.monotonic() - self.last_shared_error > 60:
+                    logging.error(f"Shared rate limit backend failed, limiting per process: {e}")
+                    self.last_shared_error = time.monotonic()
+        return await self.local.acquire(bucket_key, capacity, period)
+
+rate_limiter = RateLimiter(RedisRateLimitBackend(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_BACKEND == "redis" else None)
+
+def client_ip(connection) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = connection.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return connection.client.host if connection.client else "unknown"
+
+async def enforce_rate_limit(budget: str, key: str):
+    retry_after = await rate_limiter.hit(budget, key)
+    if retry_after > 0:
+        metrics.inc("rate_limited_total", {"budget": budget, "transport": "http"})
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+def rate_limit(budget: str, by_ip: bool = False):
+    """Route dependency charging one token of ``budget`` to the caller.
+
+    Authenticated callers are keyed by user id, anonymous ones (and every
+    caller when ``by_ip`` is set) by client IP.
+    """
+    async def check(request: Request, user_id: Optional[str] = Depends(get_optional_user)):
+        key = f"user:{user_id}" if user_id and not by_ip else f"ip:{client_ip(request)}"
+        await enforce_rate_limit(budget, key)
+    return Depends(check)
+
+# AI Integration for message suggestions and translation
+AI_MODEL_PROVIDER = os.environ.get('AI_MODEL_PROVIDER', 'openai')
+AI_MODEL_NAME = os.environ.get('AI_MODEL_NAME', 'gpt-4o-mini')
+AI_MAX_CONCURRENCY = int(os.environ.get('AI_MAX_CONCURRENCY', '16'))
+AI_MAX_CONCURRENCY_PER_USER = int(os.environ.get('AI_MAX_CONCURRENCY_PER_USER', '2'))
+AI_CALL_TIMEOUT_SECONDS = float(os.environ.get('AI_CALL_TIMEOUT_SECONDS', '15'))
+AI_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('AI_QUEUE_TIMEOUT_SECONDS', '2'))
+AI_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('AI_BREAKER_FAILURE_THRESHOLD', '5'))
+AI_BREAKER_RESET_SECONDS = float(os.environ.get('AI_BREAKER_RESET_SECONDS', '30'))
+
+FALLBACK_SUGGESTIONS = ["Thanks!", "Got it", "Let me check"]
+
+class AIUnavailable(Exception):
+    """Raised when an LLM call is rejected, times out or fails upstream."""
+
+class CircuitBreaker:
+    """Closed -> open after consecutive failures; half-open lets one probe through."""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+        if self.probe_in_flight:
+            return False
+        self.probe_in_flight = True
+        return True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+class AIClient:
+    """Single entry point for LLM calls.
+
+    Every call is bounded by a global and a per-user semaphore and a deadline
+    covering both queueing and the upstream request. A circuit breaker makes
+    callers fail fast to their fallback while the provider is unhealthy.
+    """
+
+    def __init__(self):
+        self.global_slots = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+        self.user_slots: Dict[str, asyncio.Semaphore] = {}
+        self.user_waiters: Dict[str, int] = {}
+        self.breaker = CircuitBreaker(AI_BREAKER_FAILURE_THRESHOLD, AI_BREAKER_RESET_SECONDS)
+        self.stats = {
+            "calls": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "timeouts": 0,
+            "rejected_queue": 0,
+            "rejected_breaker": 0,
+            "queue_wait_seconds_total": 0.0,
+            "queue_wait_seconds_max": 0.0,
+            "upstream_seconds_total": 0.0,
+            "upstream_seconds_max": 0.0,
+        }
+
+    def _observe(self, name: str, seconds: float):
+        metrics.observe(f"ai_{name}_seconds", seconds)
+        self.stats[f"{name}_seconds_total"] += seconds
+        if seconds > self.stats[f"{name}_seconds_max"]:
+            self.stats[f"{name}_seconds_max"] = seconds
+
+    def _user_semaphore(self, user_id: str) -> asyncio.Semaphore:
+        if user_id not in self.user_slots:
+            self.user_slots[user_id] = asyncio.Semaphore(AI_MAX_CONCURRENCY_PER_USER)
+            self.user_waiters[user_id] = 0
+        self.user_waiters[user_id] += 1
+        return self.user_slots[user_id]
+
+    def _release_user(self, user_id: str):
+        self.user_waiters[user_id] -= 1
+        if self.user_waiters[user_id] == 0:
+            del self.user_waiters[user_id]
+            del self.user_slots[user_id]
+
+    async def complete(self, system_message: str, prompt: str, session_prefix: str,
+                       user_id: str = "anonymous", timeout: Optional[float] = None) -> str:
+        self.stats["calls"] += 1
+        if not self.breaker.allow():
+            self.stats["rejected_breaker"] += 1
+            raise AIUnavailable("circuit open")
+        # allow() only sets the flag for the one call it lets through as the half-open probe
+        probing = self.breaker.probe_in_flight
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or AI_CALL_TIMEOUT_SECONDS)
+        queued_at = loop.time()
+        user_slot = self._user_semaphore(user_id)
+        acquired_user = acquired_global = False
+        try:
+            try:
+                queue_budget = min(AI_QUEUE_TIMEOUT_SECONDS, deadline - loop.time())
+                await asyncio.wait_for(user_slot.acquire(), queue_budget)
+                acquired_user = True
+                await asyncio.wait_for(self.global_slots.acquire(), max(0.0, queued_at + queue_budget - loop.time()))
+                acquired_global = True
+            except asyncio.TimeoutError:
+                # Saturation is not an upstream failure; the probe slot is freed below
+                self.stats["rejected_queue"] += 1
+                raise AIUnavailable("no capacity")
+            finally:
+                self._observe("queue_wait", loop.time() - queued_at)
+
+            started = loop.time()
+            try:
+                from emergentintegrations.llm.chat import LlmChat, UserMessage
+
+                chat = LlmChat(
+                    api_key=os.environ.get('EMERGENT_LLM_KEY'),
+                    session_id=f"{session_prefix}-{uuid.uuid4()}",
+                    system_message=system_message
+                ).with_model(AI_MODEL_PROVIDER, AI_MODEL_NAME)
+                response = await asyncio.wait_for(
+                    chat.send_message(UserMessage(text=prompt)),
+                    max(0.0, deadline - loop.time())
+                )
+            except asyncio.TimeoutError:
+                self.stats["timeouts"] += 1
+                self.stats["failed"] += 1
+                self.breaker.record_failure()
+                raise AIUnavailable("upstream timeout")
+            except Exception as e:
+                self.stats["failed"] += 1
+                self.breaker.record_failure()
+                raise AIUnavailable(str(e)) from e
+            finally:
+                self._observe("upstream", loop.time() - started)
+
+            self.stats["succeeded"] += 1
+            self.breaker.record_success()
+            return response
+        finally:
+            if acquired_global:
+                self.global_slots.release()
+            if acquired_user:
+                user_slot.release()
+            self._release_user(user_id)
+            if probing:
+                # Also when the caller was cancelled mid-probe, or the breaker would never close
+                self.breaker.probe_in_flight = False
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "in_flight": AI_MAX_CONCURRENCY - self.global_slots._value,
+            "users_queued": len(self.user_slots),
+            "breaker_state": self.breaker.state,
+            "breaker_failures": self.breaker.failures,
+        }
+
+ai_client = AIClient()
+
+async def get_ai_suggestions(message: str, context: str = "", user_id: str = "anonymous") -> List[str]:
+    try:
+        response = await ai_client.complete(
+            system_message="Generate 3 short, helpful message suggestions based on the context. Return only the suggestions, one per line.",
+            prompt=f"Context: {context}\nMessage: {message}\nGenerate 3 helpful response suggestions:",
+            session_prefix="suggestions",
+            user_id=user_id
+        )
+        suggestions = [s.strip() for s in response.split('\n') if s.strip()][:3]
+        return suggestions or FALLBACK_SUGGESTIONS
+    except AIUnavailable as e:
+        logging.warning(f"AI suggestions unavailable: {e}")
+        return FALLBACK_SUGGESTIONS
+
+async def translate_message(message: str, target_language: str = "en", user_id: str = "anonymous") -> str:
+    try:
+        response = await ai_client.complete(
+            system_message=f"Translate the given text to {target_language}. Return only the translation, no extra text.",
+            prompt=f"Translate: {message}",
+            session_prefix="translate",
+            user_id=user_id
+        )
+        return response.strip()
+    except AIUnavailable as e:
+        logging.warning(f"Translation unavailable: {e}")
+        return message
+
+# Authentication endpoints
+@app.post("/api/auth/register", dependencies=[rate_limit("register", by_ip=True)])
+async def register_user(user_data: UserCreate):
+    # Check if user exists
+    existing_user = await db.users.find_one(
+        {"$or": [{"username": user_data.username}, {"email": user_data.email}]}
+    )
+    if existing_user:
+        raise HTTPException(status_code=400, detail="User already exists")
+    
+    # Create new user
+    hashed_password = hash_password(user_data.password)
+    user = User(
+        username=user_data.username,
+        email=user_data.email,
+        password_hash=hashed_password,
+        display_name=user_data.display_name,
+        phone=user_data.phone
+    )
+    
+    await db.users.insert_one(user.dict())
+    
+    # Create access token
+    access_token = create_access_token(data={"sub": user.id})
+    
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "user": {
+            "id": user.id,
+            "username": user.username,
+            "display_name": user.display_name,
+            "email": user.email
+        }
+    }
+
+@app.post("/api/auth/login", dependencies=[rate_limit("login", by_ip=True)])
+async def login_user(user_data: UserLogin):
+    # Guessing one account's password from many addresses still hits a limit
+    await enforce_rate_limit("login_account", user_data.username.lower())
+    user = await db.users.find_one({"username": user_data.username, "deleted": {"$ne": True}})
+    if not user or not verify_password(user_data.password, user["password_hash"]):
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    
+    access_token = create_access_token(data={"sub": user["id"]})
+    
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "user": {
+            "id": user["id"],
+            "username": user["username"],
+            "display_name": user["display_name"],
+            "email": user["email"]
+        }
+    }
+
+@app.post("/api/auth/forgot-password", dependencies=[rate_limit("password_reset", by_ip=True)])
+async def forgot_password(request: ForgotPasswordRequest):
+    # Find user by email
+    user = await db.users.find_one({"email": request.email, "deleted": {"$ne": True}})
+    if not user:
+        # Don't reveal if email exists or not for security
+        return {"message": "If your email is registered, you will receive a reset link"}
+    
+    reset_token = await issue_reset_token(user["id"])
+    await outbox.enqueue("email", user["id"], user["email"], reset_email(user["display_name"], reset_token))
+    
+    return {"message": "If your email is registered, you will receive a reset link"}
+
+@app.post("/api/auth/reset-password", dependencies=[rate_limit("password_reset", by_ip=True)])
+async def reset_password(request: ResetPasswordRequest):
+    # Mark the token used in the same step that validates it
+    reset_record = await redeem_reset_token(request.token)
+    
+    if not reset_record:
+        raise HTTPException(status_code=400, detail="Invalid or expired reset token")
+    
+    # Hash new password
+    new_password_hash = hash_password(request.new_password)
+    
+    # Update user password
+    await db.users.update_one(
+        {"id": reset_record["user_id"]},
+        {"$set": {"password_hash": new_password_hash, "updated_at": datetime.utcnow()}}
+    )
+    
+    # Any other outstanding tokens for this account are now moot
+    await db.password_resets.delete_many({"user_id": reset_record["user_id"], "used": False})
+    
+    return {"message": "Password reset successfully"}
+
+# Privacy settings
+# Settings are read on hot paths (typing indicators, presence in user lists),
+# so they are cached per user for PRIVACY_CACHE_TTL_SECONDS. A user who never
+# changed anything has no document: the defaults in PrivacySettings apply
+# without being written, and only the fields a user sets are stored.
+PRIVACY_CACHE_TTL_SECONDS = float(os.environ.get('PRIVACY_CACHE_TTL_SECONDS', '60'))
+PRIVACY_CACHE_MAX_USERS = int(os.environ.get('PRIVACY_CACHE_MAX_USERS', '50000'))
+
+class PrivacyService:
+    """Effective privacy settings by user id, defaults filled in."""
+
+    def __init__(self, max_users: int = PRIVACY_CACHE_MAX_USERS):
+        self.max_users = max_users
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.defaults = PrivacySettings().dict()
+        self.projection = {"_id": 0, "user_id": 1, **{name: 1 for name in self.defaults}}
+
+    async def get_settings(self, user_ids: List[str]) -> Dict[str, Dict[str, bool]]:
+        """Settings for every given user, from one query for those not cached."""
+        now = time.monotonic()
+        found = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            entry = self.entries.get(user_id)
+            if entry is not None and now - entry[0] < PRIVACY_CACHE_TTL_SECONDS:
+                self.entries.move_to_end(user_id)
+                found[user_id] = entry[1]
+            else:
+                missing.append(user_id)
+        if missing:
+            stored = {
+                doc.pop("user_id"): doc
+                async for doc in db.privacy_settings.find({"user_id": {"$in": missing}}, self.projection)
+            }
+            for user_id in missing:
+                settings = {**self.defaults, **stored.get(user_id, {})}
+                found[user_id] = settings
+                self.entries[user_id] = (now, settings)
+                self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_users:
+                self.entries.popitem(last=False)
+        return found
+
+    async def get(self, user_id: str) -> Dict[str, bool]:
+        return (await self.get_settings([user_id]))[user_id]
+
+    async def update(self, user_id: str, changes: Dict[str, bool]) -> Dict[str, bool]:
+        if changes:
+            await db.privacy_settings.update_one(
+                {"user_id": user_id},
+                {"$set": {**changes, "updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+        self.invalidate(user_id)
+        return await self.get(user_id)
+
+    def invalidate(self, user_id: str):
+        self.entries.pop(user_id, None)
+
+privacy = PrivacyService()
+
+# Friend graph
+# Each user's friendships are cached as adjacency sets: accepted friends plus
+# pending requests in either direction. The friend endpoints update cached
+# entries in place, so this process never serves a stale edge; other
+# processes see changes once FRIEND_CACHE_TTL_SECONDS pass.
+FRIEND_CACHE_TTL_SECONDS = float(os.environ.get('FRIEND_CACHE_TTL_SECONDS', '300'))
+FRIEND_CACHE_MAX_USERS = int(os.environ.get('FRIEND_CACHE_MAX_USERS', '20000'))
+PROFILE_CACHE_TTL_SECONDS = float(os.environ.get('PROFILE_CACHE_TTL_SECONDS', '60'))
+PROFILE_CACHE_MAX_USERS = int(os.environ.get('PROFILE_CACHE_MAX_USERS', '20000'))
+FRIEND_EDGE_FIELDS = {"_id": 0, "user_id": 1, "friend_id": 1, "status": 1}
+
+class FriendEdges:
+    """One user's side of the friend graph."""
+
+    __slots__ = ("friends", "sent", "received", "ordered", "loaded_at")
+
+    def __init__(self):
+        self.friends: set = set()
+        self.sent: set = set()
+        self.received: set = set()
+        self.ordered: Optional[List[str]] = None
+        self.loaded_at = time.monotonic()
+
+    def add(self, user_id: str, edge: Dict[str, Any]):
+        outgoing = edge["user_id"] == user_id
+        other = edge["friend_id"] if outgoing else edge["user_id"]
+        if edge.get("status") == "accepted":
+            self.friends.add(other)
+        elif outgoing:
+            self.sent.add(other)
+        else:
+            self.received.add(other)
+
+    def drop(self, other: str):
+        self.friends.discard(other)
+        self.sent.discard(other)
+        self.received.discard(other)
+        self.ordered = None
+
+    def status_with(self, other: str) -> Optional[str]:
+        if other in self.friends:
+            return "accepted"
+        if other in self.sent or other in self.received:
+            return "pending"
+        return None
+
+    def sorted_friends(self) -> List[str]:
+        # Friend ids in cursor order, rebuilt only after the set changes
+        if self.ordered is None:
+            self.ordered = sorted(self.friends)
+        return self.ordered
+
+class FriendGraph:
+    """LRU of FriendEdges per user, reloaded after FRIEND_CACHE_TTL_SECONDS."""
+
+    def __init__(self, max_users: int = FRIEND_CACHE_MAX_USERS):
+        self.max_users = max_users
+        self.entries: "OrderedDict[str, FriendEdges]" = OrderedDict()
+        self.loading: Dict[str, asyncio.Future] = {}
+        # Bumped by every change; a load that overlapped one may have missed it and is not cached
+        self.generation = 0
+
+    def _fresh(self, user_id: str) -> Optional[FriendEdges]:
+        entry = self.entries.get(user_id)
+        if entry is not None and time.monotonic() - entry.loaded_at < FRIEND_CACHE_TTL_SECONDS:
+            self.entries.move_to_end(user_id)
+            return entry
+        return None
+
+    def _store(self, loaded: Dict[str, FriendEdges], generation: int):
+        if generation != self.generation:
+            return
+        for user_id, entry in loaded.items():
+            self.entries[user_id] = entry
+            self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_users:
+            self.entries.popitem(last=False)
+
+    async def _load(self, user_ids: List[str]) -> Dict[str, FriendEdges]:
+        loaded = {user_id: FriendEdges() for user_id in user_ids}
+        cursor = db.friends.find(
+            {"$or": [{"user_id": {"$in": user_ids}}, {"friend_id": {"$in": user_ids}}]},
+            FRIEND_EDGE_FIELDS
+        ).batch_size(5000)
+        async for edge in cursor:
+            for user_id in (edge["user_id"], edge["friend_id"]):
+                if user_id in loaded:
+                    loaded[user_id].add(user_id, edge)
+        return loaded
+
+    async def get(self, user_id: str) -> FriendEdges:
+        entry = self._fresh(user_id)
+        if entry is not None:
+            return entry
+        pending = self.loading.get(user_id)
+        if pending is not None:
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # The loading caller was cancelled; load it here instead
+                return await self.get(user_id)
+        future = asyncio.get_running_loop().create_future()
+        self.loading[user_id] = future
+        generation = self.generation
+        try:
+            entry = (await self._load([user_id]))[user_id]
+            future.set_result(entry)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self.loading[user_id]
+            if not future.done():
+                future.cancel()
+        self._store({user_id: entry}, generation)
+        return entry
+
+    async def get_many(self, user_ids: List[str]) -> Dict[str, FriendEdges]:
+        """Edges for many users, loading every miss in one query."""
+        found = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            entry = self._fresh(user_id)
+            if entry is not None:
+                found[user_id] = entry
+            else:
+                missing.append(user_id)
+        if missing:
+            generation = self.generation
+            loaded = await self._load(missing)
+            self._store(loaded, generation)
+            found.update(loaded)
+        return found
+
+    async def friends_of(self, user_id: str) -> set:
+        return (await self.get(user_id)).friends
+
+    async def are_friends(self, user_id: str, other: str) -> bool:
+        return other in (await self.get(user_id)).friends
+
+    def _touch(self, user_id: str) -> Optional[FriendEdges]:
+        self.generation += 1
+        return self.entries.get(user_id)
+
+    def requested(self, from_user: str, to_user: str):
+        sender, recipient = self._touch(from_user), self._touch(to_user)
+        if sender is not None:
+            sender.sent.add(to_user)
+        if recipient is not None:
+            recipient.received.add(from_user)
+
+    def accepted(self, from_user: str, to_user: str):
+        for user_id, other in ((from_user, to_user), (to_user, from_user)):
+            entry = self._touch(user_id)
+            if entry is not None:
+                entry.drop(other)
+                entry.friends.add(other)
+
+    def removed(self, user_id: str, other: str):
+        for a, b in ((user_id, other), (other, user_id)):
+            entry = self._touch(a)
+            if entry is not None:
+                entry.drop(b)
+
+    def forget(self, user_id: str):
+        """Drop a deleted account from the graph, including its neighbours' entries."""
+        self._touch(user_id)
+        self.entries.pop(user_id, None)
+        for other, entry in self.entries.items():
+            if user_id in entry.friends or user_id in entry.sent or user_id in entry.received:
+                self._touch(other)
+                entry.drop(user_id)
+
+friend_graph = FriendGraph()
+
+class ProfileCache:
+    """Public profile fields by user id, for endpoints that list many users.
+
+    Entries expire after PROFILE_CACHE_TTL_SECONDS and are dropped whenever
+    this process changes the profile or the user's online status.
+    """
+
+    def __init__(self, max_users: int = PROFILE_CACHE_MAX_USERS):
+        self.max_users = max_users
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.projection = build_projection(FriendSummary)
+
+    async def get_many(self, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        found = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            entry = self.entries.get(user_id)
+            if entry is not None and now - entry[0] < PROFILE_CACHE_TTL_SECONDS:
+                self.entries.move_to_end(user_id)
+                found[user_id] = entry[1]
+            else:
+                missing.append(user_id)
+        if missing:
+            cursor = db.users.find({"id": {"$in": missing}, "deleted": {"$ne": True}}, self.projection)
+            async for profile in cursor:
+                found[profile["id"]] = profile
+                self.entries[profile["id"]] = (now, profile)
+                self.entries.move_to_end(profile["id"])
+            while len(self.entries) > self.max_users:
+                self.entries.popitem(last=False)
+        return found
+
+    def invalidate(self, user_id: str):
+        self.entries.pop(user_id, None)
+
+profile_cache = ProfileCache()
+
+async def presence_view(users: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Privacy-correct presence for a page of user rows, without touching the rows given.
+
+    Connections to this process are ground truth for "online"; users who
+    turned off last_seen_online show neither status nor last seen. Privacy
+    flags for the whole page come from one cached bulk lookup.
+    """
+    settings = await privacy.get_settings([user["id"] for user in users])
+    connected = manager.active_connections
+    view = []
+    for user in users:
+        if not settings[user["id"]]["last_seen_online"]:
+            user = {**user, "status": None, "last_seen": None}
+        elif user["id"] in connected and user.get("status") != "online":
+            user = {**user, "status": "online"}
+        view.append(user)
+    return view
+
+@app.on_event("startup")
+async def create_friend_indexes():
+    await db.friends.create_index([("user_id", 1), ("friend_id", 1)])
+    await db.friends.create_index([("friend_id", 1), ("user_id", 1)])
+
+# User search endpoint
+@app.get("/api/users/search", dependencies=[rate_limit("search")])
 async def search_users(q: str, current_user: str = Depends(get_current_user)):
     if len(q) < 2:
         return []
@@ -502,6 +2352,7 @@ async def search_users(q: str, current_user: str = Depends(get_current_user)):
     users = await db.users.find({
         "$and": [
             {"id": {"$ne": current_user}},  # Exclude current user
+            {"deleted": {"$ne": True}},
             {
                 "$or": [
                     {"username": {"$regex": q, "$options": "i"}},
@@ -509,181 +2360,656 @@ async def search_users(q: str, current_user: str = Depends(get_current_user)):
                 ]
             }
         ]
-    }, {
-        "password_hash": 0  # Exclude password hash
-    }).limit(10).to_list(10)
+    }, USER_PUBLIC).limit(10).to_list(10)
     
     # Convert MongoDB documents to proper format
+    edges = await friend_graph.get(current_user)
     search_results = []
-    for user in users:
-        # Check if already friends
-        existing_friendship = await db.friends.find_one({
-            "$or": [
-                {"user_id": current_user, "friend_id": user["id"]},
-                {"user_id": user["id"], "friend_id": current_user}
-            ]
-        })
-        
+    for user in await presence_view(users):
+        friend_status = edges.status_with(user["id"])
         search_results.append({
             **user,
-            "_id": str(user["_id"]) if "_id" in user else None,
             "mutual_friends": 0,  # Could calculate this later
-            "is_friend": existing_friendship is not None,
-            "friend_status": existing_friendship["status"] if existing_friendship else None
+            "is_friend": friend_status is not None,
+            "friend_status": friend_status
         })
     
     return search_results
 
 # Friend suggestions endpoint
-@app.get("/api/friends/suggestions")
+@app.get("/api/friends/suggestions", dependencies=[rate_limit("suggestions")])
 async def get_friend_suggestions(current_user: str = Depends(get_current_user)):
-    # Get current user's friends
-    current_friends = await db.friends.find({
-        "$or": [
-            {"user_id": current_user, "status": "accepted"},
-            {"friend_id": current_user, "status": "accepted"}
-        ]
-    }).to_list(100)
-    
-    friend_ids = set()
-    for friendship in current_friends:
-        if friendship["user_id"] == current_user:
-            friend_ids.add(friendship["friend_id"])
-        else:
-            friend_ids.add(friendship["user_id"])
+    edges = await friend_graph.get(current_user)
     
     # Find users who are not already friends
     all_users = await db.users.find({
-        "id": {"$ne": current_user}
-    }, {
-        "password_hash": 0
-    }).to_list(100)
+        "id": {"$ne": current_user},
+        "deleted": {"$ne": True}
+    }, USER_PUBLIC).to_list(100)
+    
+    # Skip friends and pending requests in either direction
+    candidates = [user for user in all_users if edges.status_with(user["id"]) is None]
+    # One query for every candidate's edges not already cached
+    candidate_edges = await friend_graph.get_many([user["id"] for user in candidates])
     
     suggestions = []
-    for user in all_users:
-        if user["id"] not in friend_ids:
-            # Check if there's a pending friend request
-            pending_request = await db.friends.find_one({
-                "$or": [
-                    {"user_id": current_user, "friend_id": user["id"], "status": "pending"},
-                    {"user_id": user["id"], "friend_id": current_user, "status": "pending"}
-                ]
-            })
-            
-            if not pending_request:
-                # Calculate mutual friends
-                user_friends = await db.friends.find({
-                    "$or": [
-                        {"user_id": user["id"], "status": "accepted"},
-                        {"friend_id": user["id"], "status": "accepted"}
-                    ]
-                }).to_list(100)
-                
-                user_friend_ids = set()
-                for friendship in user_friends:
-                    if friendship["user_id"] == user["id"]:
-                        user_friend_ids.add(friendship["friend_id"])
-                    else:
-                        user_friend_ids.add(friendship["user_id"])
-                
-                mutual_friends = len(friend_ids.intersection(user_friend_ids))
-                
-                suggestions.append({
-                    **user,
-                    "_id": str(user["_id"]) if "_id" in user else None,
-                    "mutual_friends": mutual_friends,
-                    "status": "online" if user.get("status") == "online" else "offline",
-                    "suggestion_reason": "mutual_friends" if mutual_friends > 0 else "new_user"
-                })
+    for user in candidates:
+        mutual_friends = len(edges.friends & candidate_edges[user["id"]].friends)
+        
+        suggestions.append({
+            **user,
+            "mutual_friends": mutual_friends,
+            "status": "online" if user.get("status") == "online" else "offline",
+            "suggestion_reason": "mutual_friends" if mutual_friends > 0 else "new_user"
+        })
     
     # Sort by mutual friends count (descending) and take top 10
     suggestions.sort(key=lambda x: x["mutual_friends"], reverse=True)
-    return suggestions[:10]
+    return await presence_view(suggestions[:10])
+
+# Message retention and archive
+MESSAGE_RETENTION_DAYS = float(os.environ.get('MESSAGE_RETENTION_DAYS', '90'))
+MESSAGE_ARCHIVE_SEGMENT_SIZE = int(os.environ.get('MESSAGE_ARCHIVE_SEGMENT_SIZE', '500'))
+MESSAGE_ARCHIVE_INTERVAL_SECONDS = float(os.environ.get('MESSAGE_ARCHIVE_INTERVAL_SECONDS', '3600'))
+MESSAGE_ARCHIVE_PAUSE_SECONDS = float(os.environ.get('MESSAGE_ARCHIVE_PAUSE_SECONDS', '0.2'))
+MESSAGE_ARCHIVE_MAX_SEGMENTS_PER_RUN = int(os.environ.get('MESSAGE_ARCHIVE_MAX_SEGMENTS_PER_RUN', '200'))
+
+def to_naive_utc(value: datetime) -> datetime:
+    # Mongo hands back naive UTC datetimes; compare like with like
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+# History is totally ordered by (timestamp, id); a page cursor is the pair
+# taken from the oldest message already shown. Timestamps alone tie within
+# the same millisecond.
+def history_key(message: dict):
+    return (message["timestamp"], message["id"])
+
+def precedes(message: dict, before: Optional[datetime], before_id: Optional[str]) -> bool:
+    if before is None:
+        return True
+    return history_key(message) < (before, before_id or "")
+
+def encode_segment(messages: List[dict]) -> bytes:
+    return zlib.compress(bson.encode({"messages": messages}), 6)
+
+def decode_segment(data: bytes) -> List[dict]:
+    return bson.decode(zlib.decompress(data))["messages"]
+
+class MessageArchiver:
+    """Moves messages past the retention age into compressed per-chat segments.
+
+    Each segment in db.message_archive holds consecutive messages of one chat
+    (a run of flat messages or one whole bucket) as zlib-compressed BSON, so
+    the hot collections and their indexes only carry recent traffic. Segment
+    ids are deterministic and written before the hot copies are deleted,
+    making a re-run after a crash between the two idempotent.
+    """
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+
+    async def write_segment(self, segment_id: str, chat_id: str, messages: List[dict]):
+        await db.message_archive.update_one(
+            {"id": segment_id},
+            {"$set": {
+                "id": segment_id,
+                "chat_id": chat_id,
+                "start_ts": messages[0]["timestamp"],
+                "end_ts": messages[-1]["timestamp"],
+                "count": len(messages),
+                "senders": sorted({message["sender_id"] for message in messages}),
+                "codec": "zlib+bson",
+                "data": encode_segment(messages),
+                "archived_at": datetime.utcnow(),
+            }},
+            upsert=True
+        )
+
+    async def run_once(self) -> int:
+        if MESSAGE_RETENTION_DAYS <= 0:
+            return 0
+        cutoff = datetime.utcnow() - timedelta(days=MESSAGE_RETENTION_DAYS)
+        archived = segments = 0
+        while segments < MESSAGE_ARCHIVE_MAX_SEGMENTS_PER_RUN:
+            moved = await message_store.archive_next(cutoff)
+            if not moved:
+                break
+            archived += moved
+            segments += 1
+            await asyncio.sleep(MESSAGE_ARCHIVE_PAUSE_SECONDS)
+        if archived:
+            logging.info(f"Archived {archived} messages into {segments} segments")
+        return archived
+
+    async def read(self, chat_id: str, before: Optional[datetime], before_id: Optional[str],
+                   limit: int) -> List[dict]:
+        """Newest-first archived messages of a chat preceding the cursor."""
+        query: Dict[str, Any] = {"chat_id": chat_id}
+        if before is not None:
+            query["start_ts"] = {"$lte": before}
+        results: List[dict] = []
+        cursor = db.message_archive.find(query, {"_id": 0, "data": 1}).sort("end_ts", -1)
+        async for segment in cursor:
+            page = [m for m in decode_segment(segment["data"]) if precedes(m, before, before_id)]
+            page.sort(key=history_key, reverse=True)
+            results.extend(page)
+            if len(results) >= limit:
+                break
+        return results[:limit]
+
+    async def remove_sender(self, segment_ids: List[Any], user_id: str):
+        """Rewrite segments without a deleted user's messages."""
+        async for segment in db.message_archive.find({"_id": {"$in": segment_ids}}):
+            remaining = [m for m in decode_segment(segment["data"]) if m["sender_id"] != user_id]
+            if not remaining:
+                await db.message_archive.delete_one({"_id": segment["_id"]})
+                continue
+            await db.message_archive.update_one({"_id": segment["_id"]}, {"$set": {
+                "start_ts": remaining[0]["timestamp"],
+                "end_ts": remaining[-1]["timestamp"],
+                "count": len(remaining),
+                "senders": sorted({m["sender_id"] for m in remaining}),
+                "data": encode_segment(remaining),
+            }})
+
+    async def run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Message archiving failed: {e}")
+            await asyncio.sleep(MESSAGE_ARCHIVE_INTERVAL_SECONDS)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+message_archiver = MessageArchiver()
+
+# Message storage
+MESSAGE_STORAGE = os.environ.get('MESSAGE_STORAGE', 'flat')  # flat, bucketed
+MESSAGE_BUCKET_SIZE = int(os.environ.get('MESSAGE_BUCKET_SIZE', '200'))
+
+class FlatMessageStore:
+    """One document per message in db.messages."""
+
+    async def append(self, message: dict):
+        await db.messages.insert_one({**message})
+
+    async def recent(self, chat_id: str, before: Optional[datetime], before_id: Optional[str],
+                     limit: int) -> List[dict]:
+        """Newest-first messages of a chat preceding the (before, before_id) cursor."""
+        query: Dict[str, Any] = {"chat_id": chat_id}
+        if before is not None:
+            query["$or"] = [
+                {"timestamp": {"$lt": before}},
+                {"timestamp": before, "id": {"$lt": before_id or ""}},
+            ]
+        return await db.messages.find(query, NO_ID).sort(
+            [("timestamp", -1), ("id", -1)]
+        ).limit(limit).to_list(limit)
+
+    async def contains(self, chat_id: str, message_id: str) -> bool:
+        return await db.messages.find_one({"chat_id": chat_id, "id": message_id}, {"_id": 1}) is not None
+
+    async def archive_next(self, cutoff: datetime) -> int:
+        # Oldest expired message first, so chats are drained oldest-first
+        oldest = await db.messages.find_one(
+            {"timestamp": {"$lt": cutoff}}, {"_id": 0, "chat_id": 1}, sort=[("timestamp", 1)]
+        )
+        if not oldest:
+            return 0
+        chat_id = oldest["chat_id"]
+        messages = await db.messages.find(
+            {"chat_id": chat_id, "timestamp": {"$lt": cutoff}}, NO_ID
+        ).sort("timestamp", 1).limit(MESSAGE_ARCHIVE_SEGMENT_SIZE).to_list(MESSAGE_ARCHIVE_SEGMENT_SIZE)
+        await message_archiver.write_segment(f"{chat_id}:{messages[0]['id']}", chat_id, messages)
+        await db.messages.delete_many({"id": {"$in": [message["id"] for message in messages]}})
+        return len(messages)
+
+class BucketedMessageStore:
+    """Groups a chat's messages into bucket documents in db.message_buckets.
+
+    Appends $push into the chat's open bucket until it holds
+    MESSAGE_BUCKET_SIZE messages, after which it is sealed and the upsert opens
+    a new one, so a page of history is one or two document reads. A unique
+    index allows one open bucket per chat, so concurrent appends never open
+    two. ``count`` tracks appends (not current length), so a bucket never
+    reopens after messages are purged from it. Until a chat is marked
+    messages_bucketed, reads also consult db.messages so history stays
+    complete while migrate_from_flat() is still moving it over.
+    """
+
+    def __init__(self):
+        self.bucketed_chats: set = set()  # chats known to have no flat messages; the flag never reverts
+
+    async def append(self, message: dict):
+        update = {
+            "$push": {"messages": message},
+            "$inc": {"count": 1},
+            "$min": {"start_ts": message["timestamp"]},
+            "$max": {"end_ts": message["timestamp"]},
+            "$addToSet": {"senders": message["sender_id"]},
+            "$setOnInsert": {"id": str(uuid.uuid4()), "open": True},
+        }
+        while True:
+            try:
+                previous = await db.message_buckets.find_one_and_update(
+                    {"chat_id": message["chat_id"], "open": True, "count": {"$lt": MESSAGE_BUCKET_SIZE}},
+                    update, projection={"_id": 0, "id": 1, "count": 1}, upsert=True
+                )
+            except DuplicateKeyError:
+                # The open bucket is full but not sealed yet (a racing append,
+                # or a crash in between): seal it and append again
+                await db.message_buckets.update_many(
+                    {"chat_id": message["chat_id"], "open": True, "count": {"$gte": MESSAGE_BUCKET_SIZE}},
+                    {"$set": {"open": False}}
+                )
+                continue
+            if previous is not None and previous["count"] + 1 >= MESSAGE_BUCKET_SIZE:
+                await db.message_buckets.update_one({"id": previous["id"]}, {"$set": {"open": False}})
+            return
+
+    async def is_migrated(self, chat_id: str) -> bool:
+        if chat_id in self.bucketed_chats:
+            return True
+        if await db.chats.find_one({"id": chat_id, "messages_bucketed": True}, {"_id": 1}):
+            self.bucketed_chats.add(chat_id)
+            return True
+        return False
+
+    async def contains(self, chat_id: str, message_id: str) -> bool:
+        if await db.message_buckets.find_one({"chat_id": chat_id, "messages.id": message_id}, {"_id": 1}):
+            return True
+        return not await self.is_migrated(chat_id) and await flat_messages.contains(chat_id, message_id)
+
+    async def recent(self, chat_id: str, before: Optional[datetime], before_id: Optional[str],
+                     limit: int) -> List[dict]:
+        query: Dict[str, Any] = {"chat_id": chat_id}
+        if before is not None:
+            query["start_ts"] = {"$lte": before}
+        results: List[dict] = []
+        cursor = db.message_buckets.find(query, {"_id": 0, "end_ts": 1, "messages": 1}).sort("end_ts", -1).batch_size(2)
+        async for bucket in cursor:
+            if len(results) >= limit:
+                results.sort(key=history_key, reverse=True)
+                del results[limit:]
+                # Migrated buckets can overlap the live one in time, so stop only
+                # at a bucket that ends before the oldest message kept so far
+                if bucket["end_ts"] < results[-1]["timestamp"]:
+                    break
+            results.extend(m for m in bucket["messages"] if precedes(m, before, before_id))
+        if not await self.is_migrated(chat_id):
+            results += await flat_messages.recent(chat_id, before, before_id, limit)
+        results.sort(key=history_key, reverse=True)
+        return results[:limit]
+
+    async def archive_next(self, cutoff: datetime) -> int:
+        bucket = await db.message_buckets.find_one(
+            {"end_ts": {"$lt": cutoff}}, {"_id": 0, "id": 1, "chat_id": 1, "messages": 1}, sort=[("end_ts", 1)]
+        )
+        if not bucket:
+            # Leftovers from before a migration still age out of the flat collection
+            return await flat_messages.archive_next(cutoff)
+        if bucket["messages"]:
+            await message_archiver.write_segment(bucket["id"], bucket["chat_id"], bucket["messages"])
+        await db.message_buckets.delete_one({"id": bucket["id"]})
+        return max(1, len(bucket["messages"]))
+
+    async def migrate_from_flat(self, chat_id: Optional[str] = None, pause: float = 0.05) -> int:
+        """Move flat db.messages into sealed buckets, chat by chat, resumably.
+
+        Bucket ids derive from their first message and are upserted before the
+        flat copies are deleted, so re-running after an interruption is safe.
+        Once no flat messages are left, the chats are marked messages_bucketed
+        and reads stop consulting db.messages for them.
+        """
+        migrated = 0
+        while True:
+            query = {"chat_id": chat_id} if chat_id else {}
+            next_message = await db.messages.find_one(query, {"_id": 0, "chat_id": 1})
+            if not next_message:
+                await db.chats.update_many(
+                    {**({"id": chat_id} if chat_id else {}), "messages_bucketed": {"$ne": True}},
+                    {"$set": {"messages_bucketed": True}}
+                )
+                return migrated
+            current_chat = next_message["chat_id"]
+            while True:
+                messages = await db.messages.find(
+                    {"chat_id": current_chat}, NO_ID
+                ).sort("timestamp", 1).limit(MESSAGE_BUCKET_SIZE).to_list(MESSAGE_BUCKET_SIZE)
+                if not messages:
+                    break
+                bucket_id = f"{current_chat}:{messages[0]['id']}"
+                await db.message_buckets.update_one(
+                    {"id": bucket_id},
+                    {"$set": {
+                        "id": bucket_id,
+                        "chat_id": current_chat,
+                        # Sealed: live appends must not extend a historical bucket's time range
+                        "open": False,
+                        "count": MESSAGE_BUCKET_SIZE,
+                        "start_ts": messages[0]["timestamp"],
+                        "end_ts": messages[-1]["timestamp"],
+                        "senders": sorted({m["sender_id"] for m in messages}),
+                        "messages": messages,
+                    }},
+                    upsert=True
+                )
+                await db.messages.delete_many({"id": {"$in": [m["id"] for m in messages]}})
+                migrated += len(messages)
+                await asyncio.sleep(pause)
+
+    async def remove_sender(self, bucket_ids: List[Any], user_id: str):
+        await db.message_buckets.update_many(
+            {"_id": {"$in": bucket_ids}},
+            {"$pull": {"messages": {"sender_id": user_id}, "senders": user_id}}
+        )
+        await db.message_buckets.delete_many({"_id": {"$in": bucket_ids}, "messages": {"$size": 0}})
+
+flat_messages = FlatMessageStore()
+bucketed_messages = BucketedMessageStore()
+message_store = bucketed_messages if MESSAGE_STORAGE == "bucketed" else flat_messages
+
+async def load_chat_history(chat_id: str, before: Optional[datetime], before_id: Optional[str],
+                            limit: int) -> List[dict]:
+    """Newest ``limit`` messages preceding the cursor, oldest first, falling through to the archive."""
+    messages = await message_store.recent(chat_id, before, before_id, limit)
+    if len(messages) < limit:
+        # Archived messages are all older than anything still hot
+        if messages:
+            before, before_id = history_key(messages[-1])
+        messages += await message_archiver.read(chat_id, before, before_id, limit - len(messages))
+    messages.reverse()
+    return messages
+
+@app.on_event("startup")
+async def start_message_archiver():
+    await db.messages.create_index([("chat_id", 1), ("timestamp", -1), ("id", -1)])
+    await db.messages.create_index("timestamp")
+    await db.message_archive.create_index("id", unique=True)
+    await db.message_archive.create_index([("chat_id", 1), ("end_ts", -1)])
+    await db.message_archive.create_index("senders")
+    await db.message_buckets.create_index("id", unique=True)
+    # Buckets from before the open flag are sealed; their chats start a fresh one
+    await db.message_buckets.update_many({"open": {"$exists": False}}, {"$set": {"open": False}})
+    await db.message_buckets.create_index(
+        [("chat_id", 1), ("open", 1)], unique=True, partialFilterExpression={"open": True}
+    )
+    await db.message_buckets.create_index([("chat_id", 1), ("end_ts", -1)])
+    await db.message_buckets.create_index("end_ts")
+    await db.message_buckets.create_index("senders")
+    message_archiver.start()
+
+@app.on_event("shutdown")
+async def stop_message_archiver():
+    await message_archiver.stop()
+
+# Idempotent sends
+# Clients tag chat_message frames with a client_message_id and resend until
+# acknowledged. The first copy is stored and fanned out; a resend is only
+# answered with an ack for the stored message. Recent ids are answered from
+# memory, older ones through the unique index on db.message_receipts. A
+# receipt is claimed before the append and confirmed after it; a claim left
+# unconfirmed past its lease (the sender crashed or was cancelled) is settled
+# by the next resend, which acks the message if it was stored or stores it.
+CLIENT_MESSAGE_ID_MAX_LENGTH = 64
+MESSAGE_RECEIPT_TTL_HOURS = float(os.environ.get('MESSAGE_RECEIPT_TTL_HOURS', '72'))
+MESSAGE_CLAIM_LEASE_SECONDS = float(os.environ.get('MESSAGE_CLAIM_LEASE_SECONDS', '30'))
+SEEN_MESSAGE_TTL_SECONDS = float(os.environ.get('SEEN_MESSAGE_TTL_SECONDS', '600'))
+SEEN_MESSAGE_MAX_ENTRIES = 50_000
+
+class MessageReceipts:
+    """Maps (sender, client_message_id) to the message it created."""
+
+    def __init__(self):
+        self.seen: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (receipt, expires_at)
+
+    def recall(self, sender_id: str, client_message_id: str) -> Optional[dict]:
+        key = (sender_id, client_message_id)
+        entry = self.seen.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            del self.seen[key]
+            return None
+        return entry[0]
+
+    def remember(self, receipt: dict):
+        key = (receipt["sender_id"], receipt["client_message_id"])
+        self.seen[key] = (receipt, time.monotonic() + SEEN_MESSAGE_TTL_SECONDS)
+        self.seen.move_to_end(key)
+        while len(self.seen) > SEEN_MESSAGE_MAX_ENTRIES:
+            self.seen.popitem(last=False)
+
+    async def claim(self, message: Message) -> Optional[dict]:
+        """Claim the client id of ``message`` for storing it.
+
+        Returns None when the caller should store ``message`` and then call
+        confirm(). Otherwise returns the earlier receipt: acknowledge it if
+        ``claimed_until`` is absent, or drop the resend while another send of
+        the same id is still in flight.
+        """
+        key = {"sender_id": message.sender_id, "client_message_id": message.client_message_id}
+        now = datetime.utcnow()
+        lease = {"claimed_until": now + timedelta(seconds=MESSAGE_CLAIM_LEASE_SECONDS), "created_at": now}
+        try:
+            await db.message_receipts.insert_one({**message_receipt(message), **lease})
+            return None
+        except DuplicateKeyError:
+            original = await db.message_receipts.find_one(key, NO_ID)
+        if original is None:
+            # Expired between the insert and the read; the id is free again
+            return await self.claim(message)
+        if "claimed_until" not in original:
+            self.remember(original)
+            return original
+        if original["claimed_until"] > now:
+            return original
+        # The claim's sender gave up: settle it from whether its message was stored
+        if await message_store.contains(original["chat_id"], original["message_id"]):
+            await db.message_receipts.update_one({**key, "message_id": original["message_id"]},
+                                                 {"$unset": {"claimed_until": ""}})
+            del original["claimed_until"]
+            self.remember(original)
+            return original
+        taken = await db.message_receipts.update_one(
+            {**key, "message_id": original["message_id"], "claimed_until": original["claimed_until"]},
+            {"$set": {**message_receipt(message), **lease}}
+        )
+        return None if taken.modified_count else {**original, "claimed_until": lease["claimed_until"]}
+
+    async def confirm(self, message: Message):
+        """Mark the claim of ``message`` fulfilled after the message was stored."""
+        receipt = message_receipt(message)
+        await db.message_receipts.update_one(
+            {"sender_id": message.sender_id, "client_message_id": message.client_message_id,
+             "message_id": message.id},
+            {"$unset": {"claimed_until": ""}}
+        )
+        self.remember(receipt)
+
+    async def release(self, message: Message):
+        # The append failed, though it may have been applied; end the lease so
+        # the client's retry settles the claim instead of waiting it out
+        await db.message_receipts.update_one(
+            {"sender_id": message.sender_id, "client_message_id": message.client_message_id,
+             "message_id": message.id},
+            {"$set": {"claimed_until": datetime.utcnow()}}
+        )
+
+message_receipts = MessageReceipts()
+
+def message_receipt(message: Message) -> dict:
+    return {
+        "sender_id": message.sender_id,
+        "client_message_id": message.client_message_id,
+        "message_id": message.id,
+        "chat_id": message.chat_id,
+        "timestamp": message.timestamp,
+    }
+
+def message_ack(receipt: dict, duplicate: bool) -> dict:
+    return {
+        "type": "message_ack",
+        "client_message_id": receipt["client_message_id"],
+        "message_id": receipt["message_id"],
+        "chat_id": receipt["chat_id"],
+        "timestamp": receipt["timestamp"],
+        "duplicate": duplicate,
+    }
+
+@app.on_event("startup")
+async def create_message_receipt_indexes():
+    await db.message_receipts.create_index([("sender_id", 1), ("client_message_id", 1)], unique=True)
+    await db.message_receipts.create_index("created_at", expireAfterSeconds=int(MESSAGE_RECEIPT_TTL_HOURS * 3600))
 
 # Chat endpoints
 @app.get("/api/chats")
 async def get_user_chats(current_user: str = Depends(get_current_user)):
-    chats = await db.chats.find({"participants": current_user}).to_list(100)
-    
-    # Convert MongoDB documents to proper format
-    return [
-        {
-            **chat,
-            "_id": str(chat["_id"]) if "_id" in chat else None
-        } for chat in chats
-    ]
+    group_ids = await db.chat_members.distinct("chat_id", {"user_id": current_user})
+    return await db.chats.find(
+        {"$or": [{"participants": current_user}, {"id": {"$in": group_ids}}]}, NO_ID
+    ).sort("last_activity", -1).to_list(100)
 
 @app.post("/api/chats")
 async def create_chat(chat_data: dict, current_user: str = Depends(get_current_user)):
+    chat_type = chat_data.get("chat_type", "private")
+    if chat_type not in CHAT_TYPES:
+        raise HTTPException(status_code=400, detail="Unknown chat type")
+    participants = chat_data.get("participants", [current_user])
     chat = Chat(
         name=chat_data.get("name", "New Chat"),
-        chat_type=chat_data.get("chat_type", "private"),
-        participants=chat_data.get("participants", [current_user]),
-        created_by=current_user
+        chat_type=chat_type,
+        participants=participants if chat_type == "private" else [],
+        created_by=current_user,
+        messages_bucketed=MESSAGE_STORAGE == "bucketed"
     )
     
     await db.chats.insert_one(chat.dict())
+    if chat_type != "private":
+        await add_chat_members(chat.id, [current_user], role="owner")
+        await add_chat_members(chat.id, [uid for uid in participants if uid != current_user])
+        chat.member_count = (await db.chats.find_one({"id": chat.id}, {"_id": 0, "member_count": 1}))["member_count"]
     return chat.dict()
 
+async def get_group_audience(chat_id: str, current_user: str, admin: bool = False) -> ChatAudience:
+    audience = await chat_audiences.get(chat_id)
+    if audience is None or current_user not in audience.members:
+        raise HTTPException(status_code=403, detail="Access denied")
+    if audience.chat_type == "private":
+        raise HTTPException(status_code=400, detail="Private chats have no member list")
+    if admin and current_user not in audience.admins:
+        raise HTTPException(status_code=403, detail="Only admins can manage members")
+    return audience
+
+@app.get("/api/chats/{chat_id}/members")
+async def get_chat_members(chat_id: str, after: Optional[str] = None, limit: int = 100,
+                           current_user: str = Depends(get_current_user)):
+    await get_group_audience(chat_id, current_user)
+    # Keyset pagination over the (chat_id, user_id) index: pass the last user_id as ?after=
+    query: Dict[str, Any] = {"chat_id": chat_id}
+    if after:
+        query["user_id"] = {"$gt": after}
+    limit = max(1, min(limit, 500))
+    members = await db.chat_members.find(query, NO_ID).sort("user_id", 1).limit(limit).to_list(limit)
+    profiles = await db.users.find(
+        {"id": {"$in": [m["user_id"] for m in members]}},
+        {"_id": 0, "id": 1, "display_name": 1, "avatar_url": 1}
+    ).to_list(limit)
+    by_id = {p["id"]: p for p in profiles}
+    return [{**m, **by_id.get(m["user_id"], {})} for m in members]
+
+@app.post("/api/chats/{chat_id}/members")
+async def add_members(chat_id: str, data: AddChatMembers, current_user: str = Depends(get_current_user)):
+    audience = await get_group_audience(chat_id, current_user)
+    # Anyone may add to a group; channels are curated by their admins
+    if audience.chat_type == "channel" and current_user not in audience.admins:
+        raise HTTPException(status_code=403, detail="Only admins can manage members")
+    added = await add_chat_members(chat_id, data.user_ids)
+    return {"message": "Members added", "added": added}
+
+@app.put("/api/chats/{chat_id}/members/{user_id}")
+async def update_member(chat_id: str, user_id: str, data: UpdateChatMember,
+                        current_user: str = Depends(get_current_user)):
+    await get_group_audience(chat_id, current_user, admin=True)
+    if data.role not in ("admin", "member"):
+        raise HTTPException(status_code=400, detail="Role must be admin or member")
+    result = await db.chat_members.update_one(
+        {"chat_id": chat_id, "user_id": user_id, "role": {"$ne": "owner"}}, {"$set": {"role": data.role}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Member not found")
+    chat_audiences.invalidate(chat_id)
+    return {"message": "Member updated"}
+
+@app.delete("/api/chats/{chat_id}/members/{user_id}")
+async def remove_member(chat_id: str, user_id: str, current_user: str = Depends(get_current_user)):
+    # Members may leave; removing someone else takes an admin
+    await get_group_audience(chat_id, current_user, admin=user_id != current_user)
+    if not await remove_chat_member(chat_id, user_id):
+        raise HTTPException(status_code=404, detail="Member not found")
+    return {"message": "Member removed"}
+
 @app.get("/api/chats/{chat_id}/messages")
-async def get_chat_messages(chat_id: str, current_user: str = Depends(get_current_user)):
+async def get_chat_messages(chat_id: str, before: Optional[datetime] = None, before_id: Optional[str] = None,
+                            limit: int = 100, current_user: str = Depends(get_current_user)):
     # Verify user is in chat
-    chat = await get_chat_by_id(chat_id)
-    if not chat or current_user not in chat.get("participants", []):
+    audience = await chat_audiences.get(chat_id)
+    if audience is None or current_user not in audience.members:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    messages = await db.messages.find({"chat_id": chat_id}).sort("timestamp", 1).to_list(100)
-    
-    # Convert MongoDB documents to proper format
-    return [
-        {
-            **message,
-            "_id": str(message["_id"]) if "_id" in message else None
-        } for message in messages
-    ]
+    # Page backwards with ?before=<timestamp>&before_id=<id> of the oldest message already shown
+    limit = max(1, min(limit, 200))
+    return await load_chat_history(chat_id, to_naive_utc(before) if before else None, before_id, limit)
 
 # AI endpoints
-@app.post("/api/ai/suggestions")
+@app.post("/api/ai/suggestions", dependencies=[rate_limit("ai")])
 async def get_message_suggestions(data: dict, current_user: str = Depends(get_current_user)):
     message = data.get("message", "")
     context = data.get("context", "")
-    suggestions = await get_ai_suggestions(message, context)
+    suggestions = await get_ai_suggestions(message, context, user_id=current_user)
     return {"suggestions": suggestions}
 
-@app.post("/api/ai/translate")
+@app.post("/api/ai/translate", dependencies=[rate_limit("ai")])
 async def translate_text(data: dict, current_user: str = Depends(get_current_user)):
     message = data.get("message", "")
     target_language = data.get("target_language", "en")
-    translation = await translate_message(message, target_language)
+    translation = await translate_message(message, target_language, user_id=current_user)
     return {"translation": translation}
 
+@app.get("/api/ai/metrics")
+async def get_ai_metrics(current_user: str = Depends(get_current_user)):
+    return ai_client.snapshot()
+
 # Friends endpoints
-@app.get("/api/friends")
-async def get_friends(current_user: str = Depends(get_current_user)):
-    friends = await db.friends.find(
-        {"$or": [{"user_id": current_user}, {"friend_id": current_user}], "status": "accepted"}
-    ).to_list(100)
-    
-    friend_ids = []
-    for friend in friends:
-        if friend["user_id"] == current_user:
-            friend_ids.append(friend["friend_id"])
-        else:
-            friend_ids.append(friend["user_id"])
+@app.get("/api/friends", response_model=List[FriendSummary], response_model_exclude_unset=True)
+async def get_friends(fields: Optional[str] = None, after: Optional[str] = None, limit: int = 500,
+                      current_user: str = Depends(get_current_user)):
+    # Keyset pagination over friend ids: pass the last id as ?after=
+    friend_ids = (await friend_graph.get(current_user)).sorted_friends()
+    start = bisect.bisect_right(friend_ids, after) if after else 0
+    page = friend_ids[start:start + max(1, min(limit, 1000))]
     
     # Get friend details
-    friends_data = await db.users.find(
-        {"id": {"$in": friend_ids}},
-        {"password_hash": 0}
-    ).to_list(100)
-    
-    # Convert MongoDB documents to proper format
-    return [
-        {
-            **friend,
-            "_id": str(friend["_id"]) if "_id" in friend else None
-        } for friend in friends_data
-    ]
+    names = [name for name in build_projection(FriendSummary, fields) if name != "_id"]
+    profiles = await profile_cache.get_many(page)
+    friends = await presence_view([profiles[uid] for uid in page if uid in profiles])
+    return [{name: friend[name] for name in names if name in friend} for friend in friends]
 
 @app.post("/api/friends/add")
 async def add_friend(data: dict, current_user: str = Depends(get_current_user)):
@@ -714,6 +3040,7 @@ async def add_friend(data: dict, current_user: str = Depends(get_current_user)):
     )
     
     await db.friends.insert_one(friend_request.dict())
+    friend_graph.requested(current_user, friend_user["id"])
     
     # Get current user details once
     current_user_data = await db.users.find_one({'id': current_user})
@@ -734,21 +3061,22 @@ async def add_friend(data: dict, current_user: str = Depends(get_current_user)):
         }
     }
     
-    await db.notifications.insert_one(notification)
+    # insert_one adds an ObjectId to the dict it is given; keep ours clean for the WebSocket
+    await db.notifications.insert_one({**notification})
     
-    # Send real-time notification via WebSocket
-    notification_for_ws = {
-        **notification,
-        "created_at": notification["created_at"].isoformat(),
-        "_id": str(notification.get("_id", ""))
-    }
+    # Send real-time notification via WebSocket, and to their browser if it is closed
     await manager.send_personal_message(
-        json.dumps({
+        {
             "type": "notification",
-            "notification": notification_for_ws
-        }),
+            "notification": notification
+        },
         friend_user["id"]
     )
+    await outbox.enqueue("push", friend_user["id"], friend_user["id"], {
+        "title": notification["title"],
+        "body": notification["message"],
+        "data": {"type": "friend_request", "notification_id": notification["id"]}
+    })
     
     return {"message": "Friend request sent successfully"}
 
@@ -774,6 +3102,7 @@ async def accept_friend_request(data: dict, current_user: str = Depends(get_curr
         {"_id": friend_request["_id"]},
         {"$set": {"status": "accepted", "accepted_at": datetime.utcnow()}}
     )
+    friend_graph.accepted(from_user_id, current_user)
     
     # Remove the notification
     await db.notifications.delete_many({
@@ -800,6 +3129,7 @@ async def decline_friend_request(data: dict, current_user: str = Depends(get_cur
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Friend request not found")
+    friend_graph.removed(from_user_id, current_user)
     
     # Remove the notification
     await db.notifications.delete_many({
@@ -810,66 +3140,403 @@ async def decline_friend_request(data: dict, current_user: str = Depends(get_cur
     
     return {"message": "Friend request declined successfully"}
 
-# Payment mock endpoints
+@app.delete("/api/friends/{friend_id}")
+async def remove_friend(friend_id: str, current_user: str = Depends(get_current_user)):
+    # Unfriends, or withdraws a request in either direction
+    result = await db.friends.delete_many({
+        "$or": [
+            {"user_id": current_user, "friend_id": friend_id},
+            {"user_id": friend_id, "friend_id": current_user}
+        ]
+    })
+    
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Friend not found")
+    friend_graph.removed(current_user, friend_id)
+    
+    return {"message": "Friend removed successfully"}
+
+# Peer payments and ledger
+# A payment request moves pending -> settling -> completed when the payer
+# accepts it, or to declined / cancelled. Settling posts one transfer to the
+# ledger: an append-only pair of entries, debit for the payer and credit for
+# the requester, that always sums to zero. Each user's balance is a snapshot
+# in db.balances moved by $inc as transfers post, so reading it is one
+# lookup however long the history. The debit is the commit point: it is a
+# single conditional update that refuses to take a balance below the credit
+# limit, so concurrent transfers from one account cannot overdraw it. Every
+# step after it is idempotent on the transfer id, and a settlement
+# interrupted part way is finished by the recovery loop.
+PEER_PAYMENT_MAX = float(os.environ.get('PEER_PAYMENT_MAX', '5000000'))
+PEER_CREDIT_LIMIT = float(os.environ.get('PEER_CREDIT_LIMIT', '1000000'))  # how far below zero a balance may go
+PEER_DESCRIPTION_MAX = 200
+LEDGER_SETTLE_LEASE_SECONDS = float(os.environ.get('LEDGER_SETTLE_LEASE_SECONDS', '30'))
+LEDGER_APPLIED_WINDOW = 500  # recent transfer ids kept on a balance to make posting idempotent
+
+metrics.describe("ledger_transfers_total", "counter", "Peer payment settlements, by outcome")
+
+class InsufficientFunds(Exception):
+    pass
+
+def to_minor(amount: float) -> int:
+    # Balances and entries are kept in integer cents so $inc never drifts
+    return int(round(amount * 100))
+
+def from_minor(value: int) -> float:
+    return value / 100
+
+class Ledger:
+    """Double-entry ledger for peer payments, with per-user balance snapshots."""
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+
+    async def post(self, account: str, delta: int, transfer_id: str, floor: Optional[int] = None) -> bool:
+        """Apply delta to account's balance once per transfer.
+
+        Returns False only when floor is given and the balance would drop
+        below it; a transfer already applied counts as applied.
+        """
+        now = datetime.utcnow()
+        try:
+            await db.balances.update_one(
+                {"user_id": account},
+                {"$setOnInsert": {"balance_minor": 0, "currency": "TZS", "entries": 0, "applied": [], "updated_at": now}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            pass  # created concurrently
+        query: Dict[str, Any] = {"user_id": account, "applied": {"$ne": transfer_id}}
+        if floor is not None:
+            query["balance_minor"] = {"$gte": floor - delta}
+        result = await db.balances.update_one(query, {
+            "$inc": {"balance_minor": delta, "entries": 1},
+            "$push": {"applied": {"$each": [transfer_id], "$slice": -LEDGER_APPLIED_WINDOW}},
+            "$set": {"updated_at": now},
+        })
+        if result.modified_count:
+            return True
+        return await db.balances.count_documents({"user_id": account, "applied": transfer_id}, limit=1) > 0
+
+    async def record(self, transfer_id: str, payer: str, payee: str, amount_minor: int, reference: str):
+        now = datetime.utcnow()
+        entries = [
+            {"id": str(uuid.uuid4()), "transfer_id": transfer_id, "account": account, "counterparty": other,
+             "amount_minor": signed, "currency": "TZS", "kind": "peer_payment", "reference": reference,
+             "created_at": now}
+            for account, other, signed in ((payer, payee, -amount_minor), (payee, payer, amount_minor))
+        ]
+        try:
+            await db.ledger_entries.insert_many(entries, ordered=False)
+        except BulkWriteError as e:
+            # Entries already written by an earlier attempt at this transfer
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+
+    async def settle(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Post a claimed (settling) request's transfer and mark it completed."""
+        transfer_id = request["transfer_id"]
+        payer, payee = request["to_user"], request["from_user"]
+        amount_minor = to_minor(request["amount"])
+        if not await self.post(payer, -amount_minor, transfer_id, floor=-to_minor(PEER_CREDIT_LIMIT)):
+            await db.payments.update_one(
+                {"id": request["id"], "status": "settling", "transfer_id": transfer_id},
+                {"$set": {"status": "pending", "transfer_id": None, "settling_since": None}}
+            )
+            metrics.inc("ledger_transfers_total", {"outcome": "insufficient_funds"})
+            raise InsufficientFunds("Insufficient balance for this payment")
+        await self.record(transfer_id, payer, payee, amount_minor, request["id"])
+        await self.post(payee, amount_minor, transfer_id)
+        now = datetime.utcnow()
+        result = await db.payments.update_one(
+            {"id": request["id"], "status": "settling", "transfer_id": transfer_id},
+            {"$set": {"status": "completed", "settled_at": now}}
+        )
+        if result.modified_count:
+            metrics.inc("ledger_transfers_total", {"outcome": "completed"})
+        return {**request, "status": "completed", "settled_at": now}
+
+    async def balance(self, user_id: str) -> Dict[str, Any]:
+        snapshot = await db.balances.find_one(
+            {"user_id": user_id}, {"_id": 0, "balance_minor": 1, "currency": 1, "updated_at": 1}
+        ) or {"balance_minor": 0, "currency": "TZS", "updated_at": None}
+        return {
+            "user_id": user_id,
+            "balance": from_minor(snapshot["balance_minor"]),
+            "currency": snapshot["currency"],
+            "updated_at": snapshot["updated_at"],
+        }
+
+    async def recover(self):
+        cutoff = datetime.utcnow() - timedelta(seconds=LEDGER_SETTLE_LEASE_SECONDS)
+        stuck = await db.payments.find(
+            {"status": "settling", "settling_since": {"$lt": cutoff}}, NO_ID
+        ).limit(100).to_list(100)
+        for request in stuck:
+            try:
+                await self.settle(request)
+            except InsufficientFunds:
+                pass  # returned to pending; the payer can accept again
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(LEDGER_SETTLE_LEASE_SECONDS)
+            try:
+                await self.recover()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ledger recovery failed: {e}")
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+ledger = Ledger()
+
+@app.on_event("startup")
+async def start_ledger():
+    await db.ledger_entries.create_index([("transfer_id", 1), ("account", 1)], unique=True)
+    await db.ledger_entries.create_index([("account", 1), ("created_at", -1), ("id", -1)])
+    await db.balances.create_index("user_id", unique=True)
+    await db.payments.create_index([("from_user", 1), ("created_at", -1)])
+    await db.payments.create_index([("to_user", 1), ("created_at", -1)])
+    await db.payments.create_index([("status", 1), ("settling_since", 1)])
+    ledger.start()
+
+@app.on_event("shutdown")
+async def stop_ledger():
+    await ledger.stop()
+
+async def notify_payment(request: Dict[str, Any], frame_type: str, recipient: str):
+    await manager.send_personal_message({"type": frame_type, "payment": request}, recipient)
+
+def history_cursor(query: Dict[str, Any], before: Optional[datetime], before_id: Optional[str]) -> Dict[str, Any]:
+    # Newest first; page back with ?before=<created_at>&before_id=<id> of the last row shown
+    if before:
+        before = to_naive_utc(before)
+        query = {"$and": [query, {"$or": [
+            {"created_at": {"$lt": before}},
+            {"created_at": before, "id": {"$lt": before_id or "\uffff"}}
+        ]}]}
+    return query
+
 @app.post("/api/payments/request")
-async def request_payment(data: dict, current_user: str = Depends(get_current_user)):
+async def request_payment(data: CreatePaymentRequest, current_user: str = Depends(get_current_user)):
+    if data.to_user == current_user:
+        raise HTTPException(status_code=400, detail="Cannot request a payment from yourself")
+    if not math.isfinite(data.amount) or to_minor(data.amount) <= 0 or data.amount > PEER_PAYMENT_MAX:
+        raise HTTPException(status_code=400, detail=f"Amount must be between 0.01 and {PEER_PAYMENT_MAX:g}")
+    description = data.description.strip()[:PEER_DESCRIPTION_MAX] or "Payment request"
+    if not await db.users.find_one({"id": data.to_user}, {"_id": 0, "id": 1}):
+        raise HTTPException(status_code=404, detail="User not found")
+
     payment = PaymentRequest(
         from_user=current_user,
-        to_user=data.get("to_user"),
-        amount=data.get("amount"),
-        description=data.get("description", "Payment request")
-    )
-    
-    await db.payments.insert_one(payment.dict())
-    
+        to_user=data.to_user,
+        amount=from_minor(to_minor(data.amount)),
+        description=description
+    ).dict()
+    await db.payments.insert_one({**payment})
+
     # Send payment request via WebSocket
-    payment_dict = payment.dict()
-    payment_dict["created_at"] = payment_dict["created_at"].isoformat()
-    await manager.send_personal_message(
-        json.dumps({
-            "type": "payment_request",
-            "payment": payment_dict
-        }),
-        data.get("to_user")
+    await notify_payment(payment, "payment_request", data.to_user)
+
+    return {"message": "Payment request sent", "payment": payment}
+
+@app.post("/api/payments/{payment_id}/accept")
+async def accept_payment(payment_id: str, current_user: str = Depends(get_current_user)):
+    # Claim the request first so only one accept can start its transfer
+    claim = {"status": "settling", "transfer_id": str(uuid.uuid4()), "settling_since": datetime.utcnow()}
+    request = await db.payments.find_one_and_update(
+        {"id": payment_id, "to_user": current_user, "status": "pending"}, {"$set": claim}, projection=NO_ID
     )
-    
-    return {"message": "Payment request sent", "payment": payment.dict()}
+    if request is None:
+        raise HTTPException(status_code=409, detail="Payment request is not awaiting your payment")
+    request.update(claim)
+    try:
+        request = await ledger.settle(request)
+    except InsufficientFunds as e:
+        raise HTTPException(status_code=402, detail=str(e))
+    request.pop("settling_since", None)
+    await notify_payment(request, "payment_update", request["from_user"])
+    return {"payment": request, "balance": await ledger.balance(current_user)}
+
+@app.post("/api/payments/{payment_id}/decline")
+async def decline_payment(payment_id: str, current_user: str = Depends(get_current_user)):
+    # The payer declines; the requester cancels their own request
+    request = await db.payments.find_one(
+        {"id": payment_id, "$or": [{"from_user": current_user}, {"to_user": current_user}]}, NO_ID
+    )
+    if request is None:
+        raise HTTPException(status_code=404, detail="Payment request not found")
+    new_status = "cancelled" if request["from_user"] == current_user else "declined"
+    if not await transition_payment(payment_id, "pending", new_status):
+        raise HTTPException(status_code=409, detail="Payment request is no longer pending")
+    request.update(status=new_status, updated_at=datetime.utcnow())
+    other = request["to_user"] if new_status == "cancelled" else request["from_user"]
+    await notify_payment(request, "payment_update", other)
+    return {"payment": request}
 
 @app.get("/api/payments")
-async def get_payments(current_user: str = Depends(get_current_user)):
-    payments = await db.payments.find(
-        {"$or": [{"from_user": current_user}, {"to_user": current_user}]}
-    ).to_list(100)
-    
-    # Convert MongoDB documents to proper format
-    return [
-        {
-            **payment,
-            "_id": str(payment["_id"]) if "_id" in payment else None
-        } for payment in payments
-    ]
+async def get_payments(status: Optional[str] = None, before: Optional[datetime] = None,
+                       before_id: Optional[str] = None, limit: int = 50,
+                       current_user: str = Depends(get_current_user)):
+    query: Dict[str, Any] = {"$or": [{"from_user": current_user}, {"to_user": current_user}]}
+    if status:
+        query["status"] = status
+    limit = max(1, min(limit, 200))
+    return await db.payments.find(
+        history_cursor(query, before, before_id), {"_id": 0, "settling_since": 0}
+    ).sort([("created_at", -1), ("id", -1)]).limit(limit).to_list(limit)
+
+@app.get("/api/payments/balance")
+async def get_balance(current_user: str = Depends(get_current_user)):
+    return await ledger.balance(current_user)
+
+@app.get("/api/payments/ledger")
+async def get_ledger(before: Optional[datetime] = None, before_id: Optional[str] = None, limit: int = 50,
+                     current_user: str = Depends(get_current_user)):
+    limit = max(1, min(limit, 200))
+    entries = await db.ledger_entries.find(
+        history_cursor({"account": current_user}, before, before_id), NO_ID
+    ).sort([("created_at", -1), ("id", -1)]).limit(limit).to_list(limit)
+    for entry in entries:
+        entry["amount"] = from_minor(entry.pop("amount_minor"))
+    return entries
 
 # WebSocket endpoint
+WS_INBOUND_TYPES = {"chat_message", "typing", "refresh_notifications", "ping", "pong"}
+
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
+    if await rate_limiter.hit("ws_connect", f"ip:{client_ip(websocket)}") > 0:
+        metrics.inc("rate_limited_total", {"budget": "ws_connect", "transport": "websocket"})
+        await websocket.accept()
+        await websocket.close(code=WS_CLOSE_RATE_LIMITED)
+        return
+    if manager.draining:
+        # This instance is shutting down; point the client somewhere else
+        websocket.state.codec, subprotocol = negotiate_codec(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        await manager._send(websocket, manager.reconnect_frame())
+        await manager.close(websocket, WS_CLOSE_SERVICE_RESTART)
+        return
+    if not await is_active_user(user_id):
+        await websocket.accept()
+        await websocket.close(code=WS_CLOSE_ACCOUNT_DELETED)
+        return
     await manager.connect(websocket, user_id)
+    frames = TokenBucket(WS_FRAME_BURST, WS_FRAME_RATE)
+    throttled = 0
     try:
         while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            manager.touch(websocket)
+            # Drop frames over the per-connection rate before parsing them;
+            # a client that keeps flooding is disconnected
+            if frames.take() > 0:
+                throttled += 1
+                metrics.inc("rate_limited_total", {"budget": "ws_frames", "transport": "websocket"})
+                if throttled > WS_MAX_THROTTLED_FRAMES:
+                    await manager.close(websocket, WS_CLOSE_RATE_LIMITED)
+                    return
+                if throttled == 1:
+                    await manager.send_personal_message({"type": "error", "code": "rate_limited"}, user_id)
+                continue
+            throttled = 0
+            try:
+                message_data = decode_frame(websocket, frame)
+                if not isinstance(message_data, dict):
+                    raise ValueError("frame is not an object")
+            except (ValueError, TypeError):
+                await manager.send_personal_message({"type": "error", "code": "bad_frame"}, user_id)
+                continue
+            frame_type = message_data.get("type")
+            metrics.inc("websocket_frames_in_total", {"type": frame_type if frame_type in WS_INBOUND_TYPES else "other"})
             
-            if message_data.get("type") == "chat_message":
+            if frame_type == "pong":
+                # Heartbeat reply; receiving it already refreshed last_seen
+                continue
+            elif frame_type == "ping":
+                await manager._send(websocket, OutboundFrame({"type": "pong"}))
+            elif message_data.get("type") == "chat_message":
+                client_message_id = message_data.get("client_message_id")
+                if not isinstance(client_message_id, str) or not 0 < len(client_message_id) <= CLIENT_MESSAGE_ID_MAX_LENGTH:
+                    client_message_id = None
+                if client_message_id:
+                    # A resend of something just stored: ack it without touching the database
+                    receipt = message_receipts.recall(user_id, client_message_id)
+                    if receipt is not None:
+                        await manager.send_personal_message(message_ack(receipt, duplicate=True), user_id)
+                        continue
+                retry_after = await rate_limiter.hit("chat_message", f"user:{user_id}")
+                if retry_after > 0:
+                    metrics.inc("rate_limited_total", {"budget": "chat_message", "transport": "websocket"})
+                    await manager.send_personal_message({
+                        "type": "error",
+                        "code": "rate_limited",
+                        "chat_id": message_data.get("chat_id"),
+                        "retry_after": round(retry_after, 2)
+                    }, user_id)
+                    continue
+                audience = await chat_audiences.get(message_data.get("chat_id"))
+                if audience is None or not audience.can_post(user_id):
+                    await manager.send_personal_message({
+                        "type": "error",
+                        "code": "forbidden",
+                        "chat_id": message_data.get("chat_id")
+                    }, user_id)
+                    continue
                 # Store message
+                metadata = message_data.get("metadata")
+                if metadata and metadata.get("media_id"):
+                    # Attachments reference the sender's own uploads; embed its URLs so readers need no lookup
+                    media = await media_service.attach(metadata["media_id"], user_id, message_data.get("chat_id"))
+                    if media is None:
+                        await manager.send_personal_message({
+                            "type": "error",
+                            "code": "unknown_media",
+                            "chat_id": message_data.get("chat_id")
+                        }, user_id)
+                        continue
+                    metadata = {**metadata, "media": media_view(media)}
                 message = Message(
                     chat_id=message_data.get("chat_id"),
                     sender_id=user_id,
                     sender_name=message_data.get("sender_name", "Unknown"),
                     content=message_data.get("content"),
                     message_type=message_data.get("message_type", "text"),
-                    metadata=message_data.get("metadata")
+                    metadata=metadata,
+                    client_message_id=client_message_id
                 )
                 
-                await db.messages.insert_one(message.dict())
+                if client_message_id:
+                    original = await message_receipts.claim(message)
+                    if original is not None:
+                        if "claimed_until" not in original:
+                            await manager.send_personal_message(message_ack(original, duplicate=True), user_id)
+                        # Otherwise the first copy is still being stored; the client resends until acked
+                        continue
+                    try:
+                        await message_store.append(message.dict())
+                    except Exception:
+                        await message_receipts.release(message)
+                        raise
+                    await message_receipts.confirm(message)
+                else:
+                    await message_store.append(message.dict())
                 
                 # Update chat last activity
                 await db.chats.update_one(
@@ -878,54 +3545,67 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                 )
                 
                 # Send to all chat participants
-                message_dict = message.dict()
-                message_dict["timestamp"] = message_dict["timestamp"].isoformat()
                 await manager.send_to_chat({
                     "type": "new_message",
-                    "message": message_dict
-                }, message.chat_id)
+                    "message": message
+                }, message.chat_id, audience)
+                if client_message_id:
+                    await manager.send_personal_message(message_ack(message_receipt(message), duplicate=False), user_id)
                 
             elif message_data.get("type") == "typing":
-                # Forward typing indicator to chat participants
+                # Forward typing indicator to chat participants; not worth it in channels or big groups
+                audience = await chat_audiences.get(message_data.get("chat_id"))
+                if (audience is None or not audience.can_post(user_id)
+                        or len(audience.members) > TYPING_FANOUT_MAX_MEMBERS
+                        or not (await privacy.get(user_id))["typing_indicators"]):
+                    continue
                 await manager.send_to_chat({
                     "type": "typing",
                     "user_id": user_id,
                     "chat_id": message_data.get("chat_id"),
                     "is_typing": message_data.get("is_typing", False)
-                }, message_data.get("chat_id"))
+                }, message_data.get("chat_id"), audience)
                 
             elif message_data.get("type") == "refresh_notifications":
                 # Refresh notifications for the user
                 notifications = await db.notifications.find(
-                    {"user_id": user_id}
+                    {"user_id": user_id}, NO_ID
                 ).sort("created_at", -1).limit(50).to_list(50)
                 
-                formatted_notifications = [
-                    {
-                        **notification,
-                        "created_at": notification["created_at"].isoformat() if "created_at" in notification else None,
-                        "_id": str(notification["_id"]) if "_id" in notification else None
-                    } for notification in notifications
-                ]
-                
                 await manager.send_personal_message(
-                    json.dumps({
+                    {
                         "type": "notifications_update",
-                        "notifications": formatted_notifications
-                    }),
+                        "notifications": notifications
+                    },
                     user_id
                 )
     
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
+        pass
+    except Exception as e:
+        logging.error(f"WebSocket handler for {user_id} failed: {e}")
+        await manager.close(websocket, 1011)
+    finally:
+        # Every exit path releases the slot, unless a newer socket already took it
+        manager.disconnect(user_id, websocket)
+
+@app.post("/api/admin/drain", status_code=202, dependencies=[Depends(require_admin)])
+async def drain_connections():
+    """Take this instance out of rotation: refuse new sockets and move existing ones off."""
+    if manager.drain_task is None:
+        manager.drain_task = asyncio.create_task(manager.drain())
+    return {"status": "draining", "connections": len(manager.active_connections), "window_seconds": WS_DRAIN_WINDOW_SECONDS}
 
 # Notification endpoints
 @app.post("/api/notifications/subscribe")
 async def subscribe_to_notifications(data: dict, current_user: str = Depends(get_current_user)):
-    # Store push notification subscription
+    # Store push notification subscription; the outbox delivers to it
+    subscription = data.get("subscription")
+    if not isinstance(subscription, dict) or not subscription.get("endpoint"):
+        raise HTTPException(status_code=400, detail="Invalid push subscription")
     subscription_data = {
         "user_id": current_user,
-        "subscription": data.get("subscription"),
+        "subscription": subscription,
         "created_at": datetime.utcnow()
     }
     
@@ -940,16 +3620,9 @@ async def subscribe_to_notifications(data: dict, current_user: str = Depends(get
 @app.get("/api/notifications")
 async def get_notifications(current_user: str = Depends(get_current_user)):
     # Get user notifications
-    notifications = await db.notifications.find(
-        {"user_id": current_user}
+    return await db.notifications.find(
+        {"user_id": current_user}, NO_ID
     ).sort("created_at", -1).limit(50).to_list(50)
-    
-    return [
-        {
-            **notification,
-            "_id": str(notification["_id"]) if "_id" in notification else None
-        } for notification in notifications
-    ]
 
 @app.post("/api/notifications/{notification_id}/read")
 async def mark_notification_read(notification_id: str, current_user: str = Depends(get_current_user)):
@@ -963,39 +3636,32 @@ async def mark_notification_read(notification_id: str, current_user: str = Depen
 async def refresh_notifications(current_user: str = Depends(get_current_user)):
     # Trigger notification refresh for the user
     notifications = await db.notifications.find(
-        {"user_id": current_user}
+        {"user_id": current_user}, NO_ID
     ).sort("created_at", -1).limit(50).to_list(50)
     
-    formatted_notifications = [
-        {
-            **notification,
-            "created_at": notification["created_at"].isoformat() if "created_at" in notification else None,
-            "_id": str(notification["_id"]) if "_id" in notification else None
-        } for notification in notifications
-    ]
-    
     # Send via WebSocket
     await manager.send_personal_message(
-        json.dumps({
+        {
             "type": "notifications_update",
-            "notifications": formatted_notifications
-        }),
+            "notifications": notifications
+        },
         current_user
     )
     
-    return {"message": "Notifications refreshed", "count": len(formatted_notifications)}
+    return {"message": "Notifications refreshed", "count": len(notifications)}
 
 # News endpoints
-@app.get("/api/news")
-async def get_news():
-    news_posts = await db.news.find({}).sort("created_at", -1).limit(50).to_list(50)
-    return [
-        {
-            **post,
-            "_id": str(post["_id"]) if "_id" in post else None,
-            "created_at": post["created_at"].isoformat() if "created_at" in post else None
-        } for post in news_posts
-    ]
+@app.get("/api/news", response_model=List[NewsPostSummary], response_model_exclude_unset=True)
+async def get_news(fields: Optional[str] = None, current_user: Optional[str] = Depends(get_optional_user)):
+    projection = build_projection(NewsPostSummary, fields, {
+        **likes_projection(current_user),
+        "comment_count": {"$ifNull": ["$comment_count", 0]},
+    })
+    return await db.news.aggregate([
+        {"$sort": {"created_at": -1}},
+        {"$limit": 50},
+        {"$project": projection}
+    ]).to_list(50)
 
 @app.post("/api/news")
 async def create_news_post(post_data: CreateNewsPost, current_user: str = Depends(get_current_user)):
@@ -1013,56 +3679,308 @@ async def create_news_post(post_data: CreateNewsPost, current_user: str = Depend
     await db.news.insert_one(news_post.dict())
     return {"message": "News post created successfully", "post": news_post.dict()}
 
+# Comments are threaded one level deep: a reply to a reply is filed under the
+# top-level comment. Each thread reads oldest first, totally ordered by
+# (created_at, id) like chat history; a page cursor is the pair taken from the
+# last comment shown. Posts carry comment_count and top-level comments
+# reply_count, both maintained with $inc so the feed never counts.
+COMMENT_BACKFILL_BATCH_SIZE = 500
+
+async def comment_counts(post_ids: List[str]) -> Dict[str, int]:
+    """Comments per post, counted from db.comments in one aggregation."""
+    rows = await db.comments.aggregate([
+        {"$match": {"post_id": {"$in": post_ids}}},
+        {"$group": {"_id": "$post_id", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    return {row["_id"]: row["count"] for row in rows}
+
+async def backfill_comment_counts():
+    # Posts created before comment_count existed; newer posts always have it.
+    # Runs to completion before serving: an $inc on a post without the field
+    # would create it with a partial count that this pass then skips.
+    while True:
+        posts = await db.news.find(
+            {"comment_count": {"$exists": False}}, {"_id": 0, "id": 1}
+        ).limit(COMMENT_BACKFILL_BATCH_SIZE).to_list(COMMENT_BACKFILL_BATCH_SIZE)
+        if not posts:
+            return
+        counts = await comment_counts([post["id"] for post in posts])
+        await db.news.bulk_write([
+            UpdateOne({"id": post["id"], "comment_count": {"$exists": False}},
+                      {"$set": {"comment_count": counts.get(post["id"], 0)}})
+            for post in posts
+        ], ordered=False)
+
+async def purge_comments(ids: List[Any]) -> int:
+    """Remove comments (by _id) for account deletion, keeping counts in step.
+
+    Top-level comments that have replies are scrubbed instead so the thread
+    under them stays readable.
+    """
+    comments = await db.comments.find(
+        {"_id": {"$in": ids}}, {"_id": 1, "post_id": 1, "parent_id": 1, "reply_count": 1}
+    ).to_list(len(ids))
+    keep = {c["_id"] for c in comments if not c.get("parent_id") and c.get("reply_count", 0) > 0}
+    if keep:
+        await db.comments.update_many({"_id": {"$in": list(keep)}}, {"$set": {
+            "author_id": None, "author_name": "Deleted user", "content": "", "likes": [], "deleted": True
+        }})
+    removed = [c for c in comments if c["_id"] not in keep]
+    if not removed:
+        return len(keep)
+    await db.comments.delete_many({"_id": {"$in": [c["_id"] for c in removed]}})
+    posts: Dict[str, int] = {}
+    parents: Dict[str, int] = {}
+    for c in removed:
+        posts[c["post_id"]] = posts.get(c["post_id"], 0) + 1
+        if c.get("parent_id"):
+            parents[c["parent_id"]] = parents.get(c["parent_id"], 0) + 1
+    await db.news.bulk_write([UpdateOne({"id": k}, {"$inc": {"comment_count": -n}}) for k, n in posts.items()], ordered=False)
+    if parents:
+        await db.comments.bulk_write([UpdateOne({"id": k}, {"$inc": {"reply_count": -n}}) for k, n in parents.items()], ordered=False)
+    return len(comments)
+
+@app.on_event("startup")
+async def start_comments():
+    await db.comments.create_index([("post_id", 1), ("parent_id", 1), ("created_at", 1), ("id", 1)])
+    await db.comments.create_index("id", unique=True)
+    await backfill_comment_counts()
+
 @app.get("/api/news/{post_id}/comments")
-async def get_comments(post_id: str):
-    comments = await db.comments.find({"post_id": post_id}).sort("created_at", 1).to_list(100)
-    return [
-        {
-            **comment,
-            "_id": str(comment["_id"]) if "_id" in comment else None,
-            "created_at": comment["created_at"].isoformat() if "created_at" in comment else None
-        } for comment in comments
-    ]
+async def get_comments(post_id: str, parent_id: Optional[str] = None, after: Optional[datetime] = None,
+                       after_id: Optional[str] = None, limit: int = 50):
+    # Top-level comments by default; ?parent_id= lists that comment's replies.
+    # Page forwards with ?after=<created_at>&after_id=<id> of the last comment shown
+    query: Dict[str, Any] = {"post_id": post_id, "parent_id": parent_id}
+    if after:
+        after = to_naive_utc(after)
+        query["$or"] = [
+            {"created_at": {"$gt": after}},
+            {"created_at": after, "id": {"$gt": after_id or ""}}
+        ]
+    limit = max(1, min(limit, 200))
+    return await db.comments.find(query, NO_ID).sort([("created_at", 1), ("id", 1)]).limit(limit).to_list(limit)
 
 @app.post("/api/news/{post_id}/comments")
 async def create_comment(post_id: str, comment_data: CreateComment, current_user: str = Depends(get_current_user)):
     user = await db.users.find_one({"id": current_user})
     
+    parent_id = None
+    if comment_data.parent_id:
+        parent = await db.comments.find_one(
+            {"id": comment_data.parent_id, "post_id": post_id}, {"_id": 0, "id": 1, "parent_id": 1}
+        )
+        if not parent:
+            raise HTTPException(status_code=404, detail="Comment not found")
+        parent_id = parent.get("parent_id") or parent["id"]
+    
     comment = Comment(
         post_id=post_id,
+        parent_id=parent_id,
         author_id=current_user,
         author_name=user["display_name"],
         content=comment_data.content
     )
     
-    await db.comments.insert_one(comment.dict())
+    # Count first: it doubles as the existence check for the post
+    result = await db.news.update_one({"id": post_id}, {"$inc": {"comment_count": 1}})
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Post not found")
+    try:
+        await db.comments.insert_one(comment.dict())
+    except Exception:
+        await db.news.update_one({"id": post_id}, {"$inc": {"comment_count": -1}})
+        raise
+    if parent_id:
+        await db.comments.update_one({"id": parent_id}, {"$inc": {"reply_count": 1}})
     return {"message": "Comment created successfully", "comment": comment.dict()}
 
 # Marketplace endpoints
-@app.get("/api/products")
-async def get_products(category: str = None, search: str = None):
-    query = {"is_active": True}
-    if category:
-        query["category"] = category
-    if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-            {"tags": {"$in": [search]}}
-        ]
+# Browse pages are keyset-paginated: each sort orders by one field then id,
+# and the X-Next-Cursor response header carries the last row's pair. Every
+# sort is backed by a (is_active, [category,] sort field, id) index; price
+# ranges and the other filters ride along as residual predicates.
+PRODUCT_SORTS = {
+    "newest": ("created_at", -1),
+    "price_asc": ("price", 1),
+    "price_desc": ("price", -1),
+    "popular": ("like_count", -1),
+}
+PRODUCT_CONDITIONS = {"new", "used", "refurbished"}
+PRODUCT_PAGE_MAX = 100
+PRODUCT_CACHE_TTL_SECONDS = float(os.environ.get('PRODUCT_CACHE_TTL_SECONDS', '15'))
+PRODUCT_CACHE_MAX_ENTRIES = 512
+
+def product_index_specs() -> List[List[tuple]]:
+    specs = []
+    for field, direction in dict.fromkeys(PRODUCT_SORTS.values()):
+        keys = [(field, direction), ("id", direction)]
+        specs.append([("is_active", 1)] + keys)
+        specs.append([("is_active", 1), ("category", 1)] + keys)
+        specs.append([("seller_id", 1), ("is_active", 1)] + keys)
+    return specs
+
+def encode_product_cursor(sort: str, product: Dict[str, Any]) -> str:
+    field = PRODUCT_SORTS[sort][0]
+    value = product.get(field)
+    if isinstance(value, datetime):
+        value = {"$date": value.isoformat()}
+    raw = json.dumps([sort, value, product["id"]], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_product_cursor(sort: str, cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, value, product_id = json.loads(raw)
+        if isinstance(value, dict):
+            value = datetime.fromisoformat(value["$date"])
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_sort != sort or not isinstance(product_id, str):
+        raise HTTPException(status_code=400, detail="Cursor does not match sort")
+    return value, product_id
+
+def after_product(sort: str, value: Any, product_id: str) -> Dict[str, Any]:
+    field, direction = PRODUCT_SORTS[sort]
+    beyond = "$gt" if direction == 1 else "$lt"
+    # Rows without the sort field (null) come last in descending order
+    return {"$or": [
+        {field: {beyond: value}},
+        {field: value, "id": {beyond: product_id}},
+    ]}
+
+class ProductPageCache:
+    """Short-lived first pages of common browse queries (category tiles, default sorts).
+
+    Only anonymous-shaped results are kept; liked_by_me is filled in per request.
+    """
+
+    def __init__(self, max_entries: int = PRODUCT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+    def get(self, key: tuple) -> Optional[tuple]:
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] >= PRODUCT_CACHE_TTL_SECONDS:
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: tuple, value: tuple):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+product_pages = ProductPageCache()
+
+async def backfill_like_counts():
+    # Products created before like_count existed. Runs to completion before
+    # serving, since a like would otherwise $inc the field into existence
+    # with a partial count that this pass then skips.
+    while True:
+        products = await db.products.find(
+            {"like_count": {"$exists": False}}, {"_id": 0, "id": 1, "likes": 1}
+        ).limit(500).to_list(500)
+        if not products:
+            return
+        await db.products.bulk_write([
+            UpdateOne({"id": p["id"], "like_count": {"$exists": False}},
+                      {"$set": {"like_count": len(p.get("likes") or [])}})
+            for p in products
+        ], ordered=False)
+
+@app.on_event("startup")
+async def start_marketplace():
+    await db.products.create_index("id", unique=True)
+    for keys in product_index_specs():
+        await db.products.create_index(keys)
+    await backfill_like_counts()
+
+@app.get("/api/products", response_model=List[ProductSummary], response_model_exclude_unset=True)
+async def get_products(response: Response, category: str = None, search: str = None, seller: Optional[str] = None,
+                       min_price: Optional[float] = None, max_price: Optional[float] = None,
+                       condition: Optional[str] = None, location: Optional[str] = None,
+                       sort: str = "newest", cursor: Optional[str] = None, limit: int = 50,
+                       fields: Optional[str] = None, current_user: Optional[str] = Depends(get_optional_user)):
+    if sort not in PRODUCT_SORTS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of: {', '.join(PRODUCT_SORTS)}")
+    conditions = sorted({c.strip() for c in condition.split(",") if c.strip()}) if condition else []
+    if set(conditions) - PRODUCT_CONDITIONS:
+        raise HTTPException(status_code=400, detail=f"condition must be among: {', '.join(sorted(PRODUCT_CONDITIONS))}")
+    limit = max(1, min(limit, PRODUCT_PAGE_MAX))
     
-    products = await db.products.find(query).sort("created_at", -1).limit(50).to_list(50)
-    return [
-        {
-            **product,
-            "_id": str(product["_id"]) if "_id" in product else None,
-            "created_at": product["created_at"].isoformat() if "created_at" in product else None
-        } for product in products
-    ]
+    projection = build_projection(ProductSummary, fields, {
+        "likes_count": {"$ifNull": ["$like_count", {"$size": {"$ifNull": ["$likes", []]}}]},
+    })
+    wants_liked = projection.pop("liked_by_me", None) is not None
+    requested = [name for name in projection if name != "_id"]
+    sort_field, direction = PRODUCT_SORTS[sort]
+    # The cursor needs the sort key even when fields= leaves it out
+    projection.setdefault(sort_field, 1)
+    
+    key = None
+    if not (search or seller or cursor):
+        key = (category, tuple(conditions), (location or "").lower(), min_price, max_price, sort, limit, tuple(requested))
+    cached = product_pages.get(key) if key else None
+    if cached is not None:
+        products, next_cursor = cached
+    else:
+        query: Dict[str, Any] = {"is_active": True}
+        if seller:
+            query["seller_id"] = seller
+        if category:
+            query["category"] = category
+        if conditions:
+            query["condition"] = conditions[0] if len(conditions) == 1 else {"$in": conditions}
+        if location:
+            query["location"] = {"$regex": f"^{re.escape(location.strip())}", "$options": "i"}
+        if min_price is not None or max_price is not None:
+            query["price"] = {
+                **({"$gte": min_price} if min_price is not None else {}),
+                **({"$lte": max_price} if max_price is not None else {}),
+            }
+        clauses = []
+        if search:
+            clauses.append({"$or": [
+                {"name": {"$regex": search, "$options": "i"}},
+                {"description": {"$regex": search, "$options": "i"}},
+                {"tags": {"$in": [search]}}
+            ]})
+        if cursor:
+            clauses.append(after_product(sort, *decode_product_cursor(sort, cursor)))
+        if clauses:
+            query["$and"] = clauses
+        
+        products = await db.products.aggregate([
+            {"$match": query},
+            {"$sort": {sort_field: direction, "id": direction}},
+            {"$limit": limit},
+            {"$project": projection}
+        ]).to_list(limit)
+        next_cursor = encode_product_cursor(sort, products[-1]) if len(products) == limit else None
+        products = [{name: p[name] for name in requested if name in p} for p in products]
+        if key:
+            product_pages.put(key, (products, next_cursor))
+    
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    if wants_liked:
+        liked = set()
+        if current_user and products:
+            liked = {p["id"] for p in await db.products.find(
+                {"id": {"$in": [p["id"] for p in products]}, "likes": current_user}, {"_id": 0, "id": 1}
+            ).to_list(len(products))}
+        products = [{**p, "liked_by_me": p["id"] in liked} for p in products]
+    return products
 
 @app.post("/api/products")
 async def create_product(product_data: CreateProduct, current_user: str = Depends(get_current_user)):
     user = await db.users.find_one({"id": current_user})
+    uploaded = await media_service.resolve(product_data.media_ids, current_user, publish=True)
     
     product = Product(
         seller_id=current_user,
@@ -1071,36 +3989,208 @@ async def create_product(product_data: CreateProduct, current_user: str = Depend
         description=product_data.description,
         price=product_data.price,
         category=product_data.category,
-        images=product_data.images,
+        images=product_data.images + [media_url(doc["id"], "960" if "960" in doc["variants"] else None) for doc in uploaded],
         stock_quantity=product_data.stock_quantity,
         condition=product_data.condition,
         location=product_data.location,
         tags=product_data.tags
     )
-    
-    await db.products.insert_one(product.dict())
-    return {"message": "Product created successfully", "product": product.dict()}
+    
+    await db.products.insert_one(product.dict())
+    # A new listing should show up on the tiles right away
+    product_pages.clear()
+    return {"message": "Product created successfully", "product": product.dict()}
+
+@app.post("/api/products/{product_id}/like")
+async def like_product(product_id: str, current_user: str = Depends(get_current_user)):
+    # Toggle atomically: each update only matches in the state it changes
+    action = "liked"
+    result = await db.products.update_one(
+        {"id": product_id, "likes": {"$ne": current_user}},
+        {"$push": {"likes": current_user}, "$inc": {"like_count": 1}}
+    )
+    if result.matched_count == 0:
+        action = "unliked"
+        result = await db.products.update_one(
+            {"id": product_id, "likes": current_user},
+            {"$pull": {"likes": current_user}, "$inc": {"like_count": -1}}
+        )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Product not found")
+    
+    product_views.record_like(product_id, 1 if action == "liked" else -1)
+    
+    product = await db.products.find_one({"id": product_id}, {"_id": 0, "like_count": 1})
+    return {"message": f"Product {action}", "likes_count": product.get("like_count", 0) if product else 0}
+
+# Product views and trending
+# Views are counted in memory and written out every PRODUCT_VIEW_FLUSH_SECONDS
+# as one bulk_write of $inc updates, so a hot listing costs one write per
+# flush rather than one per view. A viewer counts once per product within
+# PRODUCT_VIEW_DEDUPE_SECONDS. Views and like changes also go into daily
+# db.product_stats buckets, which the trending ranking decays by age.
+PRODUCT_VIEW_FLUSH_SECONDS = float(os.environ.get('PRODUCT_VIEW_FLUSH_SECONDS', '10'))
+PRODUCT_VIEW_DEDUPE_SECONDS = float(os.environ.get('PRODUCT_VIEW_DEDUPE_SECONDS', '1800'))
+PRODUCT_VIEW_DEDUPE_MAX = int(os.environ.get('PRODUCT_VIEW_DEDUPE_MAX', '200000'))
+TRENDING_WINDOW_DAYS = int(os.environ.get('TRENDING_WINDOW_DAYS', '7'))
+TRENDING_HALF_LIFE_HOURS = float(os.environ.get('TRENDING_HALF_LIFE_HOURS', '24'))
+TRENDING_LIKE_WEIGHT = float(os.environ.get('TRENDING_LIKE_WEIGHT', '5'))
+TRENDING_CACHE_TTL_SECONDS = float(os.environ.get('TRENDING_CACHE_TTL_SECONDS', '60'))
+TRENDING_MAX = 100
+
+metrics.describe("product_views_total", "counter", "Product views counted, after per-viewer dedupe")
+metrics.describe("product_view_flushes_total", "counter", "Buffered product view flushes by outcome")
+
+class ProductViewCounter:
+    def __init__(self):
+        self.views: Dict[str, int] = {}
+        self.likes: Dict[str, int] = {}
+        # (product_id, viewer) -> first seen; insertion order is time order
+        self.seen: "OrderedDict[tuple, float]" = OrderedDict()
+        self.task: Optional[asyncio.Task] = None
+
+    def record_view(self, product_id: str, viewer: str) -> bool:
+        now = time.monotonic()
+        while self.seen:
+            key, first_seen = next(iter(self.seen.items()))
+            if now - first_seen < PRODUCT_VIEW_DEDUPE_SECONDS and len(self.seen) < PRODUCT_VIEW_DEDUPE_MAX:
+                break
+            self.seen.popitem(last=False)
+        key = (product_id, viewer)
+        if key in self.seen:
+            return False
+        self.seen[key] = now
+        self.views[product_id] = self.views.get(product_id, 0) + 1
+        metrics.inc("product_views_total")
+        return True
+
+    def record_like(self, product_id: str, delta: int):
+        self.likes[product_id] = self.likes.get(product_id, 0) + delta
+
+    async def flush(self):
+        views, self.views = self.views, {}
+        likes, self.likes = self.likes, {}
+        if not views and not likes:
+            return
+        day = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        try:
+            if views:
+                await db.products.bulk_write([
+                    UpdateOne({"id": product_id}, {"$inc": {"views": n}}) for product_id, n in views.items()
+                ], ordered=False)
+            await db.product_stats.bulk_write([
+                UpdateOne({"product_id": product_id, "day": day},
+                          {"$inc": {"views": views.get(product_id, 0), "likes": likes.get(product_id, 0)}},
+                          upsert=True)
+                for product_id in views.keys() | likes.keys()
+            ], ordered=False)
+            metrics.inc("product_view_flushes_total", {"outcome": "ok"})
+        except Exception as e:
+            # Put the counts back for the next flush; an $inc that did land is counted twice, which beats losing it
+            for product_id, n in views.items():
+                self.views[product_id] = self.views.get(product_id, 0) + n
+            for product_id, n in likes.items():
+                self.likes[product_id] = self.likes.get(product_id, 0) + n
+            metrics.inc("product_view_flushes_total", {"outcome": "error"})
+            logging.error(f"Product view flush failed: {e}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(PRODUCT_VIEW_FLUSH_SECONDS)
+            await self.flush()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+product_views = ProductViewCounter()
+
+class TrendingCache:
+    """Product ids ranked by decayed views and likes, recomputed at most every TRENDING_CACHE_TTL_SECONDS."""
+
+    def __init__(self):
+        self.ranking: List[str] = []
+        self.computed_at = float("-inf")
+        self.lock = asyncio.Lock()
+
+    async def _compute(self) -> List[str]:
+        now = datetime.utcnow()
+        since = now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=TRENDING_WINDOW_DAYS)
+        # Each day's bucket is weighted 0.5 ** (age / half-life)
+        decay = {"$pow": [0.5, {"$divide": [{"$subtract": [now, "$day"]}, TRENDING_HALF_LIFE_HOURS * 3600 * 1000]}]}
+        rows = await db.product_stats.aggregate([
+            {"$match": {"day": {"$gte": since}}},
+            {"$group": {"_id": "$product_id", "score": {"$sum": {"$multiply": [
+                {"$add": [{"$ifNull": ["$views", 0]}, {"$multiply": [{"$ifNull": ["$likes", 0]}, TRENDING_LIKE_WEIGHT]}]},
+                decay
+            ]}}}},
+            {"$match": {"score": {"$gt": 0}}},
+            {"$sort": {"score": -1}},
+            {"$limit": TRENDING_MAX * 2}
+        ]).to_list(TRENDING_MAX * 2)
+        return [row["_id"] for row in rows]
+
+    async def get(self) -> List[str]:
+        if time.monotonic() - self.computed_at < TRENDING_CACHE_TTL_SECONDS:
+            return self.ranking
+        async with self.lock:
+            # Whoever held the lock may have just refreshed it
+            if time.monotonic() - self.computed_at >= TRENDING_CACHE_TTL_SECONDS:
+                self.ranking = await self._compute()
+                self.computed_at = time.monotonic()
+        return self.ranking
+
+trending_products = TrendingCache()
+
+@app.on_event("startup")
+async def start_product_views():
+    await db.product_stats.create_index([("product_id", 1), ("day", 1)], unique=True)
+    await db.product_stats.create_index(
+        "day", expireAfterSeconds=int(timedelta(days=TRENDING_WINDOW_DAYS + 1).total_seconds())
+    )
+    product_views.start()
 
-@app.post("/api/products/{product_id}/like")
-async def like_product(product_id: str, current_user: str = Depends(get_current_user)):
-    product = await db.products.find_one({"id": product_id})
-    if not product:
+@app.on_event("shutdown")
+async def stop_product_views():
+    await product_views.stop()
+
+@app.get("/api/products/trending", response_model=List[ProductSummary], response_model_exclude_unset=True)
+async def get_trending_products(limit: int = 20, fields: Optional[str] = None,
+                                current_user: Optional[str] = Depends(get_optional_user)):
+    ranking = await trending_products.get()
+    limit = max(1, min(limit, TRENDING_MAX))
+    projection = build_projection(ProductSummary, fields, likes_projection(current_user))
+    products = await db.products.aggregate([
+        {"$match": {"id": {"$in": ranking}, "is_active": True}},
+        {"$project": projection}
+    ]).to_list(len(ranking))
+    order = {product_id: n for n, product_id in enumerate(ranking)}
+    products.sort(key=lambda p: order[p["id"]])
+    return products[:limit]
+
+@app.get("/api/products/{product_id}", response_model=ProductSummary, response_model_exclude_unset=True)
+async def get_product(product_id: str, request: Request, fields: Optional[str] = None,
+                      current_user: Optional[str] = Depends(get_optional_user)):
+    projection = build_projection(ProductSummary, fields, likes_projection(current_user))
+    products = await db.products.aggregate([
+        {"$match": {"id": product_id}},
+        {"$limit": 1},
+        {"$project": projection}
+    ]).to_list(1)
+    if not products:
         raise HTTPException(status_code=404, detail="Product not found")
-    
-    likes = product.get("likes", [])
-    if current_user in likes:
-        likes.remove(current_user)
-        action = "unliked"
-    else:
-        likes.append(current_user)
-        action = "liked"
-    
-    await db.products.update_one(
-        {"id": product_id},
-        {"$set": {"likes": likes}}
-    )
-    
-    return {"message": f"Product {action}", "likes_count": len(likes)}
+    product_views.record_view(product_id, current_user or f"ip:{client_ip(request)}")
+    return products[0]
 
 @app.post("/api/cart/add")
 async def add_to_cart(data: dict, current_user: str = Depends(get_current_user)):
@@ -1129,42 +4219,56 @@ async def add_to_cart(data: dict, current_user: str = Depends(get_current_user))
     
     return {"message": "Product added to cart"}
 
-@app.get("/api/cart")
-async def get_cart(current_user: str = Depends(get_current_user)):
-    cart_items = await db.cart.find({"user_id": current_user}).to_list(100)
+@app.get("/api/cart", response_model=List[CartItemView], response_model_exclude_unset=True)
+async def get_cart(fields: Optional[str] = None, current_user: str = Depends(get_current_user)):
+    cart_items = await db.cart.find(
+        {"user_id": current_user},
+        {"_id": 0, "id": 1, "product_id": 1, "quantity": 1, "added_at": 1}
+    ).to_list(100)
+    
+    # Get product details for all cart items in one query; fields= narrows the nested product
+    product_ids = [item["product_id"] for item in cart_items]
+    products = await db.products.find(
+        {"id": {"$in": product_ids}},
+        build_projection(CartProduct, fields)
+    ).to_list(len(product_ids))
+    products_by_id = {product["id"]: product for product in products}
     
-    # Get product details for each cart item
     enriched_items = []
     for item in cart_items:
-        product = await db.products.find_one({"id": item["product_id"]})
+        product = products_by_id.get(item["product_id"])
         if product:
-            enriched_items.append({
-                **item,
-                "_id": str(item["_id"]) if "_id" in item else None,
-                "product": {
-                    **product,
-                    "_id": str(product["_id"]) if "_id" in product else None
-                }
-            })
+            item["product"] = product
+            enriched_items.append(item)
     
     return enriched_items
 
 @app.post("/api/orders")
 async def create_order(order_data: CreateOrder, current_user: str = Depends(get_current_user)):
     user = await db.users.find_one({"id": current_user})
+    if not order_data.product_ids:
+        raise HTTPException(status_code=400, detail="Order has no products")
     
     # Get products and calculate total
+    found = await db.products.find(
+        {"id": {"$in": order_data.product_ids}},
+        {"_id": 0, "id": 1, "name": 1, "price": 1, "seller_id": 1, "seller_name": 1}
+    ).to_list(len(order_data.product_ids))
+    by_id = {product["id"]: product for product in found}
     products = []
     total_amount = 0
     
     for i, product_id in enumerate(order_data.product_ids):
-        product = await db.products.find_one({"id": product_id})
+        product = by_id.get(product_id)
         if not product:
             raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
         
         quantity = order_data.quantities[i] if i < len(order_data.quantities) else 1
+        if quantity < 1:
+            raise HTTPException(status_code=400, detail="Quantity must be at least 1")
         products.append({
             "product_id": product_id,
+            "seller_id": product["seller_id"],
             "name": product["name"],
             "price": product["price"],
             "quantity": quantity,
@@ -1172,12 +4276,25 @@ async def create_order(order_data: CreateOrder, current_user: str = Depends(get_
         })
         total_amount += product["price"] * quantity
     
-    # Create order
+    # Reserve stock line by line; the guard on the update means stock never goes negative
+    reserved = []
+    for line in products:
+        result = await db.products.update_one(
+            {"id": line["product_id"], "is_active": True, "stock_quantity": {"$gte": line["quantity"]}},
+            {"$inc": {"stock_quantity": -line["quantity"]}}
+        )
+        if result.matched_count == 0:
+            await restock(reserved)
+            raise HTTPException(status_code=409, detail=f"{line['name']} is out of stock")
+        reserved.append(line)
+    
+    # Create order; lines carry their own seller, the order is filed under the first
+    first = by_id[products[0]["product_id"]]
     order = Order(
         buyer_id=current_user,
         buyer_name=user["display_name"],
-        seller_id=products[0]["product_id"],  # Simplified - assumes single seller
-        seller_name="Seller",  # Would get from product
+        seller_id=first["seller_id"],
+        seller_name=first.get("seller_name", "Seller"),
         products=products,
         total_amount=total_amount,
         payment_method=order_data.payment_method,
@@ -1185,45 +4302,1406 @@ async def create_order(order_data: CreateOrder, current_user: str = Depends(get_
     )
     
     await db.orders.insert_one(order.dict())
+    await seller_stats.order_placed(order.dict())
+    await refresh_low_stock([line["product_id"] for line in products])
     
-    # Create payment transaction
-    payment = PaymentTransaction(
-        order_id=order.id,
-        payer_id=current_user,
-        payee_id=products[0]["product_id"],  # Simplified
-        amount=total_amount,
-        payment_method=order_data.payment_method
-    )
-    
-    await db.payments.insert_one(payment.dict())
+    # Create payment transaction; the settlement worker asks the provider to collect it
+    payment = await open_payment(order.dict())
     
-    return {"message": "Order created successfully", "order": order.dict()}
+    return {"message": "Order created successfully", "order": order.dict(), "payment": payment}
 
-@app.get("/api/orders")
-async def get_orders(current_user: str = Depends(get_current_user)):
-    orders = await db.orders.find({
+async def restock(lines: List[Dict[str, Any]]):
+    """Return reserved units to stock, e.g. for a cancelled order."""
+    for line in lines:
+        await db.products.update_one({"id": line["product_id"]}, {"$inc": {"stock_quantity": line["quantity"]}})
+    await refresh_low_stock([line["product_id"] for line in lines])
+
+async def refresh_low_stock(product_ids: List[str]):
+    products = await db.products.find(
+        {"id": {"$in": list(dict.fromkeys(product_ids))}},
+        {"_id": 0, "id": 1, "name": 1, "seller_id": 1, "stock_quantity": 1, "is_active": 1}
+    ).to_list(len(product_ids))
+    for product in products:
+        await seller_stats.stock_changed(product)
+
+@app.get("/api/orders", response_model=List[OrderSummary], response_model_exclude_unset=True)
+async def get_orders(fields: Optional[str] = None, current_user: str = Depends(get_current_user)):
+    return await db.orders.find({
         "$or": [{"buyer_id": current_user}, {"seller_id": current_user}]
-    }).sort("created_at", -1).to_list(100)
+    }, build_projection(OrderSummary, fields)).sort("created_at", -1).to_list(100)
+
+# Seller dashboard
+# One db.seller_stats document per seller, updated with $inc as orders are
+# placed and change status, so the dashboard is a single find_one:
+#   revenue.<YYYY-MM-DD>, revenue_total  - booked sales, reversed on cancel
+#   units.<product_id>                   - units sold
+#   orders.<status>                      - order counts by current status
+#   low_stock.<product_id>               - listings a sale left at or under LOW_STOCK_THRESHOLD
+# Sellers with orders from before the documents existed are rebuilt from
+# db.orders at startup, before serving, since an $inc would otherwise upsert a
+# partial document (and orders.<status> could go negative). Complete
+# documents carry rebuilt: True.
+LOW_STOCK_THRESHOLD = int(os.environ.get('LOW_STOCK_THRESHOLD', '3'))
+ORDER_TRANSITIONS = {
+    "pending": {"paid", "cancelled"},
+    "paid": {"shipped", "cancelled"},
+    "shipped": {"delivered"},
+}  # delivered and cancelled are final
+
+def order_sellers(order: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """An order's line items grouped by seller."""
+    lines: Dict[str, List[Dict[str, Any]]] = {}
+    for line in order["products"]:
+        lines.setdefault(line.get("seller_id") or order["seller_id"], []).append(line)
+    return lines
+
+def sales_update(order: Dict[str, Any], lines: List[Dict[str, Any]], sign: int) -> Dict[str, Any]:
+    day = order["created_at"].strftime("%Y-%m-%d")
+    revenue = sum(line["subtotal"] for line in lines) * sign
+    inc: Dict[str, Any] = {f"revenue.{day}": revenue, "revenue_total": revenue}
+    for line in lines:
+        key = f"units.{line['product_id']}"
+        inc[key] = inc.get(key, 0) + line["quantity"] * sign
+    return inc
+
+class SellerStats:
+    async def _write(self, seller_id: str, update: Dict[str, Any]):
+        if is_account_pseudonym(seller_id):
+            return  # the seller's account was deleted along with its summary
+        update.setdefault("$set", {})["updated_at"] = datetime.utcnow()
+        # After backfill() only a seller's first order or listing creates a document
+        update["$setOnInsert"] = {"rebuilt": True}
+        await db.seller_stats.update_one({"seller_id": seller_id}, update, upsert=True)
+
+    async def order_placed(self, order: Dict[str, Any]):
+        for seller_id, lines in order_sellers(order).items():
+            inc = sales_update(order, lines, 1)
+            inc[f"orders.{order['status']}"] = 1
+            await self._write(seller_id, {"$inc": inc})
+
+    async def order_transitioned(self, order: Dict[str, Any], old: str, new: str):
+        for seller_id, lines in order_sellers(order).items():
+            inc = {f"orders.{old}": -1, f"orders.{new}": 1}
+            if new == "cancelled":
+                for key, value in sales_update(order, lines, -1).items():
+                    inc[key] = inc.get(key, 0) + value
+            await self._write(seller_id, {"$inc": inc})
+
+    async def stock_changed(self, product: Dict[str, Any]):
+        key = f"low_stock.{product['id']}"
+        if product.get("is_active", True) and product["stock_quantity"] <= LOW_STOCK_THRESHOLD:
+            update = {"$set": {key: {"name": product["name"], "stock_quantity": product["stock_quantity"]}}}
+        else:
+            update = {"$unset": {key: ""}}
+        await self._write(product["seller_id"], update)
+
+    async def rebuild(self, seller_id: str, replace: bool = False) -> Dict[str, Any]:
+        """Recompute a seller's summary from db.orders and db.products.
+
+        Fills in a missing document, or with ``replace`` overwrites one that
+        is not yet marked rebuilt.
+        """
+        stats: Dict[str, Any] = {"seller_id": seller_id, "revenue": {}, "revenue_total": 0,
+                                 "units": {}, "orders": {}, "low_stock": {}, "rebuilt": True}
+        cursor = db.orders.find({"$or": [{"seller_id": seller_id}, {"products.seller_id": seller_id}]}, NO_ID)
+        async for order in cursor:
+            lines = order_sellers(order).get(seller_id)
+            if not lines:
+                continue
+            stats["orders"][order["status"]] = stats["orders"].get(order["status"], 0) + 1
+            if order["status"] == "cancelled":
+                continue
+            for key, value in sales_update(order, lines, 1).items():
+                if key == "revenue_total":
+                    stats[key] += value
+                else:
+                    field, sub = key.split(".", 1)
+                    stats[field][sub] = stats[field].get(sub, 0) + value
+        # Alerts are raised by sales, so only listings that have sold qualify
+        low = db.products.find({"id": {"$in": list(stats["units"])}, "is_active": True,
+                                "stock_quantity": {"$lte": LOW_STOCK_THRESHOLD}},
+                               {"_id": 0, "id": 1, "name": 1, "stock_quantity": 1})
+        async for product in low:
+            stats["low_stock"][product["id"]] = {"name": product["name"], "stock_quantity": product["stock_quantity"]}
+        stats["updated_at"] = datetime.utcnow()
+        if replace:
+            try:
+                await db.seller_stats.replace_one({"seller_id": seller_id, "rebuilt": {"$ne": True}}, stats, upsert=True)
+            except DuplicateKeyError:
+                pass  # rebuilt meanwhile by another server
+        else:
+            # Only fill a missing document; a concurrent $inc upsert already holds newer counts
+            await db.seller_stats.update_one({"seller_id": seller_id}, {"$setOnInsert": stats}, upsert=True)
+        return await db.seller_stats.find_one({"seller_id": seller_id}, NO_ID)
+
+    async def backfill(self) -> int:
+        """Rebuild every seller with orders whose document is missing or partial."""
+        sellers = set(await db.orders.distinct("seller_id")) | set(await db.orders.distinct("products.seller_id"))
+        sellers -= set(await db.seller_stats.distinct("seller_id", {"rebuilt": True})) | {None}
+        sellers = {seller_id for seller_id in sellers if not is_account_pseudonym(seller_id)}
+        for seller_id in sellers:
+            await self.rebuild(seller_id, replace=True)
+        return len(sellers)
+
+seller_stats = SellerStats()
+
+@app.on_event("startup")
+async def start_seller_stats():
+    await db.seller_stats.create_index("seller_id", unique=True)
+    await db.orders.create_index("id", unique=True)
+    await db.orders.create_index("products.seller_id")
+    await db.orders.create_index([("buyer_id", 1), ("created_at", -1)])
+    await db.orders.create_index([("seller_id", 1), ("created_at", -1)])
+    rebuilt = await seller_stats.backfill()
+    if rebuilt:
+        logging.info(f"Rebuilt dashboard stats for {rebuilt} sellers")
+
+@app.get("/api/sellers/me/dashboard")
+async def get_seller_dashboard(days: int = 30, current_user: str = Depends(get_current_user)):
+    stats = await db.seller_stats.find_one({"seller_id": current_user}, NO_ID)
+    if stats is None:
+        stats = await seller_stats.rebuild(current_user)
+    days = max(1, min(days, 366))
+    today = datetime.utcnow().date()
+    revenue = stats.get("revenue", {})
+    return {
+        "revenue_total": stats.get("revenue_total", 0),
+        "revenue_by_day": [
+            {"day": key, "revenue": revenue.get(key, 0)}
+            for key in ((today - timedelta(days=n)).isoformat() for n in range(days - 1, -1, -1))
+        ],
+        "units_sold": {product_id: n for product_id, n in stats.get("units", {}).items() if n},
+        "orders_by_status": {status: n for status, n in stats.get("orders", {}).items() if n},
+        "pending_orders": stats.get("orders", {}).get("pending", 0),
+        "low_stock": [{"product_id": pid, **item} for pid, item in stats.get("low_stock", {}).items()],
+        "low_stock_threshold": LOW_STOCK_THRESHOLD,
+        "updated_at": stats.get("updated_at"),
+    }
+
+@app.put("/api/orders/{order_id}/status")
+async def update_order_status(order_id: str, data: dict, current_user: str = Depends(get_current_user)):
+    new_status = data.get("status")
+    order = await db.orders.find_one({"id": order_id}, NO_ID)
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    sellers = order_sellers(order)
+    # Buyers may only cancel before payment; sellers move the order along.
+    # Only settlement marks an order paid.
+    if current_user in sellers:
+        allowed = ORDER_TRANSITIONS.get(order["status"], set()) - {"paid"}
+    elif current_user == order["buyer_id"]:
+        allowed = {"cancelled"} if order["status"] == "pending" else set()
+    else:
+        raise HTTPException(status_code=403, detail="Access denied")
+    if new_status not in allowed:
+        raise HTTPException(status_code=409, detail=f"Cannot move order from {order['status']} to {new_status}")
     
-    return [
-        {
-            **order,
-            "_id": str(order["_id"]) if "_id" in order else None,
-            "created_at": order["created_at"].isoformat() if "created_at" in order else None
-        } for order in orders
-    ]
+    try:
+        order = await transition_order(order, new_status)
+    except OrderTransitionConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    return {"message": "Order status updated", "order": order}
+
+@app.post("/api/orders/{order_id}/pay")
+async def retry_order_payment(order_id: str, current_user: str = Depends(get_current_user)):
+    # A new attempt after the previous one failed or timed out
+    order = await db.orders.find_one({"id": order_id, "buyer_id": current_user}, NO_ID)
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    if order["status"] != "pending":
+        raise HTTPException(status_code=409, detail="Order is not awaiting payment")
+    if await db.payments.find_one({"order_id": order_id, "status": {"$in": ["pending", "initiating", "completed"]}}):
+        raise HTTPException(status_code=409, detail="A payment for this order is already in progress")
+    payment = await open_payment(order)
+    return {"message": "Payment started", "payment": payment}
+
+# Order lifecycle and payment settlement
+# Orders move pending -> paid -> shipped -> delivered, or to cancelled
+# before shipping; every move is a compare-and-set on the current status.
+# Payments move pending -> completed | failed, and completed ->
+# refund_pending -> refunded when a paid order is cancelled. Requests only
+# write a pending payment; the settlement worker talks to the mobile-money
+# provider, so no handler waits on it. A worker claims a payment (initiating,
+# refunding) before calling the provider, and a claim left behind by a crash
+# is taken over after PAYMENT_LEASE_SECONDS; the provider calls are
+# idempotent on the payment, so that retry never charges twice. Outcomes
+# arrive by polling and by provider callbacks, and are applied with the same
+# compare-and-set, so a duplicate outcome is a no-op. A completion arriving
+# after the payment timed out still settles it: the buyer was charged.
+PAYMENT_PROVIDER = os.environ.get('PAYMENT_PROVIDER', 'simulator')
+PAYMENT_POLL_SECONDS = float(os.environ.get('PAYMENT_POLL_SECONDS', '5'))
+PAYMENT_SETTLEMENT_BATCH = int(os.environ.get('PAYMENT_SETTLEMENT_BATCH', '100'))
+PAYMENT_TIMEOUT_SECONDS = float(os.environ.get('PAYMENT_TIMEOUT_SECONDS', '900'))
+PAYMENT_LEASE_SECONDS = float(os.environ.get('PAYMENT_LEASE_SECONDS', '60'))
+PAYMENT_CALLBACK_SECRET = os.environ.get('PAYMENT_CALLBACK_SECRET', SECRET_KEY)
+PAYMENT_SIMULATOR_DELAY_SECONDS = float(os.environ.get('PAYMENT_SIMULATOR_DELAY_SECONDS', '3'))
+PAYMENT_SIMULATOR_FAILURE_RATE = float(os.environ.get('PAYMENT_SIMULATOR_FAILURE_RATE', '0.1'))
+PAYMENT_FINAL_STATUSES = {"completed", "failed"}
+
+metrics.describe("payment_settlements_total", "counter", "Payment outcomes applied, by status and source")
+metrics.describe("payment_duplicate_outcomes_total", "counter", "Payment outcomes ignored because the payment was already settled")
+
+class OrderTransitionConflict(Exception):
+    pass
+
+async def notify_order(order: Dict[str, Any], payment_status: Optional[str] = None):
+    frame = {"type": "order_update", "order_id": order["id"], "status": order["status"]}
+    if payment_status:
+        frame["payment_status"] = payment_status
+    recipients = list(dict.fromkeys([order["buyer_id"], *order_sellers(order)]))
+    await fanout.publish(recipients, OutboundFrame(frame))
+
+async def transition_order(order: Dict[str, Any], new_status: str) -> Dict[str, Any]:
+    """Move an order to new_status if it is still in the status it was read in."""
+    old_status = order["status"]
+    if new_status not in ORDER_TRANSITIONS.get(old_status, set()):
+        raise OrderTransitionConflict(f"Cannot move order from {old_status} to {new_status}")
+    now = datetime.utcnow()
+    result = await db.orders.update_one(
+        {"id": order["id"], "status": old_status},
+        {"$set": {"status": new_status, "updated_at": now}}
+    )
+    if result.matched_count == 0:
+        raise OrderTransitionConflict("Order was changed concurrently")
+    order = {**order, "status": new_status, "updated_at": now}
+    await seller_stats.order_transitioned(order, old_status, new_status)
+    if new_status == "cancelled":
+        await restock(order["products"])
+        if old_status == "paid":
+            await request_refund(order["id"])
+    await notify_order(order)
+    return order
+
+async def transition_payment(payment_id: str, old_status: str, new_status: str, **fields) -> bool:
+    result = await db.payments.update_one(
+        {"id": payment_id, "status": old_status},
+        {"$set": {"status": new_status, "updated_at": datetime.utcnow(), **fields}}
+    )
+    return result.matched_count == 1
+
+async def open_payment(order: Dict[str, Any]) -> Dict[str, Any]:
+    payment = PaymentTransaction(
+        order_id=order["id"],
+        payer_id=order["buyer_id"],
+        payee_id=order["seller_id"],
+        amount=order["total_amount"],
+        payment_method=order["payment_method"],
+        provider=payment_provider.name
+    ).dict()
+    payment.update(next_check_at=payment["created_at"], updated_at=payment["created_at"])
+    await db.payments.insert_one({**payment})
+    settlement.wakeup.set()
+    return payment
+
+async def request_refund(order_id: str):
+    payment = await db.payments.find_one({"order_id": order_id, "status": "completed"}, {"_id": 0, "id": 1})
+    if payment and await transition_payment(payment["id"], "completed", "refund_pending"):
+        settlement.wakeup.set()
+
+class PaymentProviderError(Exception):
+    pass
+
+class SimulatedMobileMoney:
+    """Local stand-in for a mobile-money API (Tigo Pesa, M-Pesa, Airtel Money).
+
+    A payment is approved on the "handset" PAYMENT_SIMULATOR_DELAY_SECONDS
+    after it is initiated, or declined with PAYMENT_SIMULATOR_FAILURE_RATE.
+    Outcomes are kept in db.simulated_payments so every process can poll
+    them, and are also delivered as signed callbacks, the way a real
+    provider pushes them. Initiating the same payment again returns its
+    first reference, like a provider honouring an idempotency key.
+    """
+
+    name = "simulator"
+
+    async def create_indexes(self):
+        await db.simulated_payments.create_index("payment_id", unique=True)
+        await db.simulated_payments.create_index("reference", unique=True)
+
+    async def initiate(self, payment: Dict[str, Any]) -> str:
+        reference = f"SIM-{uuid.uuid4().hex[:12].upper()}"
+        status = "failed" if random.random() < PAYMENT_SIMULATOR_FAILURE_RATE else "completed"
+        try:
+            await db.simulated_payments.insert_one({
+                "payment_id": payment["id"], "reference": reference, "status": status,
+                "ready_at": datetime.utcnow() + timedelta(seconds=PAYMENT_SIMULATOR_DELAY_SECONDS),
+            })
+        except DuplicateKeyError:
+            existing = await db.simulated_payments.find_one({"payment_id": payment["id"]}, {"_id": 0, "reference": 1})
+            return existing["reference"]
+        asyncio.get_running_loop().call_later(PAYMENT_SIMULATOR_DELAY_SECONDS, self._callback, reference, status)
+        return reference
+
+    def _callback(self, reference: str, status: str):
+        body = json.dumps({"reference": reference, "status": status}).encode()
+        settlement.submit(self.parse_callback({"x-signature": self.sign(body)}, body))
+
+    async def poll(self, references: List[str]) -> Dict[str, str]:
+        now = datetime.utcnow()
+        statuses = {reference: "failed" for reference in references}
+        async for outcome in db.simulated_payments.find({"reference": {"$in": references}}, NO_ID):
+            statuses[outcome["reference"]] = outcome["status"] if now >= outcome["ready_at"] else "pending"
+        return statuses
+
+    async def refund(self, reference: str):
+        await db.simulated_payments.update_one({"reference": reference}, {"$set": {"status": "refunded"}})
+
+    @staticmethod
+    def sign(body: bytes) -> str:
+        return hmac.new(PAYMENT_CALLBACK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+
+    def parse_callback(self, headers, body: bytes) -> List[tuple]:
+        if not hmac.compare_digest(headers.get("x-signature", ""), self.sign(body)):
+            raise PaymentProviderError("Bad callback signature")
+        try:
+            event = json.loads(body)
+            return [(str(event["reference"]), str(event["status"]))]
+        except (ValueError, KeyError, TypeError):
+            raise PaymentProviderError("Malformed callback")
+
+PAYMENT_PROVIDERS = {"simulator": SimulatedMobileMoney}
+if PAYMENT_PROVIDER not in PAYMENT_PROVIDERS:
+    raise ValueError(f"PAYMENT_PROVIDER must be one of: {', '.join(PAYMENT_PROVIDERS)}")
+payment_provider = PAYMENT_PROVIDERS[PAYMENT_PROVIDER]()
+
+class PaymentSettlementWorker:
+    """Initiates, polls, settles and refunds order payments in batches.
+
+    Several processes may run one each: every state change is a
+    compare-and-set on the payment, so they never apply an outcome twice.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.callbacks: asyncio.Queue = asyncio.Queue()
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def submit(self, events: List[tuple]):
+        """Queue (reference, status) outcomes from a callback; never blocks the caller."""
+        for event in events:
+            self.callbacks.put_nowait(event)
+        self.wakeup.set()
+
+    async def settle(self, reference: str, status: str, source: str):
+        if status not in PAYMENT_FINAL_STATUSES:
+            return
+        payment = await db.payments.find_one({"reference": reference}, NO_ID)
+        fields = {"completed_at": datetime.utcnow()} if status == "completed" else {}
+        settled = payment is not None and await transition_payment(payment["id"], "pending", status, **fields)
+        if not settled and payment is not None and status == "completed":
+            # Completed after it timed out: the buyer was charged, so settle it like
+            # any completion (the order is paid, or refunded if it moved on)
+            settled = await transition_payment(payment["id"], "failed", status, **fields)
+        if not settled:
+            metrics.inc("payment_duplicate_outcomes_total", {"source": source})
+            return
+        metrics.inc("payment_settlements_total", {"status": status, "source": source})
+        order = await db.orders.find_one({"id": payment["order_id"]}, NO_ID)
+        if order is None:
+            return
+        if status == "completed":
+            try:
+                order = await transition_order(order, "paid")
+                await db.orders.update_one({"id": order["id"]}, {"$set": {"payment_reference": reference}})
+                return
+            except OrderTransitionConflict:
+                # Cancelled while the buyer was paying: give the money back
+                if await transition_payment(payment["id"], "completed", "refund_pending"):
+                    self.wakeup.set()
+        await notify_order(order, payment_status=status)
+
+    async def _drain_callbacks(self):
+        for _ in range(PAYMENT_SETTLEMENT_BATCH):
+            try:
+                reference, status = self.callbacks.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await self.settle(reference, status, "callback")
+
+    async def _claim(self, status: str, claimed: str, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Move payments in ``status``, or whose ``claimed`` lease ran out, to ``claimed``.
+
+        Returns the payments this worker won, each with its ``since`` stamp.
+        """
+        now = datetime.utcnow()
+        since = f"{claimed}_since"
+        payments = await db.payments.find({**query, "$or": [
+            {"status": status},
+            {"status": claimed, since: {"$lt": now - timedelta(seconds=PAYMENT_LEASE_SECONDS)}},
+        ]}, NO_ID).limit(PAYMENT_SETTLEMENT_BATCH).to_list(PAYMENT_SETTLEMENT_BATCH)
+        won = []
+        for payment in payments:
+            result = await db.payments.update_one(
+                {"id": payment["id"], "status": payment["status"], since: payment.get(since)},
+                {"$set": {"status": claimed, since: now, "updated_at": now}}
+            )
+            if result.modified_count:
+                won.append({**payment, "status": claimed, since: now})
+        return won
+
+    async def _initiate(self):
+        payments = await self._claim("pending", "initiating", {"provider": self.provider.name, "reference": None})
+        for payment in payments:
+            reference = await self.provider.initiate(payment)
+            await db.payments.update_one(
+                {"id": payment["id"], "status": "initiating", "initiating_since": payment["initiating_since"]},
+                {"$set": {"status": "pending", "reference": reference, "updated_at": datetime.utcnow(),
+                          "next_check_at": datetime.utcnow() + timedelta(seconds=PAYMENT_POLL_SECONDS)}}
+            )
+
+    async def _poll(self):
+        now = datetime.utcnow()
+        payments = await db.payments.find(
+            {"status": "pending", "reference": {"$ne": None}, "next_check_at": {"$lte": now}},
+            {"_id": 0, "id": 1, "reference": 1, "created_at": 1}
+        ).limit(PAYMENT_SETTLEMENT_BATCH).to_list(PAYMENT_SETTLEMENT_BATCH)
+        if not payments:
+            return
+        statuses = await self.provider.poll([p["reference"] for p in payments])
+        waiting = []
+        for payment in payments:
+            status = statuses.get(payment["reference"], "pending")
+            if status == "pending" and (now - payment["created_at"]).total_seconds() > PAYMENT_TIMEOUT_SECONDS:
+                status = "failed"
+            if status in PAYMENT_FINAL_STATUSES:
+                await self.settle(payment["reference"], status, "poll")
+            else:
+                waiting.append(payment["id"])
+        if waiting:
+            await db.payments.update_many(
+                {"id": {"$in": waiting}},
+                {"$set": {"next_check_at": now + timedelta(seconds=PAYMENT_POLL_SECONDS)}}
+            )
+
+    async def _refund(self):
+        payments = await self._claim("refund_pending", "refunding", {"provider": self.provider.name})
+        for payment in payments:
+            await self.provider.refund(payment["reference"])
+            await db.payments.update_one(
+                {"id": payment["id"], "status": "refunding", "refunding_since": payment["refunding_since"]},
+                {"$set": {"status": "refunded", "updated_at": datetime.utcnow()}}
+            )
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), PAYMENT_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            for step in (self._drain_callbacks, self._initiate, self._poll, self._refund):
+                try:
+                    await step()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.error(f"Payment settlement step {step.__name__} failed: {e}")
+            if not self.callbacks.empty():
+                self.wakeup.set()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+settlement = PaymentSettlementWorker(payment_provider)
+
+@app.on_event("startup")
+async def start_settlement_worker():
+    await db.payments.create_index("id", unique=True)
+    await db.payments.create_index("order_id")
+    await db.payments.create_index("reference")
+    await db.payments.create_index([("status", 1), ("next_check_at", 1)])
+    await payment_provider.create_indexes()
+    settlement.start()
+
+@app.on_event("shutdown")
+async def stop_settlement_worker():
+    await settlement.stop()
+
+@app.post("/api/payments/callback/{provider}")
+async def payment_callback(provider: str, request: Request):
+    # Acknowledge right away; the worker applies the outcome
+    if provider != payment_provider.name:
+        raise HTTPException(status_code=404, detail="Unknown payment provider")
+    try:
+        events = payment_provider.parse_callback(request.headers, await request.body())
+    except PaymentProviderError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    settlement.submit(events)
+    return {"status": "accepted"}
+
+# Media attachments
+MEDIA_STORAGE = os.environ.get('MEDIA_STORAGE', 'disk')  # disk, gridfs
+MEDIA_ROOT = Path(os.environ.get('MEDIA_ROOT', str(ROOT_DIR / 'media')))
+MEDIA_PUBLIC_URL = os.environ.get('MEDIA_PUBLIC_URL', '').rstrip('/')
+MEDIA_CHUNK_SIZE = int(os.environ.get('MEDIA_CHUNK_SIZE', str(1024 * 1024)))
+MEDIA_MAX_BYTES = int(os.environ.get('MEDIA_MAX_BYTES', str(25 * 1024 * 1024)))
+MEDIA_UPLOAD_TTL_HOURS = float(os.environ.get('MEDIA_UPLOAD_TTL_HOURS', '24'))
+MEDIA_THUMBNAIL_WORKERS = int(os.environ.get('MEDIA_THUMBNAIL_WORKERS', '2'))  # 0 renders on a thread
+MEDIA_SWEEP_INTERVAL_SECONDS = 3600
+MEDIA_IO_BLOCK = 256 * 1024
+
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+IMAGE_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp"}
+AUDIO_TYPES = {"audio/webm", "audio/ogg", "audio/mpeg", "audio/mp4"}
+
+# Accepted content types per purpose, and the longest side of each thumbnail rendered for images
+MEDIA_PURPOSES = {
+    "avatar": (IMAGE_TYPES, (96, 256)),
+    "product": (IMAGE_TYPES, (320, 960)),
+    "chat": (IMAGE_TYPES | AUDIO_TYPES, (320, 1280)),
+}
+
+IMAGE_SIGNATURES = {
+    "image/jpeg": (b"\xff\xd8\xff",),
+    "image/png": (b"\x89PNG\r\n\x1a\n",),
+    "image/gif": (b"GIF87a", b"GIF89a"),
+}
+
+def sniff_image(head: bytes, content_type: str) -> bool:
+    """Check the leading bytes match the declared image type, so nothing else is served as one."""
+    if content_type == "image/webp":
+        return head[:4] == b"RIFF" and head[8:12] == b"WEBP"
+    return head.startswith(IMAGE_SIGNATURES.get(content_type, ()))
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(MEDIA_IO_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def pwrite_all(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+def media_url(media_id: str, variant: Optional[str] = None) -> str:
+    url = f"{MEDIA_PUBLIC_URL}/api/media/{media_id}"
+    return f"{url}?variant={variant}" if variant else url
+
+def media_view(doc: dict) -> dict:
+    return {
+        "id": doc["id"],
+        "content_type": doc["content_type"],
+        "size": doc["size"],
+        "width": doc.get("width"),
+        "height": doc.get("height"),
+        "url": media_url(doc["id"]),
+        "thumbnails": {size: media_url(doc["id"], size) for size in doc.get("variants", {})},
+    }
+
+class DiskMediaStore:
+    """Blobs as files under MEDIA_ROOT/blobs, named by content hash."""
+
+    # Same content, same file: a concurrent duplicate must not delete the winner's blob
+    content_addressed = True
+
+    def __init__(self, root: Path):
+        self.root = root / "blobs"
+
+    def path(self, locator: str) -> Path:
+        return self.root / locator[:2] / locator
+
+    async def put(self, source: Path, key: str) -> str:
+        """Move ``source`` into the store; it is consumed either way."""
+        def move():
+            dest = self.path(key)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(source, dest)
+        await asyncio.to_thread(move)
+        return key
+
+    async def delete(self, locator: str):
+        await asyncio.to_thread(self.path(locator).unlink, missing_ok=True)
+
+    async def iter_range(self, locator: str, start: int, end: int):
+        fd = await asyncio.to_thread(os.open, self.path(locator), os.O_RDONLY)
+        try:
+            offset = start
+            while offset <= end:
+                block = await asyncio.to_thread(os.pread, fd, min(MEDIA_IO_BLOCK, end - offset + 1), offset)
+                if not block:
+                    break
+                offset += len(block)
+                yield block
+        finally:
+            os.close(fd)
+
+class GridFSMediaStore:
+    """Blobs in a GridFS bucket; the locator is the GridFS file id."""
+
+    content_addressed = False
+
+    def __init__(self, bucket_name: str = "media_fs"):
+        self.bucket_name = bucket_name
+
+    @property
+    def bucket(self) -> AsyncIOMotorGridFSBucket:
+        return AsyncIOMotorGridFSBucket(db, bucket_name=self.bucket_name)
+
+    async def put(self, source: Path, key: str) -> str:
+        file_id = ObjectId()
+        try:
+            # Motor runs the upload on its executor, so the file is read off the event loop
+            with open(source, "rb") as f:
+                await self.bucket.upload_from_stream_with_id(file_id, key, f)
+        finally:
+            await asyncio.to_thread(source.unlink, missing_ok=True)
+        return str(file_id)
+
+    async def delete(self, locator: str):
+        try:
+            await self.bucket.delete(ObjectId(locator))
+        except gridfs.errors.NoFile:
+            pass
+
+    async def iter_range(self, locator: str, start: int, end: int):
+        stream = await self.bucket.open_download_stream(ObjectId(locator))
+        try:
+            stream.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = await stream.read(min(MEDIA_IO_BLOCK, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+        finally:
+            stream.close()
+
+class MediaResponse(StreamingResponse):
+    """Streams one byte range of a stored blob without loading it into memory.
+
+    Disk blobs are handed to the server with the ASGI zero-copy send extension
+    when it is offered (the server then uses sendfile); otherwise blocks are
+    read with pread off the event loop and streamed.
+    """
+
+    def __init__(self, store, locator: str, start: int, end: int, **kwargs):
+        super().__init__(store.iter_range(locator, start, end), **kwargs)
+        self.store = store
+        self.locator = locator
+        self.start = start
+        self.end = end
+
+    async def __call__(self, scope, receive, send):
+        if "http.response.zerocopysend" in scope.get("extensions", {}) and isinstance(self.store, DiskMediaStore):
+            with open(self.store.path(self.locator), "rb") as f:
+                await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": f,
+                    "offset": self.start,
+                    "count": self.end - self.start + 1,
+                })
+            return
+        await super().__call__(scope, receive, send)
+
+def parse_range(header: Optional[str], size: int):
+    """(start, end) for a single-range ``Range`` header, None to send the whole blob.
+
+    Raises ValueError when the range cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0:
+                raise ValueError(header)
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end
+
+class MediaService:
+    """Resumable uploads, content-hash dedup and thumbnails for chat, product and avatar images.
+
+    Chunks are written at their offset into a staging file under MEDIA_ROOT/tmp,
+    so an interrupted upload resumes from the ``received`` count it reports.
+    On completion the file is hashed; content already stored only gains an
+    owner, new content is thumbnailed in a process pool and moved into the
+    configured store. Abandoned uploads are swept after MEDIA_UPLOAD_TTL_HOURS.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.staging = MEDIA_ROOT / "tmp"
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def staged(self, name: str) -> Path:
+        return self.staging / name
+
+    async def create_upload(self, user_id: str, data: CreateUpload) -> dict:
+        if data.purpose not in MEDIA_PURPOSES:
+            raise HTTPException(status_code=400, detail="Unknown upload purpose")
+        if data.content_type not in MEDIA_PURPOSES[data.purpose][0]:
+            raise HTTPException(status_code=415, detail="Unsupported content type")
+        if data.size <= 0 or data.size > MEDIA_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"Uploads are limited to {MEDIA_MAX_BYTES} bytes")
+
+        now = datetime.utcnow()
+        upload = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "filename": data.filename[:255],
+            "content_type": data.content_type,
+            "purpose": data.purpose,
+            "size": data.size,
+            "received": 0,
+            "status": "open",
+            "created_at": now,
+            "expires_at": now + timedelta(hours=MEDIA_UPLOAD_TTL_HOURS),
+        }
+        await asyncio.to_thread(self.staged(upload["id"]).touch)
+        await db.media_uploads.insert_one(dict(upload))
+        return upload
+
+    async def write_chunk(self, upload: dict, offset: int, request: Request) -> int:
+        if upload["status"] != "open":
+            raise HTTPException(status_code=409, detail="Upload is no longer open")
+        if offset != upload["received"]:
+            raise HTTPException(status_code=409, detail={"message": "Unexpected offset", "received": upload["received"]})
+
+        fd = await asyncio.to_thread(os.open, self.staged(upload["id"]), os.O_WRONLY)
+        written = 0
+        pending = bytearray()
+        try:
+            async for piece in request.stream():
+                pending += piece
+                if offset + written + len(pending) > upload["size"]:
+                    raise HTTPException(status_code=413, detail="Chunk runs past the declared size")
+                if len(pending) >= MEDIA_IO_BLOCK:
+                    await asyncio.to_thread(pwrite_all, fd, bytes(pending), offset + written)
+                    written += len(pending)
+                    pending.clear()
+            if pending:
+                await asyncio.to_thread(pwrite_all, fd, bytes(pending), offset + written)
+                written += len(pending)
+        finally:
+            os.close(fd)
+
+        # Only advance from the offset this chunk was written at; a racing chunk loses
+        result = await db.media_uploads.update_one(
+            {"id": upload["id"], "status": "open", "received": offset},
+            {"$set": {"received": offset + written}}
+        )
+        if result.matched_count == 0:
+            raise HTTPException(status_code=409, detail="Upload changed concurrently")
+        metrics.inc("media_upload_bytes_total", {"purpose": upload["purpose"]}, written)
+        return offset + written
+
+    async def _render(self, upload_id: str, source: Path, sizes: List[int]) -> Optional[dict]:
+        targets = [(size, str(self.staged(f"{upload_id}_{size}"))) for size in sizes]
+        started = time.perf_counter()
+        if MEDIA_THUMBNAIL_WORKERS > 0:
+            if self.pool is None:
+                # Spawned workers import only media_worker, never the app or its Mongo client
+                self.pool = ProcessPoolExecutor(MEDIA_THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+            rendered = await asyncio.get_running_loop().run_in_executor(
+                self.pool, media_worker.render_variants, str(source), targets
+            )
+        else:
+            rendered = await asyncio.to_thread(media_worker.render_variants, str(source), targets)
+        metrics.observe("media_thumbnail_seconds", time.perf_counter() - started)
+        return rendered
+
+    async def _store_variants(self, upload_id: str, media_id: str, rendered: dict) -> dict:
+        variants = {}
+        for size, dims in rendered["variants"].items():
+            source = self.staged(f"{upload_id}_{size}")
+            length = (await asyncio.to_thread(source.stat)).st_size
+            locator = await self.store.put(source, f"{media_id}_{size}")
+            variants[size] = {"locator": locator, "size": length, "content_type": "image/jpeg", **dims}
+        return variants
+
+    async def complete(self, upload: dict) -> dict:
+        if upload["status"] == "complete":
+            return media_view(await db.media.find_one({"id": upload["media_id"]}, NO_ID))
+        if upload["received"] != upload["size"]:
+            raise HTTPException(status_code=409, detail={"message": "Upload incomplete", "received": upload["received"]})
+        claimed = await db.media_uploads.update_one(
+            {"id": upload["id"], "status": "open"}, {"$set": {"status": "processing"}}
+        )
+        if claimed.matched_count == 0:
+            raise HTTPException(status_code=409, detail="Upload is already being completed")
+
+        source = self.staged(upload["id"])
+        try:
+            doc = await self._ingest(upload, source)
+        except Exception:
+            # The staging file is gone; the client starts a new upload
+            await db.media_uploads.update_one({"id": upload["id"]}, {"$set": {"status": "failed"}})
+            raise
+        finally:
+            await asyncio.to_thread(source.unlink, missing_ok=True)
+            for size in MEDIA_PURPOSES[upload["purpose"]][1]:
+                await asyncio.to_thread(self.staged(f"{upload['id']}_{size}").unlink, missing_ok=True)
+
+        await db.media_uploads.update_one(
+            {"id": upload["id"]}, {"$set": {"status": "complete", "media_id": doc["id"]}}
+        )
+        return media_view(doc)
+
+    async def _ingest(self, upload: dict, source: Path) -> dict:
+        user_id = upload["user_id"]
+        media_id = await asyncio.to_thread(file_sha256, source)
+        is_image = upload["content_type"] in IMAGE_TYPES
+        existing = await db.media.find_one({"id": media_id}, NO_ID)
+
+        if existing is None and is_image:
+            with open(source, "rb") as f:
+                head = f.read(16)
+            if not sniff_image(head, upload["content_type"]):
+                raise HTTPException(status_code=415, detail="File content does not match its content type")
+
+        # A purpose may want thumbnail sizes an earlier upload of the same image did not
+        have = (existing or {}).get("variants", {})
+        missing = [size for size in MEDIA_PURPOSES[upload["purpose"]][1] if str(size) not in have] if is_image else []
+        rendered = None
+        if missing and PILLOW_AVAILABLE:
+            rendered = await self._render(upload["id"], source, missing)
+            if rendered is None and existing is None:
+                raise HTTPException(status_code=415, detail="Image could not be decoded")
+
+        if existing is not None:
+            metrics.inc("media_dedup_hits_total")
+            update: Dict[str, Any] = {"$addToSet": {"owners": user_id}}
+            if rendered:
+                variants = await self._store_variants(upload["id"], media_id, rendered)
+                update["$set"] = {f"variants.{size}": variant for size, variant in variants.items()}
+            await db.media.update_one({"id": media_id}, update)
+            return await db.media.find_one({"id": media_id}, NO_ID)
+
+        doc = {
+            "id": media_id,
+            "content_type": upload["content_type"],
+            "size": upload["size"],
+            "storage": MEDIA_STORAGE,
+            "width": rendered["width"] if rendered else None,
+            "height": rendered["height"] if rendered else None,
+            "variants": await self._store_variants(upload["id"], media_id, rendered) if rendered else {},
+            "owners": [user_id],
+            "public": False,  # set once used as a product image or avatar
+            "chats": [],  # chats it was sent to; their members may download it
+            "created_at": datetime.utcnow(),
+        }
+        doc["locator"] = await self.store.put(source, media_id)
+        try:
+            await db.media.insert_one(dict(doc))
+        except DuplicateKeyError:
+            # The same content finished uploading concurrently; keep theirs
+            metrics.inc("media_dedup_hits_total")
+            if not self.store.content_addressed:
+                for locator in [doc["locator"]] + [v["locator"] for v in doc["variants"].values()]:
+                    await self.store.delete(locator)
+            await db.media.update_one({"id": media_id}, {"$addToSet": {"owners": user_id}})
+            return await db.media.find_one({"id": media_id}, NO_ID)
+        return doc
+
+    async def resolve(self, media_ids: List[str], owner: str, publish: bool = False) -> List[dict]:
+        """Media documents for ``media_ids`` in the given order, all uploaded by ``owner``.
+
+        ``publish`` makes them downloadable by anyone, for product images and avatars.
+        """
+        if not media_ids:
+            return []
+        docs = await db.media.find({"id": {"$in": media_ids}, "owners": owner}, NO_ID).to_list(len(media_ids))
+        by_id = {doc["id"]: doc for doc in docs}
+        if len(by_id) != len(set(media_ids)):
+            raise HTTPException(status_code=400, detail="Unknown media")
+        if publish:
+            await db.media.update_many({"id": {"$in": media_ids}}, {"$set": {"public": True}})
+        return [by_id[media_id] for media_id in media_ids]
+
+    async def attach(self, media_id: str, owner: str, chat_id: str) -> Optional[dict]:
+        """Share ``owner``'s upload with a chat; None unless they uploaded it."""
+        return await db.media.find_one_and_update(
+            {"id": media_id, "owners": owner}, {"$addToSet": {"chats": chat_id}}, projection=NO_ID
+        )
+
+    async def can_read(self, doc: dict, user_id: Optional[str]) -> bool:
+        if doc.get("public"):
+            return True
+        if user_id is None:
+            return False
+        if user_id in doc.get("owners", []):
+            return True
+        for chat_id in doc.get("chats", []):
+            audience = await chat_audiences.get(chat_id)
+            if audience is not None and user_id in audience.members:
+                return True
+        return False
+
+    async def backfill_access(self):
+        """Give media stored before access control its public flag.
+
+        Uploads referenced by a product or an avatar are public; the rest are
+        readable by their uploaders only.
+        """
+        if not await db.media.find_one({"public": {"$exists": False}}, {"_id": 1}):
+            return
+        url = re.compile(r"/api/media/([0-9a-f]{64})")
+        referenced = set()
+        async for product in db.products.find({"images": {"$regex": "/api/media/"}}, {"_id": 0, "images": 1}):
+            referenced.update(m for image in product["images"] for m in url.findall(image))
+        async for user in db.users.find({"avatar_url": {"$regex": "/api/media/"}}, {"_id": 0, "avatar_url": 1}):
+            referenced.update(url.findall(user["avatar_url"]))
+        await db.media.update_many(
+            {"id": {"$in": list(referenced)}, "public": {"$exists": False}}, {"$set": {"public": True, "chats": []}}
+        )
+        await db.media.update_many({"public": {"$exists": False}}, {"$set": {"public": False, "chats": []}})
+
+    async def disown(self, ids: List[Any], user_id: str):
+        """Drop ``user_id`` from the owners of the given media; blobs nobody owns are removed."""
+        await db.media.update_many({"_id": {"$in": ids}}, {"$pull": {"owners": user_id}})
+        orphans = await db.media.find({"_id": {"$in": ids}, "owners": {"$size": 0}}).to_list(len(ids))
+        for doc in orphans:
+            for locator in [doc["locator"]] + [v["locator"] for v in doc.get("variants", {}).values()]:
+                await self.store.delete(locator)
+        await db.media.delete_many({"_id": {"$in": [doc["_id"] for doc in orphans]}})
+
+    async def sweep(self) -> int:
+        """Drop expired upload sessions, with the staging files of those never completed."""
+        expired = await db.media_uploads.find(
+            {"expires_at": {"$lt": datetime.utcnow()}}, {"_id": 0, "id": 1}
+        ).to_list(1000)
+        for upload in expired:
+            await asyncio.to_thread(self.staged(upload["id"]).unlink, missing_ok=True)
+        if expired:
+            await db.media_uploads.delete_many({"id": {"$in": [upload["id"] for upload in expired]}})
+        return len(expired)
+
+    async def run(self):
+        while True:
+            try:
+                swept = await self.sweep()
+                if swept:
+                    logging.info(f"Swept {swept} abandoned media uploads")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Media upload sweep failed: {e}")
+            await asyncio.sleep(MEDIA_SWEEP_INTERVAL_SECONDS)
+
+    def start(self):
+        self.staging.mkdir(parents=True, exist_ok=True)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+media_service = MediaService(GridFSMediaStore() if MEDIA_STORAGE == "gridfs" else DiskMediaStore(MEDIA_ROOT))
+
+@app.on_event("startup")
+async def start_media_service():
+    await db.media.create_index("id", unique=True)
+    await db.media.create_index("owners")
+    await media_service.backfill_access()
+    await db.media_uploads.create_index("id", unique=True)
+    await db.media_uploads.create_index("user_id")
+    await db.media_uploads.create_index("expires_at")
+    media_service.start()
+
+@app.on_event("shutdown")
+async def stop_media_service():
+    await media_service.stop()
+
+async def get_upload(upload_id: str, user_id: str) -> dict:
+    upload = await db.media_uploads.find_one({"id": upload_id, "user_id": user_id}, NO_ID)
+    if not upload:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload
+
+def upload_view(upload: dict) -> dict:
+    return {
+        "upload_id": upload["id"],
+        "status": upload["status"],
+        "size": upload["size"],
+        "received": upload["received"],
+        "chunk_size": MEDIA_CHUNK_SIZE,
+        "expires_at": upload["expires_at"],
+    }
+
+# Media endpoints
+@app.post("/api/media/uploads", status_code=201, dependencies=[rate_limit("upload")])
+async def create_media_upload(upload_data: CreateUpload, current_user: str = Depends(get_current_user)):
+    upload = await media_service.create_upload(current_user, upload_data)
+    return upload_view(upload)
+
+@app.get("/api/media/uploads/{upload_id}")
+async def get_media_upload(upload_id: str, current_user: str = Depends(get_current_user)):
+    # Clients resume an interrupted upload from the returned "received" offset
+    return upload_view(await get_upload(upload_id, current_user))
+
+@app.put("/api/media/uploads/{upload_id}")
+async def put_media_chunk(upload_id: str, offset: int, request: Request,
+                          current_user: str = Depends(get_current_user)):
+    upload = await get_upload(upload_id, current_user)
+    received = await media_service.write_chunk(upload, offset, request)
+    return {"upload_id": upload_id, "received": received, "size": upload["size"]}
+
+@app.post("/api/media/uploads/{upload_id}/complete")
+async def complete_media_upload(upload_id: str, current_user: str = Depends(get_current_user)):
+    upload = await get_upload(upload_id, current_user)
+    return await media_service.complete(upload)
+
+@app.get("/api/media/{media_id}")
+async def download_media(media_id: str, request: Request, variant: Optional[str] = None,
+                         current_user: Optional[str] = Depends(get_optional_user)):
+    doc = await db.media.find_one({"id": media_id}, NO_ID)
+    # Chat attachments are for the uploader and the chats they were sent to
+    if not doc or not await media_service.can_read(doc, current_user):
+        raise HTTPException(status_code=404, detail="Media not found")
+    blob = doc
+    if variant is not None:
+        blob = doc.get("variants", {}).get(variant)
+        if blob is None:
+            raise HTTPException(status_code=404, detail="Variant not found")
+
+    # Content-addressed, so a URL's bytes never change
+    etag = f'"{media_id}-{variant or "original"}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"{'public' if doc.get('public') else 'private'}, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+        "X-Content-Type-Options": "nosniff",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    size = blob["size"]
+    try:
+        byte_range = parse_range(request.headers.get("range"), size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    start, end = byte_range or (0, size - 1)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return MediaResponse(
+        media_service.store, blob["locator"], start, end,
+        status_code=206 if byte_range else 200,
+        media_type=blob["content_type"],
+        headers=headers,
+    )
+
+# Account deletion jobs
+ACCOUNT_DELETION_BATCH_SIZE = int(os.environ.get('ACCOUNT_DELETION_BATCH_SIZE', '500'))
+ACCOUNT_DELETION_BATCH_PAUSE_SECONDS = float(os.environ.get('ACCOUNT_DELETION_BATCH_PAUSE_SECONDS', '0.1'))
+ACCOUNT_DELETION_LEASE_SECONDS = 60
+ACCOUNT_DELETION_POLL_SECONDS = 30
+ACCOUNT_DELETION_MAX_ATTEMPTS = 5
+
+# Purged in this order; the job records the step name so it can resume after a restart.
+# "leave" removes the user from shared documents instead of deleting them and
+# "membership" drops group memberships, keeping member counts in step;
+# "comments" does the same for post comment and reply counts;
+# "bucket" and "archive" strip the user's messages out of bucket documents and
+# compressed archive segments; "disown" releases the user's uploads, removing
+# blobs nobody else uploaded; "pseudonymise" replaces the user id in the
+# PSEUDONYMISED_FIELDS of documents that must outlive the account, such as
+# ledger postings, whose double entries have to keep balancing, and orders and
+# payments, which are the other party's history too.
+ACCOUNT_PURGE_STEPS = [
+    ("messages", lambda uid: {"sender_id": uid}, "delete"),
+    ("message_buckets", lambda uid: {"senders": uid}, "bucket"),
+    ("message_archive", lambda uid: {"senders": uid}, "archive"),
+    ("message_receipts", lambda uid: {"sender_id": uid}, "delete"),
+    ("comments", lambda uid: {"author_id": uid}, "comments"),
+    ("news", lambda uid: {"author_id": uid}, "delete"),
+    ("notifications", lambda uid: {"$or": [{"user_id": uid}, {"data.from_user_id": uid}]}, "delete"),
+    ("friends", lambda uid: {"$or": [{"user_id": uid}, {"friend_id": uid}]}, "delete"),
+    ("cart", lambda uid: {"user_id": uid}, "delete"),
+    ("products", lambda uid: {"seller_id": uid}, "delete"),
+    ("media", lambda uid: {"owners": uid}, "disown"),
+    ("orders", lambda uid: {"$or": [{"buyer_id": uid}, {"seller_id": uid}, {"products.seller_id": uid}]}, "pseudonymise"),
+    ("seller_stats", lambda uid: {"seller_id": uid}, "delete"),
+    ("payments", lambda uid: {"$or": [{"from_user": uid}, {"to_user": uid}, {"payer_id": uid}, {"payee_id": uid}]}, "pseudonymise"),
+    ("ledger_entries", lambda uid: {"$or": [{"account": uid}, {"counterparty": uid}]}, "pseudonymise"),
+    ("balances", lambda uid: {"user_id": uid}, "pseudonymise"),
+    ("chats", lambda uid: {"participants": uid}, "leave"),
+    ("chat_members", lambda uid: {"user_id": uid}, "membership"),
+    ("push_subscriptions", lambda uid: {"user_id": uid}, "delete"),
+    ("outbox", lambda uid: {"user_id": uid}, "delete"),
+    ("privacy_settings", lambda uid: {"user_id": uid}, "delete"),
+    ("password_resets", lambda uid: {"user_id": uid}, "delete"),
+    ("users", lambda uid: {"id": uid}, "delete"),
+]
+# A dotted field names a key inside an array of subdocuments, e.g. order lines
+PSEUDONYMISED_FIELDS = {
+    "ledger_entries": ("account", "counterparty"),
+    "balances": ("user_id",),
+    "orders": ("buyer_id", "seller_id", "products.seller_id"),
+    "payments": ("from_user", "to_user", "payer_id", "payee_id"),
+}
+# Personal details kept next to a pseudonymised field, overwritten with it
+PSEUDONYMISED_DETAILS = {
+    ("orders", "buyer_id"): {"buyer_name": "Deleted user", "shipping_address": {}},
+    ("orders", "seller_id"): {"seller_name": "Deleted user"},
+}
+ACCOUNT_PSEUDONYM_PREFIX = "deleted:"
+
+def account_pseudonym(job: dict) -> str:
+    # Stable per job, so a resumed job keeps using the same one
+    return f"{ACCOUNT_PSEUDONYM_PREFIX}{job['id']}"
+
+def is_account_pseudonym(user_id: Optional[str]) -> bool:
+    return bool(user_id) and user_id.startswith(ACCOUNT_PSEUDONYM_PREFIX)
+
+async def pseudonymise(collection: str, ids: List[Any], user_id: str, pseudonym: str):
+    """Replace user_id with pseudonym in the PSEUDONYMISED_FIELDS of these documents."""
+    for field in PSEUDONYMISED_FIELDS[collection]:
+        if "." in field:
+            array, key = field.split(".", 1)
+            cursor = db[collection].find({"_id": {"$in": ids}, field: user_id}, {array: 1})
+            async for doc in cursor:
+                entries = [{**entry, key: pseudonym} if entry.get(key) == user_id else entry for entry in doc[array]]
+                await db[collection].update_one({"_id": doc["_id"]}, {"$set": {array: entries}})
+        else:
+            details = PSEUDONYMISED_DETAILS.get((collection, field), {})
+            await db[collection].update_many({"_id": {"$in": ids}, field: user_id},
+                                             {"$set": {field: pseudonym, **details}})
+
+class AccountDeletionWorker:
+    """Purges a deleted account's data in throttled chunks outside the request.
+
+    Jobs live in db.deletion_jobs and are claimed with a lease, so a job left
+    running by a crashed or restarted process is picked up again once its
+    lease expires, continuing from the last recorded step.
+    """
+
+    def __init__(self):
+        self.worker_id = str(uuid.uuid4())
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    async def enqueue(self, user_id: str) -> dict:
+        existing = await db.deletion_jobs.find_one(
+            {"user_id": user_id, "status": {"$in": ["pending", "running"]}}, NO_ID
+        )
+        if existing:
+            return existing
+        now = datetime.utcnow()
+        job = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "status": "pending",
+            "step": ACCOUNT_PURGE_STEPS[0][0],
+            "purged": {},
+            "attempts": 0,
+            "error": None,
+            "lease_until": datetime(1970, 1, 1),
+            "created_at": now,
+            "updated_at": now,
+            "completed_at": None,
+        }
+        await db.deletion_jobs.insert_one({**job})
+        self.wakeup.set()
+        return job
+
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        job = await db.deletion_jobs.find_one_and_update(
+            {
+                "status": {"$in": ["pending", "running"]},
+                "lease_until": {"$lt": now},
+                "attempts": {"$lt": ACCOUNT_DELETION_MAX_ATTEMPTS},
+            },
+            {
+                "$set": {
+                    "status": "running",
+                    "worker_id": self.worker_id,
+                    "lease_until": now + timedelta(seconds=ACCOUNT_DELETION_LEASE_SECONDS),
+                    "updated_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            projection=NO_ID,
+            sort=[("created_at", 1)],
+        )
+        if job is not None:
+            # The pre-image is returned; mirror the claim locally
+            job.update(status="running", attempts=job.get("attempts", 0) + 1)
+        return job
+
+    async def _checkpoint(self, job: dict, update: dict) -> bool:
+        now = datetime.utcnow()
+        update.setdefault("$set", {}).update({
+            "lease_until": now + timedelta(seconds=ACCOUNT_DELETION_LEASE_SECONDS),
+            "updated_at": now,
+        })
+        result = await db.deletion_jobs.update_one({"id": job["id"], "worker_id": self.worker_id}, update)
+        # Losing the lease means another worker took the job over
+        return result.matched_count == 1
+
+    async def _process(self, job: dict):
+        user_id = job["user_id"]
+        step_names = [name for name, _, _ in ACCOUNT_PURGE_STEPS]
+        start = step_names.index(job["step"]) if job.get("step") in step_names else 0
+
+        for collection, build_filter, action in ACCOUNT_PURGE_STEPS[start:]:
+            query = build_filter(user_id)
+            if not await self._checkpoint(job, {"$set": {"step": collection}}):
+                return
+            while True:
+                batch = await db[collection].find(query, {"_id": 1}).limit(ACCOUNT_DELETION_BATCH_SIZE).to_list(ACCOUNT_DELETION_BATCH_SIZE)
+                if not batch:
+                    break
+                ids = [doc["_id"] for doc in batch]
+                if action == "bucket":
+                    await bucketed_messages.remove_sender(ids, user_id)
+                    purged = len(ids)
+                elif action == "archive":
+                    await message_archiver.remove_sender(ids, user_id)
+                    purged = len(ids)
+                elif action == "disown":
+                    await media_service.disown(ids, user_id)
+                    purged = len(ids)
+                elif action == "membership":
+                    memberships = await db.chat_members.find({"_id": {"$in": ids}}, {"_id": 0, "chat_id": 1}).to_list(len(ids))
+                    purged = (await db.chat_members.delete_many({"_id": {"$in": ids}})).deleted_count
+                    chat_ids = [m["chat_id"] for m in memberships]
+                    await db.chats.update_many({"id": {"$in": chat_ids}}, {"$inc": {"member_count": -1}})
+                    for chat_id in chat_ids:
+                        chat_audiences.invalidate(chat_id)
+                elif action == "comments":
+                    purged = await purge_comments(ids)
+                elif action == "pseudonymise":
+                    await pseudonymise(collection, ids, user_id, account_pseudonym(job))
+                    purged = len(ids)
+                elif action == "leave":
+                    await db[collection].update_many({"_id": {"$in": ids}}, {"$pull": {"participants": user_id}})
+                    await db[collection].delete_many({"_id": {"$in": ids}, "participants": {"$size": 0}})
+                    purged = len(ids)
+                else:
+                    purged = (await db[collection].delete_many({"_id": {"$in": ids}})).deleted_count
+                if not await self._checkpoint(job, {"$inc": {f"purged.{collection}": purged}}):
+                    return
+                await asyncio.sleep(ACCOUNT_DELETION_BATCH_PAUSE_SECONDS)
+
+        await self._checkpoint(job, {"$set": {
+            "status": "completed",
+            "step": None,
+            "error": None,
+            "completed_at": datetime.utcnow(),
+        }})
+
+    async def _fail(self, job: dict, error: Exception):
+        failed = job.get("attempts", 0) >= ACCOUNT_DELETION_MAX_ATTEMPTS
+        await db.deletion_jobs.update_one({"id": job["id"]}, {"$set": {
+            "status": "failed" if failed else "running",
+            "error": str(error),
+            # Back off before the next attempt picks the job up again
+            "lease_until": datetime.utcnow() + timedelta(seconds=ACCOUNT_DELETION_LEASE_SECONDS * job.get("attempts", 1)),
+            "updated_at": datetime.utcnow(),
+        }})
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            job = None
+            try:
+                job = await self._claim()
+                if job is None:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), ACCOUNT_DELETION_POLL_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Account deletion job {job['id'] if job else '-'} failed: {e}")
+                if job:
+                    await self._fail(job, e)
+                await asyncio.sleep(1)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+account_deletion = AccountDeletionWorker()
+
+@app.on_event("startup")
+async def start_account_deletion_worker():
+    await db.deletion_jobs.create_index("id", unique=True)
+    await db.deletion_jobs.create_index([("status", 1), ("lease_until", 1)])
+    await db.deletion_jobs.create_index("user_id")
+    # Every purge filter must be index-backed or each chunk is a collection scan
+    await db.messages.create_index("sender_id")
+    await db.comments.create_index("author_id")
+    await db.news.create_index("author_id")
+    await db.notifications.create_index("user_id")
+    await db.notifications.create_index("data.from_user_id")
+    await db.friends.create_index("user_id")
+    await db.friends.create_index("friend_id")
+    await db.cart.create_index("user_id")
+    await db.products.create_index("seller_id")
+    await db.orders.create_index("buyer_id")
+    await db.orders.create_index("seller_id")
+    for field in ("from_user", "to_user", "payer_id", "payee_id"):
+        await db.payments.create_index(field)
+    await db.ledger_entries.create_index("counterparty")
+    await db.chats.create_index("participants")
+    await db.push_subscriptions.create_index("user_id")
+    await db.privacy_settings.create_index("user_id")
+    await db.password_resets.create_index("user_id")
+    account_deletion.start()
+
+@app.on_event("shutdown")
+async def stop_account_deletion_worker():
+    await account_deletion.stop()
 
 # Account management endpoints
 @app.get("/api/users/profile")
 async def get_user_profile(current_user: str = Depends(get_current_user)):
-    user = await db.users.find_one({"id": current_user}, {"password_hash": 0})
+    user = await db.users.find_one({"id": current_user}, USER_PUBLIC)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    return {
-        **user,
-        "_id": str(user["_id"]) if "_id" in user else None
-    }
+    return user
 
 @app.put("/api/users/profile")
 async def update_user_profile(profile_data: dict, current_user: str = Depends(get_current_user)):
@@ -1236,16 +5714,14 @@ async def update_user_profile(profile_data: dict, current_user: str = Depends(ge
         {"id": current_user},
         {"$set": update_data}
     )
+    profile_cache.invalidate(current_user)
     
     # Get updated user
-    updated_user = await db.users.find_one({"id": current_user}, {"password_hash": 0})
+    updated_user = await db.users.find_one({"id": current_user}, USER_PUBLIC)
     
     return {
         "message": "Profile updated successfully",
-        "user": {
-            **updated_user,
-            "_id": str(updated_user["_id"]) if "_id" in updated_user else None
-        }
+        "user": updated_user
     }
 
 @app.post("/api/users/change-password")
@@ -1272,72 +5748,96 @@ async def change_password(data: dict, current_user: str = Depends(get_current_us
 
 @app.get("/api/users/privacy-settings")
 async def get_privacy_settings(current_user: str = Depends(get_current_user)):
-    settings = await db.privacy_settings.find_one({"user_id": current_user})
-    
-    if not settings:
-        # Return default settings
-        default_settings = {
-            "user_id": current_user,
-            "last_seen_online": True,
-            "profile_photo_visible": True,
-            "phone_visible": False,
-            "email_visible": False,
-            "search_by_phone": True,
-            "search_by_email": True,
-            "read_receipts": True,
-            "typing_indicators": True
-        }
-        await db.privacy_settings.insert_one(default_settings)
-        # Remove the _id field that MongoDB adds automatically
-        default_settings.pop("_id", None)
-        return default_settings
-    
-    return {
-        **settings,
-        "_id": str(settings["_id"]) if "_id" in settings else None
-    }
+    return {"user_id": current_user, **await privacy.get(current_user)}
 
 @app.put("/api/users/privacy-settings")
-async def update_privacy_settings(settings_data: dict, current_user: str = Depends(get_current_user)):
-    settings_data["user_id"] = current_user
-    settings_data["updated_at"] = datetime.utcnow()
-    
-    await db.privacy_settings.update_one(
-        {"user_id": current_user},
-        {"$set": settings_data},
-        upsert=True
-    )
+async def update_privacy_settings(settings_data: UpdatePrivacySettings, current_user: str = Depends(get_current_user)):
+    settings = await privacy.update(current_user, settings_data.dict(exclude_none=True))
     
-    return {"message": "Privacy settings updated successfully"}
+    return {"message": "Privacy settings updated successfully", "settings": {"user_id": current_user, **settings}}
 
 @app.post("/api/users/profile-picture")
-async def upload_profile_picture(current_user: str = Depends(get_current_user)):
-    # Mock implementation - in production, integrate with cloud storage
-    # For now, return a placeholder URL
-    avatar_url = f"https://api.dicebear.com/7.x/avataaars/svg?seed={current_user}"
+async def upload_profile_picture(picture: Optional[ProfilePictureUpdate] = None,
+                                 current_user: str = Depends(get_current_user)):
+    if picture and picture.media_id:
+        # An image uploaded through /api/media/uploads with purpose "avatar"
+        doc, = await media_service.resolve([picture.media_id], current_user, publish=True)
+        avatar_url = media_url(doc["id"], "256" if "256" in doc["variants"] else None)
+    else:
+        # No upload given: fall back to a generated placeholder
+        avatar_url = f"https://api.dicebear.com/7.x/avataaars/svg?seed={current_user}"
     
     await db.users.update_one(
         {"id": current_user},
         {"$set": {"avatar_url": avatar_url, "updated_at": datetime.utcnow()}}
     )
+    profile_cache.invalidate(current_user)
     
     return {"message": "Profile picture updated", "avatar_url": avatar_url}
 
 @app.delete("/api/users/account")
 async def delete_account(current_user: str = Depends(get_current_user)):
-    # Delete user data
-    await db.users.delete_one({"id": current_user})
-    await db.friends.delete_many({"$or": [{"user_id": current_user}, {"friend_id": current_user}]})
-    await db.messages.delete_many({"sender_id": current_user})
-    await db.notifications.delete_many({"user_id": current_user})
-    await db.privacy_settings.delete_one({"user_id": current_user})
-    await db.products.delete_many({"seller_id": current_user})
-    await db.cart.delete_many({"user_id": current_user})
-    await db.orders.delete_many({"$or": [{"buyer_id": current_user}, {"seller_id": current_user}]})
-    
-    return {"message": "Account deleted successfully"}
+    # Mark the account deleted now; its data is purged in the background
+    await db.users.update_one(
+        {"id": current_user},
+        {"$set": {"deleted": True, "deleted_at": datetime.utcnow()}}
+    )
+    friend_graph.forget(current_user)
+    profile_cache.invalidate(current_user)
+    privacy.invalidate(current_user)
+    # Payment records are kept for the other party, so close requests nobody should pay now
+    await db.payments.update_many(
+        {"from_user": current_user, "status": "pending"},
+        {"$set": {"status": "cancelled", "updated_at": datetime.utcnow()}}
+    )
+    job = await account_deletion.enqueue(current_user)
+    
+    websocket = manager.active_connections.get(current_user)
+    if websocket:
+        try:
+            await websocket.close(code=WS_CLOSE_ACCOUNT_DELETED)
+        except Exception:
+            pass
+    
+    return {"message": "Account deleted successfully", "deletion_job_id": job["id"]}
+
+@app.get("/api/users/account/deletion")
+async def get_account_deletion_status(current_user: str = Depends(get_token_user)):
+    # The account is already marked deleted, so get_current_user would turn it away
+    job = await db.deletion_jobs.find_one(
+        {"user_id": current_user},
+        {"_id": 0, "lease_until": 0, "worker_id": 0},
+        sort=[("created_at", -1)]
+    )
+    if not job:
+        raise HTTPException(status_code=404, detail="No deletion job found")
+    return job
+
+# Metrics endpoint
+@app.get("/api/metrics", dependencies=[Depends(require_admin)])
+async def get_metrics():
+    ai_stats = ai_client.snapshot()
+    lines = [
+        "# HELP ai_client_calls_total LLM calls by outcome",
+        "# TYPE ai_client_calls_total counter",
+    ]
+    for outcome in ("succeeded", "failed", "timeouts", "rejected_queue", "rejected_breaker"):
+        lines.append(f'ai_client_calls_total{{outcome="{outcome}"}} {ai_stats[outcome]}')
+    lines += [
+        "# HELP ai_client_in_flight LLM calls currently holding a slot",
+        "# TYPE ai_client_in_flight gauge",
+        f"ai_client_in_flight {ai_stats['in_flight']}",
+        "# HELP ai_client_breaker_open Whether the LLM circuit breaker is open",
+        "# TYPE ai_client_breaker_open gauge",
+        f"ai_client_breaker_open {int(ai_stats['breaker_state'] != 'closed')}",
+    ]
+    body = metrics.render() + "\n".join(lines) + "\n"
+    return Response(content=body, media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # Health check
 @app.get("/api/health")
 async def health_check():
+    if manager.draining:
+        # Lets the load balancer stop routing here while existing sockets move off
+        return JSONResponse(status_code=503, content={"status": "draining", "timestamp": datetime.utcnow().isoformat()})
     return {"status": "healthy", "timestamp": datetime.utcnow()}
\ No newline at end of file
@@ -0,0 +1,611 @@
+"""Load and latency benchmarks for the backend against a local stack.
+
+Starts ``server:app`` on a free local port, seeds a realistic data set and drives
+REST and WebSocket load, then writes per-scenario p50/p99 latency and throughput
+as JSON so runs can be compared for regressions.
+
+    # Against a local MongoDB (a throwaway database is created and dropped)
+    python backend_benchmark.py --mongo-url mongodb://localhost:27017
+
+    # Without MongoDB, using an in-process mongomock stand-in
+    python backend_benchmark.py --in-memory
+
+    # Compare with a previous run and fail on >20% p99/throughput regressions
+    python backend_benchmark.py --in-memory --baseline bench_results.json --fail-on-regression 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import requests
+import websockets
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+BENCH_PASSWORD = "BenchPassword123!"
+CATEGORIES = ["electronics", "fashion", "home", "vehicles", "books", "sports", "food", "services"]
+LOCATIONS = ["Dar es Salaam", "Arusha", "Mwanza", "Dodoma", "Zanzibar", "Mbeya"]
+NEWS_CATEGORIES = ["general", "tech", "sports", "entertainment", "business"]
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.samples = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds, ok=True):
+        with self.lock:
+            if ok:
+                self.samples.append(seconds)
+            else:
+                self.errors += 1
+
+    def summary(self, duration):
+        samples = sorted(self.samples)
+        total = len(samples) + self.errors
+        return {
+            "requests": total,
+            "errors": self.errors,
+            "duration_s": round(duration, 3),
+            "throughput_per_s": round(len(samples) / duration, 2) if duration > 0 else 0.0,
+            "p50_ms": round(percentile(samples, 50) * 1000, 2),
+            "p90_ms": round(percentile(samples, 90) * 1000, 2),
+            "p99_ms": round(percentile(samples, 99) * 1000, 2),
+            "max_ms": round(samples[-1] * 1000, 2) if samples else 0.0,
+        }
+
+
+class LocalStack:
+    """Runs server:app locally against a freshly seeded database."""
+
+    def __init__(self, args):
+        self.args = args
+        self.port = args.port or self._free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.db_name = f"bench_{uuid.uuid4().hex[:8]}"
+        self.process = None
+        self.uvicorn_server = None
+        self.sync_client = None
+        self.server = None
+
+    @staticmethod
+    def _free_port():
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    def _import_server(self):
+        os.environ["MONGO_URL"] = self.args.mongo_url
+        os.environ["DB_NAME"] = self.db_name
+        os.environ.setdefault("SECRET_KEY", "benchmark-secret-key-benchmark-secret-key")
+        # The scenarios deliberately exceed per-client budgets from one address
+        os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+        sys.path.insert(0, str(BACKEND_DIR))
+        import server
+        self.server = server
+        return server
+
+    def start(self):
+        server = self._import_server()
+        if self.args.in_memory:
+            import mongomock
+            import uvicorn
+            from mongomock_motor import AsyncMongoMockClient
+
+            # Seeder writes through the sync client, the app reads through the async wrapper
+            self.sync_client = mongomock.MongoClient()
+            server.client = AsyncMongoMockClient(mock_mongo_client=self.sync_client)
+            server.db = server.client[self.db_name]
+            config = uvicorn.Config(server.app, host="127.0.0.1", port=self.port, log_level="warning")
+            self.uvicorn_server = uvicorn.Server(config)
+            threading.Thread(target=self.uvicorn_server.run, daemon=True).start()
+        else:
+            import pymongo
+
+            self.sync_client = pymongo.MongoClient(self.args.mongo_url)
+            self.process = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+                 "--port", str(self.port), "--log-level", "warning"],
+                cwd=BACKEND_DIR,
+                env={**os.environ},
+            )
+        self._wait_healthy()
+        print(f"✅ Local stack up at {self.base_url} (db={self.db_name}, "
+              f"{'in-memory' if self.args.in_memory else self.args.mongo_url})")
+
+    def _wait_healthy(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                if requests.get(f"{self.base_url}/api/health", timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("Server did not become healthy in time")
+
+    @property
+    def db(self):
+        return self.sync_client[self.db_name]
+
+    def token_for(self, user_id):
+        return self.server.create_access_token(data={"sub": user_id})
+
+    def stop(self):
+        if self.uvicorn_server:
+            self.uvicorn_server.should_exit = True
+        if self.process:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+        if self.sync_client is not None and not self.args.keep_db:
+            self.sync_client.drop_database(self.db_name)
+
+
+class Seeder:
+    """Bulk-loads users, a friends graph, chats with long histories, products and news."""
+
+    def __init__(self, stack, args):
+        self.stack = stack
+        self.args = args
+        self.server = stack.server
+        self.db = stack.db
+        self.users = []
+        self.hot_chat_id = None
+        self.group_chat_id = None
+        self.product_ids = []
+
+    def _insert(self, collection, docs, batch_size=1000):
+        for start in range(0, len(docs), batch_size):
+            self.db[collection].insert_many(docs[start:start + batch_size], ordered=False)
+
+    def seed(self):
+        started = time.time()
+        rng = random.Random(self.args.seed)
+        server = self.server
+        # One bcrypt hash shared by every user keeps seeding fast while logins stay realistic
+        password_hash = server.hash_password(BENCH_PASSWORD)
+
+        users = [
+            server.User(
+                username=f"bench_user_{i}",
+                email=f"bench_user_{i}@example.com",
+                password_hash=password_hash,
+                display_name=f"Bench User {i}",
+                phone=f"+2557{i:08d}",
+            ).dict()
+            for i in range(self.args.users)
+        ]
+        self._insert("users", users)
+        self.users = [user["id"] for user in users]
+
+        pairs = set()
+        for i, user_id in enumerate(self.users):
+            for friend_index in rng.sample(range(len(self.users)), min(self.args.friends_per_user, len(self.users) - 1)):
+                if friend_index != i:
+                    pairs.add(tuple(sorted((i, friend_index))))
+        friends = [
+            server.Friend(user_id=self.users[a], friend_id=self.users[b], status="accepted").dict()
+            for a, b in pairs
+        ]
+        self._insert("friends", friends)
+
+        now = datetime.utcnow()
+        chats, messages = [], []
+        for a, b in list(pairs)[:len(self.users)]:
+            chat = server.Chat(name="Direct", participants=[self.users[a], self.users[b]], created_by=self.users[a]).dict()
+            chats.append(chat)
+            for n in range(self.args.messages_per_chat):
+                sender = self.users[a] if n % 2 == 0 else self.users[b]
+                messages.append(server.Message(
+                    chat_id=chat["id"], sender_id=sender, sender_name="Bench",
+                    content=f"message {n}", timestamp=now - timedelta(minutes=self.args.messages_per_chat - n)
+                ).dict())
+
+        hot_chat = server.Chat(name="Hot chat", participants=self.users[:2], created_by=self.users[0]).dict()
+        self.hot_chat_id = hot_chat["id"]
+        chats.append(hot_chat)
+        for n in range(self.args.messages):
+            messages.append(server.Message(
+                chat_id=hot_chat["id"], sender_id=self.users[n % 2], sender_name="Bench",
+                content=f"hot message {n}", timestamp=now - timedelta(seconds=self.args.messages - n)
+            ).dict())
+
+        group_members = self.users[:self.args.group_size]
+        group_chat = server.Chat(name="Bench group", chat_type="group", participants=group_members,
+                                 created_by=group_members[0]).dict()
+        self.group_chat_id = group_chat["id"]
+        chats.append(group_chat)
+        self._insert("chats", chats)
+        self._insert("messages", messages)
+
+        products = []
+        for i in range(self.args.products):
+            seller = rng.choice(self.users)
+            product = server.Product(
+                seller_id=seller, seller_name="Bench Seller", name=f"Product {i}",
+                description="A benchmark product " * 5, price=float(rng.randint(1000, 2_000_000)),
+                category=rng.choice(CATEGORIES), stock_quantity=rng.randint(500, 1000),  # checkout reserves stock
+                condition=rng.choice(["new", "used", "refurbished"]), location=rng.choice(LOCATIONS),
+                images=[f"https://example.com/images/{i}.jpg"], tags=["bench", f"tag{i % 20}"],
+                likes=rng.sample(self.users, min(len(self.users), rng.randint(0, 30))),
+            ).dict()
+            product["like_count"] = len(product["likes"])
+            products.append(product)
+        self._insert("products", products)
+        self.product_ids = [product["id"] for product in products]
+
+        posts = [
+            server.NewsPost(
+                author_id=rng.choice(self.users), author_name="Bench Author", title=f"Post {i}",
+                content="Benchmark news content " * 20, category=rng.choice(NEWS_CATEGORIES),
+                likes=rng.sample(self.users, min(len(self.users), rng.randint(0, 100))),
+            ).dict()
+            for i in range(self.args.posts)
+        ]
+        self._insert("news", posts)
+
+        print(f"🌱 Seeded {len(users)} users, {len(friends)} friendships, {len(chats)} chats, "
+              f"{len(messages)} messages, {len(products)} products, {len(posts)} posts "
+              f"in {time.time() - started:.1f}s")
+        return {
+            "users": len(users), "friendships": len(friends), "chats": len(chats),
+            "messages": len(messages), "hot_chat_messages": self.args.messages,
+            "group_size": len(group_members), "products": len(products), "posts": len(posts),
+        }
+
+
+class BenchmarkRunner:
+    def __init__(self, stack, seeder, args):
+        self.stack = stack
+        self.seeder = seeder
+        self.args = args
+        self.api_url = f"{stack.base_url}/api"
+        self.local = threading.local()
+
+    def _session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def _timed(self, recorder, method, path, expected=200, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self._session().request(method, f"{self.api_url}{path}", timeout=30, **kwargs)
+            ok = response.status_code == expected
+        except requests.RequestException:
+            response, ok = None, False
+        recorder.record(time.perf_counter() - started, ok)
+        return response
+
+    def _run_pool(self, jobs, worker):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            list(pool.map(worker, jobs))
+        return time.perf_counter() - started
+
+    def login_burst(self):
+        recorder = LatencyRecorder()
+        users = self.seeder.users
+
+        def login(i):
+            self._timed(recorder, "POST", "/auth/login",
+                        json={"username": f"bench_user_{i % len(users)}", "password": BENCH_PASSWORD})
+
+        duration = self._run_pool(range(self.args.logins), login)
+        return {"overall": recorder.summary(duration)}
+
+    def feed_polling(self):
+        endpoints = {
+            "news": "/news",
+            "chats": "/chats",
+            "friends": "/friends",
+            "notifications": "/notifications",
+            "products": "/products",
+            "hot_chat_history": f"/chats/{self.seeder.hot_chat_id}/messages",
+        }
+        recorders = {name: LatencyRecorder() for name in endpoints}
+        overall = LatencyRecorder()
+        users = self.seeder.users
+        tokens = {user_id: self.stack.token_for(user_id) for user_id in users[:max(2, self.args.concurrency * 4)]}
+        token_users = list(tokens)
+
+        def poll(i):
+            name = list(endpoints)[i % len(endpoints)]
+            # The hot chat only admits its two participants
+            user_id = users[i % 2] if name == "hot_chat_history" else token_users[i % len(token_users)]
+            headers = {"Authorization": f"Bearer {tokens[user_id]}"}
+            started = time.perf_counter()
+            response = self._timed(recorders[name], "GET", endpoints[name], headers=headers)
+            overall.record(time.perf_counter() - started, response is not None and response.status_code == 200)
+
+        duration = self._run_pool(range(self.args.poll_requests), poll)
+        result = {"overall": overall.summary(duration)}
+        result.update({name: recorder.summary(duration) for name, recorder in recorders.items()})
+        return result
+
+    def checkout(self):
+        steps = {name: LatencyRecorder() for name in ("cart_add", "cart_get", "order_create")}
+        flow = LatencyRecorder()
+        rng = random.Random(self.args.seed)
+        users = self.seeder.users
+        plans = [(users[i % len(users)], rng.sample(self.seeder.product_ids, 2)) for i in range(self.args.checkouts)]
+
+        def run_checkout(plan):
+            user_id, product_ids = plan
+            headers = {"Authorization": f"Bearer {self.stack.token_for(user_id)}"}
+            started = time.perf_counter()
+            ok = True
+            for product_id in product_ids:
+                response = self._timed(steps["cart_add"], "POST", "/cart/add", headers=headers,
+                                       json={"product_id": product_id, "quantity": 1})
+                ok = ok and response is not None and response.status_code == 200
+            response = self._timed(steps["cart_get"], "GET", "/cart", headers=headers)
+            ok = ok and response is not None and response.status_code == 200
+            response = self._timed(steps["order_create"], "POST", "/orders", headers=headers, json={
+                "product_ids": product_ids, "quantities": [1, 1],
+                "shipping_address": {"city": "Dar es Salaam", "street": "Bench Street 1"},
+            })
+            ok = ok and response is not None and response.status_code == 200
+            flow.record(time.perf_counter() - started, ok)
+
+        duration = self._run_pool(plans, run_checkout)
+        result = {"overall": flow.summary(duration)}
+        result.update({name: recorder.summary(duration) for name, recorder in steps.items()})
+        return result
+
+    async def _fanout(self, encoding="json", compression=None):
+        """Fan messages out to the group; returns the summary and the frames the first member received."""
+        ws_url = self.stack.base_url.replace("http://", "ws://")
+        codec = self.stack.server.WS_CODECS[encoding]
+        members = self.seeder.users[:self.args.group_size]
+        expected = self.args.fanout_messages * len(members)
+        recorder = LatencyRecorder()
+        received = 0
+        done = asyncio.Event()
+        captured = []
+
+        async def receive(connection, capture):
+            nonlocal received
+            async for raw in connection:
+                if capture:
+                    captured.append(raw)
+                frame = codec.decode(raw) if isinstance(raw, bytes) else json.loads(raw)
+                if frame.get("type") != "new_message":
+                    continue
+                sent_at = (frame["message"].get("metadata") or {}).get("bench_sent_at")
+                if sent_at is None:
+                    continue
+                recorder.record(time.time() - sent_at)
+                received += 1
+                if received >= expected:
+                    done.set()
+
+        connections = [
+            await websockets.connect(f"{ws_url}/ws/{user_id}", max_size=None,
+                                     subprotocols=[encoding], compression=compression)
+            for user_id in members
+        ]
+        readers = [asyncio.create_task(receive(connection, n == 0)) for n, connection in enumerate(connections)]
+        sender = connections[0]
+        started = time.perf_counter()
+        for n in range(self.args.fanout_messages):
+            await sender.send(codec.encode({
+                "type": "chat_message",
+                "chat_id": self.seeder.group_chat_id,
+                "sender_name": "Bench Sender",
+                "content": f"fan-out {n}",
+                "metadata": {"bench_sent_at": time.time()},
+            }))
+            if self.args.fanout_interval:
+                await asyncio.sleep(self.args.fanout_interval)
+        try:
+            await asyncio.wait_for(done.wait(), timeout=self.args.fanout_timeout)
+        except asyncio.TimeoutError:
+            pass
+        duration = time.perf_counter() - started
+        for reader in readers:
+            reader.cancel()
+        for connection in connections:
+            await connection.close()
+
+        recorder.errors = expected - received
+        summary = recorder.summary(duration)
+        summary["messages_sent"] = self.args.fanout_messages
+        summary["recipients"] = len(members)
+        return summary, captured
+
+    async def _chat_fanout(self):
+        summary, _ = await self._fanout()
+        return {"overall": summary}
+
+    def chat_fanout(self):
+        return asyncio.run(self._chat_fanout())
+
+    async def _ws_encoding(self):
+        results = {}
+        for encoding, codec in self.stack.server.WS_CODECS.items():
+            for compression in (None, "deflate"):
+                summary, frames = await self._fanout(encoding, compression)
+                summary.update(frame_costs(codec, frames))
+                results[encoding + ("+deflate" if compression else "")] = summary
+        # JSON without compression is what clients get unless they ask otherwise
+        results["overall"] = results["json"]
+        return results
+
+    def ws_encoding(self):
+        """The fan-out once per WebSocket encoding, with and without permessage-deflate."""
+        return asyncio.run(self._ws_encoding())
+
+    def run(self, scenarios):
+        results = {}
+        for name in scenarios:
+            print(f"\n🔍 Running scenario: {name}")
+            results[name] = getattr(self, name)()
+            overall = results[name]["overall"]
+            print(f"   p50={overall['p50_ms']}ms p99={overall['p99_ms']}ms "
+                  f"throughput={overall['throughput_per_s']}/s errors={overall['errors']}")
+        return results
+
+
+def frame_costs(codec, frames, repeat=5):
+    """Bytes and CPU per frame for one encoding, measured on frames captured off a socket."""
+    if not frames:
+        return {}
+    payloads = [frame.encode() if isinstance(frame, str) else frame for frame in frames]
+    messages = [codec.decode(frame) for frame in frames]
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for message in messages:
+            codec.encode(message)
+    encode_seconds = (time.perf_counter() - started) / repeat
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for frame in frames:
+            codec.decode(frame)
+    decode_seconds = (time.perf_counter() - started) / repeat
+
+    # What permessage-deflate puts on the wire with its default context takeover:
+    # one raw deflate stream per direction, sync-flushed per message, minus the 4-byte tail
+    started = time.perf_counter()
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    deflated = sum(len(compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4 for payload in payloads)
+    deflate_seconds = time.perf_counter() - started
+
+    count = len(payloads)
+    return {
+        "frames_measured": count,
+        "payload_bytes_per_frame": round(sum(map(len, payloads)) / count, 1),
+        "deflated_bytes_per_frame": round(deflated / count, 1),
+        "encode_us_per_frame": round(encode_seconds / count * 1e6, 2),
+        "decode_us_per_frame": round(decode_seconds / count * 1e6, 2),
+        "deflate_us_per_frame": round(deflate_seconds / count * 1e6, 2),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print deltas against a previous run; return scenarios regressing beyond threshold percent."""
+    regressions = []
+    print("\n📊 Comparison with baseline")
+    for name, scenario in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name, {}).get("overall")
+        if not previous:
+            print(f"   {name}: no baseline")
+            continue
+        current = scenario["overall"]
+
+        def change(key):
+            return (current[key] - previous[key]) / previous[key] * 100 if previous[key] else 0.0
+
+        p99_change, throughput_change = change("p99_ms"), change("throughput_per_s")
+        print(f"   {name}: p50 {previous['p50_ms']} -> {current['p50_ms']}ms ({change('p50_ms'):+.1f}%), "
+              f"p99 {previous['p99_ms']} -> {current['p99_ms']}ms ({p99_change:+.1f}%), "
+              f"throughput {previous['throughput_per_s']} -> {current['throughput_per_s']}/s ({throughput_change:+.1f}%)")
+        if threshold is not None and (p99_change > threshold or throughput_change < -threshold):
+            regressions.append(name)
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the backend against a local stack")
+    parser.add_argument("--mongo-url", default=os.environ.get("BENCH_MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--in-memory", action="store_true", help="use an in-process mongomock stand-in")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--keep-db", action="store_true", help="do not drop the seeded database afterwards")
+    parser.add_argument("--scenarios", default="login_burst,chat_fanout,ws_encoding,feed_polling,checkout")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--friends-per-user", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=10000, help="messages in the hot chat history")
+    parser.add_argument("--messages-per-chat", type=int, default=20)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--posts", type=int, default=200)
+    parser.add_argument("--group-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--poll-requests", type=int, default=1200)
+    parser.add_argument("--checkouts", type=int, default=200)
+    parser.add_argument("--fanout-messages", type=int, default=100)
+    parser.add_argument("--fanout-interval", type=float, default=0.01)
+    parser.add_argument("--fanout-timeout", type=float, default=60.0)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="previous results JSON to compare against")
+    parser.add_argument("--fail-on-regression", type=float, default=None, metavar="PCT",
+                        help="exit non-zero if p99 grows or throughput drops by more than PCT percent")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    print("🚀 Starting backend benchmark")
+    print("=" * 60)
+
+    stack = LocalStack(args)
+    stack.start()
+    try:
+        seeder = Seeder(stack, args)
+        dataset = seeder.seed()
+        runner = BenchmarkRunner(stack, seeder, args)
+        scenario_results = runner.run(scenarios)
+    finally:
+        stack.stop()
+
+    results = {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat(),
+            "commit": git_commit(),
+            "mode": "in-memory" if args.in_memory else "mongodb",
+            "concurrency": args.concurrency,
+            "dataset": dataset,
+        },
+        "scenarios": scenario_results,
+    }
+    # Load the baseline first so --output may point at the same file
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\n💾 Results written to {args.output}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.fail_on_regression)
+        if regressions:
+            print(f"⚠️  Regressions beyond {args.fail_on_regression}%: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
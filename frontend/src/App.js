@@ -150,8 +150,20 @@ function App() {
       setWs(websocket);
     };
     
+    // Set when the server asks us to move to another instance
+    let reconnectDelay = null;
+    
     websocket.onmessage = (event) => {
       const data = JSON.parse(event.data);
+      if (data.type === 'ping') {
+        // Heartbeat: the server drops connections that stop answering
+        websocket.send(JSON.stringify({ type: 'pong' }));
+        return;
+      }
+      if (data.type === 'reconnect') {
+        reconnectDelay = data.delay_ms;
+        return;
+      }
       handleWebSocketMessage(data);
     };
     
@@ -160,10 +172,15 @@ function App() {
       toast.error('Connection error. Please refresh the page.');
     };
     
-    websocket.onclose = () => {
+    websocket.onclose = (event) => {
       console.log('WebSocket disconnected');
-      // Auto-reconnect after 3 seconds
-      setTimeout(() => initializeWebSocket(userId, token), 3000);
+      // 4000: this account connected from another tab, which now owns the socket
+      if (event.code === 4000) return;
+      // 4001: the account was deleted
+      if (event.code === 4001) return;
+      // Auto-reconnect after 3 seconds, jittered so clients don't return all at once
+      const delay = reconnectDelay ?? 3000 + Math.floor(Math.random() * 2000);
+      setTimeout(() => initializeWebSocket(userId, token), delay);
     };
   };
 
@@ -191,6 +208,18 @@ function App() {
         toast.info(`Payment request: $${data.payment.amount} from ${data.payment.description}`);
         break;
       
+      case 'payment_update':
+        toast.info(`Payment request for ${data.payment.amount} ${data.payment.currency} was ${data.payment.status}`);
+        break;
+      
+      case 'order_update':
+        if (data.payment_status === 'failed') {
+          toast.error('Payment for your order failed. You can try again from your orders.');
+        } else {
+          toast.info(`Order ${data.order_id.slice(0, 8)} is now ${data.status}`);
+        }
+        break;
+      
       default:
         console.log('Unknown message type:', data);
     }
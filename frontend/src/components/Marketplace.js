@@ -77,7 +77,10 @@ const Marketplace = ({ user }) => {
       if (selectedCategory !== 'all') params.append('category', selectedCategory);
       if (searchQuery) params.append('search', searchQuery);
       
-      const response = await axios.get(`${API}/products?${params}`);
+      const token = localStorage.getItem('token');
+      const response = await axios.get(`${API}/products?${params}`, {
+        headers: token ? { Authorization: `Bearer ${token}` } : {}
+      });
       setProducts(response.data);
     } catch (error) {
       console.error('Failed to load products:', error);
@@ -184,6 +187,20 @@ const Marketplace = ({ user }) => {
     }
   };
 
+  // Open product details; fetching the product is what counts a view
+  const openProduct = async (product) => {
+    setShowProductDetails(product);
+    try {
+      const token = localStorage.getItem('token');
+      const response = await axios.get(`${API}/products/${product.id}`, {
+        headers: token ? { Authorization: `Bearer ${token}` } : {}
+      });
+      setShowProductDetails(current => (current?.id === product.id ? response.data : current));
+    } catch (error) {
+      console.error('Failed to load product:', error);
+    }
+  };
+
   // Like product
   const likeProduct = async (productId) => {
     try {
@@ -302,7 +319,7 @@ const Marketplace = ({ user }) => {
           <div className={viewMode === 'grid' ? 'grid grid-cols-1 md:grid-cols-2 lg:grid-cols-3 gap-4' : 'space-y-4'}>
             {products.map((product) => (
               <Card key={product.id} className="overflow-hidden hover:shadow-lg transition-shadow cursor-pointer">
-                <div onClick={() => setShowProductDetails(product)}>
+                <div onClick={() => openProduct(product)}>
                   {product.images?.[0] && (
                     <div className="h-48 bg-gray-200 overflow-hidden">
                       <img 
@@ -353,8 +370,8 @@ const Marketplace = ({ user }) => {
                     className="flex-1"
                     onClick={() => likeProduct(product.id)}
                   >
-                    <Heart className={`h-4 w-4 mr-1 ${product.likes?.includes(user?.id) ? 'text-red-500 fill-current' : ''}`} />
-                    {product.likes?.length || 0}
+                    <Heart className={`h-4 w-4 mr-1 ${product.liked_by_me ? 'text-red-500 fill-current' : ''}`} />
+                    {product.likes_count || 0}
                   </Button>
                   <Button
                     size="sm"
@@ -411,7 +428,7 @@ const Marketplace = ({ user }) => {
                       </div>
                       <div className="flex items-center space-x-1">
                         <Heart className="h-3 w-3" />
-                        <span>{product.likes?.length || 0} likes</span>
+                        <span>{product.likes_count || 0} likes</span>
                       </div>
                       <Badge variant={product.is_active ? 'default' : 'secondary'}>
                         {product.is_active ? 'Active' : 'Inactive'}
@@ -738,8 +755,8 @@ const Marketplace = ({ user }) => {
                   className="flex-1"
                   onClick={() => likeProduct(showProductDetails.id)}
                 >
-                  <Heart className={`h-4 w-4 mr-2 ${showProductDetails.likes?.includes(user?.id) ? 'text-red-500 fill-current' : ''}`} />
-                  Like ({showProductDetails.likes?.length || 0})
+                  <Heart className={`h-4 w-4 mr-2 ${showProductDetails.liked_by_me ? 'text-red-500 fill-current' : ''}`} />
+                  Like ({showProductDetails.likes_count || 0})
                 </Button>
                 <Button
                   className="flex-1 bg-orange-600 hover:bg-orange-700"
@@ -221,7 +221,7 @@ const NewsFeed = ({ user }) => {
                   <div className="flex items-center space-x-4">
                     <Button variant="ghost" size="sm" className="text-gray-500 hover:text-red-500">
                       <Heart className="h-4 w-4 mr-1" />
-                      {post.likes?.length || 0}
+                      {post.likes_count || 0}
                     </Button>
                     <Button 
                       variant="ghost" 
@@ -230,7 +230,7 @@ const NewsFeed = ({ user }) => {
                       onClick={() => loadComments(post.id)}
                     >
                       <MessageCircle className="h-4 w-4 mr-1" />
-                      Comments
+                      {post.comment_count || 0}
                     </Button>
                   </div>
                   <Button variant="ghost" size="sm" className="text-gray-500 hover:text-green-500">
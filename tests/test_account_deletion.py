@@ -0,0 +1,157 @@
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+
+import server
+
+
+def bearer(user_id):
+    return HTTPAuthorizationCredentials(scheme="Bearer", credentials=server.create_access_token({"sub": user_id}))
+
+
+@pytest.fixture
+def profiles(monkeypatch):
+    cache = server.ProfileCache()
+    monkeypatch.setattr(server, "profile_cache", cache)
+    return cache
+
+
+@pytest.mark.anyio
+async def test_token_of_deleted_account_is_rejected(db, profiles):
+    await db.users.insert_one({"id": "u1", "username": "alice", "display_name": "Alice"})
+    assert await server.get_current_user(bearer("u1")) == "u1"
+
+    await db.users.update_one({"id": "u1"}, {"$set": {"deleted": True}})
+    profiles.invalidate("u1")
+    with pytest.raises(HTTPException) as error:
+        await server.get_current_user(bearer("u1"))
+    assert error.value.status_code == 401
+    assert await server.get_optional_user(bearer("u1")) is None
+
+
+@pytest.mark.anyio
+async def test_token_of_purged_account_is_rejected(db, profiles):
+    with pytest.raises(HTTPException):
+        await server.get_current_user(bearer("gone"))
+
+
+@pytest.mark.anyio
+async def test_active_user_check_is_served_from_the_profile_cache(db, profiles):
+    await db.users.insert_one({"id": "u1", "username": "alice", "display_name": "Alice"})
+    assert await server.is_active_user("u1")
+    await db.users.delete_many({})
+    assert await server.is_active_user("u1")  # cached until invalidated or expired
+
+
+@pytest.mark.anyio
+async def test_deletion_job_purges_and_is_claimed_once(db, monkeypatch):
+    monkeypatch.setattr(server, "ACCOUNT_DELETION_BATCH_PAUSE_SECONDS", 0)
+    await db.users.insert_one({"id": "u1", "deleted": True})
+    await db.news.insert_many([{"id": f"p{i}", "author_id": "u1"} for i in range(3)])
+    await db.news.insert_one({"id": "other", "author_id": "u2"})
+
+    worker, rival = server.AccountDeletionWorker(), server.AccountDeletionWorker()
+    await worker.enqueue("u1")
+    assert (await worker.enqueue("u1"))["status"] == "pending"  # not enqueued twice
+    job = await worker._claim()
+    assert job is not None
+    assert await rival._claim() is None  # leased to the first worker
+
+    await worker._process(job)
+    stored = await db.deletion_jobs.find_one({"id": job["id"]})
+    assert stored["status"] == "completed"
+    assert stored["purged"]["news"] == 3
+    assert await db.news.count_documents({}) == 1
+    assert await db.users.count_documents({}) == 0
+
+
+@pytest.mark.anyio
+async def test_deletion_keeps_ledger_postings_balanced(db, monkeypatch):
+    monkeypatch.setattr(server, "ACCOUNT_DELETION_BATCH_PAUSE_SECONDS", 0)
+    await db.users.insert_one({"id": "u1", "deleted": True})
+    for transfer_id, payer, payee in (("t1", "u1", "u2"), ("t2", "u2", "u1")):
+        assert await server.ledger.post(payer, -500, transfer_id)
+        await server.ledger.record(transfer_id, payer, payee, 500, "req")
+        assert await server.ledger.post(payee, 500, transfer_id)
+
+    worker = server.AccountDeletionWorker()
+    job = await worker.enqueue("u1")
+    await worker._process(await worker._claim())
+
+    pseudonym = server.account_pseudonym(job)
+    entries = await db.ledger_entries.find({}, {"_id": 0}).to_list(None)
+    assert len(entries) == 4 and sum(entry["amount_minor"] for entry in entries) == 0
+    assert not [e for e in entries if "u1" in (e["account"], e["counterparty"])]
+    assert {e["account"] for e in entries} == {"u2", pseudonym}
+    balances = {b["user_id"]: b["balance_minor"] async for b in db.balances.find({})}
+    assert balances == {"u2": 0, pseudonym: 0}
+
+
+
+@pytest.mark.anyio
+async def test_deleted_account_can_read_its_deletion_status(db, profiles):
+    await db.users.insert_one({"id": "u1", "username": "alice", "display_name": "Alice"})
+    deleted = await server.delete_account(current_user=await server.get_current_user(bearer("u1")))
+
+    with pytest.raises(HTTPException):
+        await server.get_current_user(bearer("u1"))
+    status = await server.get_account_deletion_status(current_user=await server.get_token_user(bearer("u1")))
+    assert status["id"] == deleted["deletion_job_id"]
+    assert status["status"] == "pending"
+    assert "lease_until" not in status and "worker_id" not in status
+
+    with pytest.raises(HTTPException) as error:
+        await server.get_token_user(HTTPAuthorizationCredentials(scheme="Bearer", credentials="forged"))
+    assert error.value.status_code == 401
+
+
+@pytest.mark.anyio
+async def test_deletion_keeps_orders_and_payments_for_the_other_party(db, monkeypatch):
+    monkeypatch.setattr(server, "ACCOUNT_DELETION_BATCH_PAUSE_SECONDS", 0)
+    await db.users.insert_one({"id": "u1", "deleted": True})
+    line = {"product_id": "p", "name": "Lamp", "price": 10.0, "quantity": 1, "subtotal": 10.0}
+    order = {"status": "paid", "total_amount": 10.0, "created_at": datetime.utcnow()}
+    await db.orders.insert_many([
+        {**order, "id": "bought", "buyer_id": "u1", "buyer_name": "Alice", "seller_id": "u2", "seller_name": "Bob",
+         "shipping_address": {"city": "Dar"}, "products": [{**line, "seller_id": "u2"}]},
+        {**order, "id": "mixed", "buyer_id": "u3", "buyer_name": "Carol", "seller_id": "u2", "seller_name": "Bob",
+         "shipping_address": {}, "products": [{**line, "seller_id": "u2"}, {**line, "seller_id": "u1"}]},
+    ])
+    await db.payments.insert_many([
+        {"id": "pay", "order_id": "bought", "payer_id": "u1", "payee_id": "u2", "status": "completed"},
+        {"id": "peer", "from_user": "u2", "to_user": "u1", "status": "completed"},
+    ])
+    await db.seller_stats.insert_many([{"seller_id": "u1"}, {"seller_id": "u2"}])
+
+    worker = server.AccountDeletionWorker()
+    job = await worker.enqueue("u1")
+    await worker._process(await worker._claim())
+
+    pseudonym = server.account_pseudonym(job)
+    bought = await db.orders.find_one({"id": "bought"})
+    assert (bought["buyer_id"], bought["buyer_name"], bought["shipping_address"]) == (pseudonym, "Deleted user", {})
+    assert bought["seller_name"] == "Bob"
+    mixed = await db.orders.find_one({"id": "mixed"})
+    assert [entry["seller_id"] for entry in mixed["products"]] == ["u2", pseudonym]
+    assert (await db.payments.find_one({"id": "pay"}))["payer_id"] == pseudonym
+    assert (await db.payments.find_one({"id": "peer"}))["to_user"] == pseudonym
+    assert [s["seller_id"] async for s in db.seller_stats.find({})] == ["u2"]
+
+    # The pseudonymised seller gets no summary of its own, now or on a rebuild
+    await server.seller_stats.order_transitioned(mixed, "paid", "shipped")
+    assert await server.seller_stats.backfill() == 1
+    assert await db.seller_stats.distinct("seller_id") == ["u2"]
+
+
+@pytest.mark.anyio
+async def test_deleting_an_account_cancels_its_open_payment_requests(db, profiles):
+    await db.users.insert_one({"id": "u1", "username": "alice", "display_name": "Alice"})
+    await db.payments.insert_many([
+        {"id": "sent", "from_user": "u1", "to_user": "u2", "status": "pending"},
+        {"id": "paid", "from_user": "u1", "to_user": "u2", "status": "completed"},
+    ])
+    await server.delete_account(current_user="u1")
+    assert (await db.payments.find_one({"id": "sent"}))["status"] == "cancelled"
+    assert (await db.payments.find_one({"id": "paid"}))["status"] == "completed"
@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import pytest
+
+import server
+
+
+def half_open_client():
+    client = server.AIClient()
+    client.breaker.state = "open"
+    client.breaker.opened_at = time.monotonic() - client.breaker.reset_timeout - 1
+    return client
+
+
+def test_breaker_opens_after_threshold_and_lets_one_probe_through():
+    breaker = server.CircuitBreaker(failure_threshold=2, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    assert breaker.allow() is True
+    assert breaker.state == "half_open"
+    assert breaker.allow() is False  # probe already in flight
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow() is True
+
+
+@pytest.mark.anyio
+async def test_open_breaker_rejects_without_queueing():
+    client = server.AIClient()
+    client.breaker.state = "open"
+    client.breaker.opened_at = time.monotonic()
+    with pytest.raises(server.AIUnavailable):
+        await client.complete("system", "prompt", "test")
+    assert client.stats["rejected_breaker"] == 1
+    assert client.user_slots == {}
+
+
+@pytest.mark.anyio
+async def test_cancelled_probe_releases_the_breaker(monkeypatch):
+    monkeypatch.setattr(server, "AI_QUEUE_TIMEOUT_SECONDS", 30)
+    client = half_open_client()
+    client.global_slots = asyncio.Semaphore(0)  # the probe waits in the queue
+
+    probe = asyncio.create_task(client.complete("system", "prompt", "test"))
+    await asyncio.sleep(0.01)
+    assert client.breaker.probe_in_flight is True
+    probe.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await probe
+
+    assert client.breaker.probe_in_flight is False
+    assert client.breaker.allow() is True
+    assert client.user_slots == {}
+
+
+@pytest.mark.anyio
+async def test_probe_rejected_for_capacity_releases_the_breaker(monkeypatch):
+    monkeypatch.setattr(server, "AI_QUEUE_TIMEOUT_SECONDS", 0.01)
+    client = half_open_client()
+    client.global_slots = asyncio.Semaphore(0)
+
+    with pytest.raises(server.AIUnavailable):
+        await client.complete("system", "prompt", "test")
+    assert client.stats["rejected_queue"] == 1
+    assert client.breaker.probe_in_flight is False
@@ -0,0 +1,33 @@
+import pytest
+
+backend_benchmark = pytest.importorskip("backend_benchmark")
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert backend_benchmark.percentile(values, 50) == 50
+    assert backend_benchmark.percentile(values, 99) == 99
+    assert backend_benchmark.percentile([7], 99) == 7
+    assert backend_benchmark.percentile([], 50) == 0.0
+
+
+def test_summary_counts_errors_apart_from_latency():
+    recorder = backend_benchmark.LatencyRecorder()
+    for seconds in (0.01, 0.02, 0.03):
+        recorder.record(seconds)
+    recorder.record(5.0, ok=False)
+    summary = recorder.summary(2.0)
+    assert summary["requests"] == 4 and summary["errors"] == 1
+    assert summary["throughput_per_s"] == 1.5
+    assert summary["max_ms"] == 30.0
+
+
+def test_compare_flags_p99_and_throughput_regressions(capsys):
+    def run(p99, throughput):
+        return {"scenarios": {"feed": {"overall": {"p50_ms": 1.0, "p99_ms": p99, "throughput_per_s": throughput}}}}
+
+    baseline = run(10.0, 100.0)
+    assert backend_benchmark.compare(run(11.0, 95.0), baseline, 20) == []
+    assert backend_benchmark.compare(run(13.0, 100.0), baseline, 20) == ["feed"]
+    assert backend_benchmark.compare(run(10.0, 70.0), baseline, 20) == ["feed"]
+    assert backend_benchmark.compare(run(50.0, 1.0), {"scenarios": {}}, 20) == []
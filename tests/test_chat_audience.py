@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+class SlowLoads:
+    """Stands in for a cache's _load, counting calls and blocking until released."""
+
+    def __init__(self, result):
+        self.result = result
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self, *args):
+        self.calls += 1
+        await self.release.wait()
+        return self.result
+
+
+def audience():
+    return server.ChatAudience("group", frozenset({"u1", "u2"}), frozenset({"u1"}))
+
+
+@pytest.mark.anyio
+async def test_concurrent_misses_share_one_load():
+    cache = server.ChatAudienceCache()
+    cache._load = loads = SlowLoads(audience())
+    tasks = [asyncio.create_task(cache.get("c1")) for _ in range(5)]
+    await asyncio.sleep(0)
+    loads.release.set()
+    results = await asyncio.gather(*tasks)
+    assert loads.calls == 1
+    assert all(result is results[0] for result in results)
+    assert cache.loading == {}
+
+
+@pytest.mark.anyio
+async def test_waiters_survive_a_cancelled_loader():
+    cache = server.ChatAudienceCache()
+    cache._load = loads = SlowLoads(audience())
+    loader = asyncio.create_task(cache.get("c1"))
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(cache.get("c1"))
+    await asyncio.sleep(0)
+
+    loader.cancel()
+    await asyncio.sleep(0)
+    loads.release.set()
+    result = await asyncio.wait_for(waiter, 1)
+    assert result.members == {"u1", "u2"}
+    assert loader.cancelled()
+    assert loads.calls == 2  # the waiter took over the load
+
+
+@pytest.mark.anyio
+async def test_loads_from_chat_and_members(db):
+    await db.chats.insert_one({"id": "g1", "chat_type": "channel", "participants": []})
+    await db.chat_members.insert_many([{"chat_id": "g1", "user_id": "owner", "role": "owner"},
+                                       {"chat_id": "g1", "user_id": "reader", "role": "member"}])
+    cache = server.ChatAudienceCache()
+    result = await cache.get("g1")
+    assert result.members == {"owner", "reader"}
+    assert result.can_post("owner") and not result.can_post("reader")
+    assert await cache.get("missing") is None
+
+
+@pytest.fixture
+async def legacy_group(db, monkeypatch):
+    monkeypatch.setattr(server, "chat_audiences", server.ChatAudienceCache())
+    await db.chat_members.create_index([("chat_id", 1), ("user_id", 1)], unique=True)
+    await db.chats.insert_one({"id": "g1", "name": "Old", "chat_type": "group",
+                               "participants": ["u1", "u2", "u3"], "created_by": "u1"})
+
+
+@pytest.mark.anyio
+async def test_members_can_leave_a_group_that_still_embeds_them(db, legacy_group):
+    assert "u2" in (await server.chat_audiences.get("g1")).members
+    assert await server.remove_chat_member("g1", "u2")
+    assert (await server.chat_audiences.get("g1")).members == {"u1", "u3"}
+    assert not await server.remove_chat_member("g1", "u2")
+
+
+@pytest.mark.anyio
+async def test_legacy_group_members_move_into_chat_members(db, legacy_group):
+    assert await server.migrate_legacy_groups() == 1
+    assert await server.migrate_legacy_groups() == 0
+    chat = await db.chats.find_one({"id": "g1"})
+    assert chat["participants"] == [] and chat["member_count"] == 3
+    roles = {m["user_id"]: m["role"] async for m in db.chat_members.find({"chat_id": "g1"})}
+    assert roles == {"u1": "owner", "u2": "member", "u3": "member"}
+
+    audience = await server.chat_audiences.get("g1")
+    assert audience.members == {"u1", "u2", "u3"} and audience.admins == {"u1"}
+    assert await server.remove_chat_member("g1", "u3")
+    assert (await db.chats.find_one({"id": "g1"}))["member_count"] == 2
+
+
+@pytest.mark.anyio
+async def test_adding_members_ignores_only_duplicates(db, legacy_group, monkeypatch):
+    assert await server.add_chat_members("g1", ["u4", "u5"]) == 2
+    assert await server.add_chat_members("g1", ["u4", "u6"]) == 1
+
+    async def rejected(self, docs, ordered=True):
+        raise server.BulkWriteError({"nInserted": 1, "writeErrors": [{"index": 1, "code": 121}]})
+    monkeypatch.setattr(type(db.chat_members), "insert_many", rejected)
+    with pytest.raises(server.BulkWriteError):
+        await server.add_chat_members("g1", ["u7", "u8"])
+    assert (await db.chats.find_one({"id": "g1"}))["member_count"] == 4
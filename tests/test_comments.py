@@ -0,0 +1,30 @@
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+@pytest.mark.anyio
+async def test_startup_backfills_legacy_counts_before_serving(db):
+    await db.news.insert_many([{"id": "legacy"}, {"id": "quiet"}, {"id": "new", "comment_count": 7}])
+    await db.comments.insert_many([{"id": f"c{i}", "post_id": "legacy", "parent_id": None} for i in range(3)])
+    await server.start_comments()
+    counts = {post["id"]: post["comment_count"] async for post in db.news.find({}, {"_id": 0})}
+    assert counts == {"legacy": 3, "quiet": 0, "new": 7}
+
+
+@pytest.mark.anyio
+async def test_comments_and_replies_keep_counts(db):
+    await db.users.insert_one({"id": "u1", "display_name": "U"})
+    await db.news.insert_one({"id": "p1", "comment_count": 0})
+    top = (await server.create_comment("p1", server.CreateComment(content="a"), "u1"))["comment"]
+    reply = (await server.create_comment("p1", server.CreateComment(content="b", parent_id=top["id"]), "u1"))["comment"]
+    # A reply to a reply is filed under the top-level comment
+    nested = server.CreateComment(content="c", parent_id=reply["id"])
+    assert (await server.create_comment("p1", nested, "u1"))["comment"]["parent_id"] == top["id"]
+
+    assert (await db.news.find_one({"id": "p1"}))["comment_count"] == 3
+    assert (await db.comments.find_one({"id": top["id"]}))["reply_count"] == 2
+    with pytest.raises(HTTPException) as missing:
+        await server.create_comment("nope", server.CreateComment(content="a"), "u1")
+    assert missing.value.status_code == 404
@@ -0,0 +1,71 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import server
+
+
+class FakeSocket:
+    def __init__(self, idle=0.0):
+        self.state = SimpleNamespace(codec=server.WS_CODECS["json"], last_seen=time.monotonic() - idle)
+        self.sent = []
+        self.closed = None
+
+    async def send_text(self, data):
+        self.sent.append(json.loads(data))
+
+    async def close(self, code):
+        self.closed = code
+
+
+@pytest.fixture
+def manager(db, monkeypatch):
+    manager = server.ConnectionManager()
+    monkeypatch.setattr(server, "manager", manager)
+    monkeypatch.setattr(server, "fanout", server.FanoutDispatcher())  # no workers: delivers inline
+    return manager
+
+
+@pytest.mark.anyio
+async def test_supervisor_pings_quiet_sockets_and_reaps_silent_ones(manager, monkeypatch):
+    monkeypatch.setattr(server, "WS_HEARTBEAT_INTERVAL_SECONDS", 0.01)
+    monkeypatch.setattr(server, "WS_IDLE_TIMEOUT_SECONDS", 60)
+    # The pass runs every 10ms, so "fresh" is kept talking for the length of the test
+    fresh, quiet, silent = FakeSocket(idle=-60), FakeSocket(idle=30), FakeSocket(idle=120)
+    manager.active_connections.update(fresh=fresh, quiet=quiet, silent=silent)
+
+    manager.start()
+    await asyncio.sleep(0.05)
+    await manager.stop()
+
+    assert fresh.sent == [] and fresh.closed is None
+    assert {"type": "ping"} in quiet.sent and quiet.closed is None
+    assert silent.closed == server.WS_CLOSE_IDLE
+    assert set(manager.active_connections) == {"fresh", "quiet"}
+
+
+@pytest.mark.anyio
+async def test_drain_sends_everyone_elsewhere_without_marking_them_offline(manager, db):
+    sockets = {f"u{n}": FakeSocket() for n in range(3)}
+    manager.active_connections.update(sockets)
+    for user_id in sockets:
+        manager.user_status[user_id] = "online"
+
+    assert await manager.drain(window=0) == 3
+    assert manager.draining and manager.active_connections == {}
+    for websocket in sockets.values():
+        assert websocket.sent[0]["type"] == "reconnect"
+        assert 0 <= websocket.sent[0]["delay_ms"] <= server.WS_RECONNECT_JITTER_MS
+        assert websocket.closed == server.WS_CLOSE_SERVICE_RESTART
+    assert set(manager.user_status.values()) == {"online"}
+
+
+@pytest.mark.anyio
+async def test_replaced_socket_does_not_disconnect_its_successor(manager):
+    old, new = FakeSocket(), FakeSocket()
+    manager.active_connections["u1"] = new
+    manager.disconnect("u1", old)
+    assert manager.active_connections["u1"] is new
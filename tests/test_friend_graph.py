@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.mark.anyio
+async def test_loads_edges_from_both_sides(db):
+    await db.friends.insert_many([
+        {"user_id": "a", "friend_id": "b", "status": "accepted"},
+        {"user_id": "a", "friend_id": "c", "status": "pending"},
+        {"user_id": "d", "friend_id": "a", "status": "pending"},
+    ])
+    graph = server.FriendGraph()
+    edges = await graph.get("a")
+    assert edges.friends == {"b"} and edges.sent == {"c"} and edges.received == {"d"}
+    assert await graph.are_friends("b", "a")
+
+
+@pytest.mark.anyio
+async def test_change_during_load_is_not_cached(db):
+    graph = server.FriendGraph()
+    release = asyncio.Event()
+    real_load = graph._load
+
+    async def slow_load(user_ids):
+        await release.wait()
+        return await real_load(user_ids)
+
+    graph._load = slow_load
+    loading = asyncio.create_task(graph.get("a"))
+    await asyncio.sleep(0)
+    graph.accepted("a", "b")
+    release.set()
+    await loading
+    assert "a" not in graph.entries
+
+
+@pytest.mark.anyio
+async def test_waiters_survive_a_cancelled_loader(db):
+    graph = server.FriendGraph()
+    release = asyncio.Event()
+    calls = []
+
+    async def slow_load(user_ids):
+        calls.append(user_ids)
+        await release.wait()
+        edges = server.FriendEdges()
+        edges.friends.add("b")
+        return {user_id: edges for user_id in user_ids}
+
+    graph._load = slow_load
+    loader = asyncio.create_task(graph.get("a"))
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(graph.get("a"))
+    await asyncio.sleep(0)
+
+    loader.cancel()
+    await asyncio.sleep(0)
+    release.set()
+    edges = await asyncio.wait_for(waiter, 1)
+    assert edges.friends == {"b"}
+    assert loader.cancelled()
+    assert len(calls) == 2
+    assert graph.loading == {}
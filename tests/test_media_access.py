@@ -0,0 +1,56 @@
+import pytest
+
+import server
+
+MEDIA_ID = "a" * 64
+
+
+@pytest.fixture
+def media(db, monkeypatch):
+    monkeypatch.setattr(server, "chat_audiences", server.ChatAudienceCache())
+    return server.MediaService(server.DiskMediaStore(server.MEDIA_ROOT))
+
+
+@pytest.fixture
+async def upload(db):
+    await db.media.insert_one({"id": MEDIA_ID, "owners": ["alice"], "public": False, "chats": []})
+    await db.chats.insert_one({"id": "c1", "chat_type": "private", "participants": ["alice", "bob"]})
+
+
+async def stored():
+    return await server.db.media.find_one({"id": MEDIA_ID})
+
+
+@pytest.mark.anyio
+async def test_private_upload_is_readable_by_its_uploader_only(media, upload):
+    doc = await stored()
+    assert await media.can_read(doc, "alice")
+    assert not await media.can_read(doc, "bob")
+    assert not await media.can_read(doc, None)
+
+
+@pytest.mark.anyio
+async def test_attaching_shares_with_chat_members(media, upload):
+    assert await media.attach(MEDIA_ID, "bob", "c1") is None  # not bob's upload
+    assert await media.attach(MEDIA_ID, "alice", "c1") is not None
+    doc = await stored()
+    assert await media.can_read(doc, "bob")
+    assert not await media.can_read(doc, "mallory")
+
+
+@pytest.mark.anyio
+async def test_published_media_is_readable_by_anyone(media, upload):
+    with pytest.raises(server.HTTPException):
+        await media.resolve([MEDIA_ID], "bob", publish=True)
+    await media.resolve([MEDIA_ID], "alice", publish=True)
+    assert await media.can_read(await stored(), None)
+
+
+@pytest.mark.anyio
+async def test_backfill_publishes_only_referenced_media(db, media):
+    other = "b" * 64
+    await db.media.insert_many([{"id": MEDIA_ID, "owners": ["alice"]}, {"id": other, "owners": ["alice"]}])
+    await db.products.insert_one({"images": [f"/api/media/{MEDIA_ID}?variant=320"]})
+    await media.backfill_access()
+    assert (await db.media.find_one({"id": MEDIA_ID}))["public"] is True
+    assert (await db.media.find_one({"id": other}))["public"] is False
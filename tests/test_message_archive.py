@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def flat_store(db, monkeypatch):
+    monkeypatch.setattr(server, "message_store", server.flat_messages)
+    monkeypatch.setattr(server, "MESSAGE_RETENTION_DAYS", 30)
+    monkeypatch.setattr(server, "MESSAGE_ARCHIVE_PAUSE_SECONDS", 0)
+    monkeypatch.setattr(server, "MESSAGE_ARCHIVE_SEGMENT_SIZE", 2)
+
+
+async def add_messages(db, ages_in_days, sender="alice"):
+    now = datetime.utcnow().replace(microsecond=0)
+    messages = [{"id": f"m{n}", "chat_id": "c1", "sender_id": sender, "content": str(n),
+                 "timestamp": now - timedelta(days=age)} for n, age in enumerate(ages_in_days)]
+    await db.messages.insert_many([{**m} for m in messages])
+    return messages
+
+
+@pytest.mark.anyio
+async def test_expired_messages_move_to_segments_and_stay_readable(db, flat_store):
+    await add_messages(db, [90, 80, 70, 1, 0])
+    assert await server.message_archiver.run_once() == 3
+    assert await db.messages.count_documents({}) == 2
+    assert await db.message_archive.count_documents({}) == 2  # segments of at most two messages
+    assert await server.message_archiver.run_once() == 0
+
+    history = await server.load_chat_history("c1", None, None, 10)
+    assert [m["id"] for m in history] == ["m0", "m1", "m2", "m3", "m4"]
+    oldest_hot = history[3]
+    page = await server.load_chat_history("c1", oldest_hot["timestamp"], oldest_hot["id"], 2)
+    assert [m["id"] for m in page] == ["m1", "m2"]
+
+
+@pytest.mark.anyio
+async def test_removing_a_sender_rewrites_segments(db, flat_store):
+    await add_messages(db, [90, 80])
+    await add_messages(db, [85], sender="bob")
+    await db.messages.update_one({"sender_id": "bob"}, {"$set": {"id": "b0"}})
+    await server.message_archiver.run_once()
+
+    ids = [segment["_id"] async for segment in db.message_archive.find({"senders": "bob"})]
+    await server.message_archiver.remove_sender(ids, "bob")
+    history = await server.message_archiver.read("c1", None, None, 10)
+    assert sorted(m["id"] for m in history) == ["m0", "m1"]
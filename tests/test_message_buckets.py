@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+START = datetime(2024, 1, 1)
+
+
+def message(chat_id, n, sender="u1"):
+    return {"id": f"m{n:04d}", "chat_id": chat_id, "sender_id": sender, "content": str(n),
+            "timestamp": START + timedelta(seconds=n)}
+
+
+@pytest.fixture
+def store(db, monkeypatch):
+    monkeypatch.setattr(server, "MESSAGE_BUCKET_SIZE", 3)
+    return server.BucketedMessageStore()
+
+
+@pytest.fixture
+async def indexed(db):
+    await db.message_buckets.create_index(
+        [("chat_id", 1), ("open", 1)], unique=True, partialFilterExpression={"open": True}
+    )
+
+
+@pytest.mark.anyio
+async def test_appends_fill_and_seal_buckets_in_order(db, store, indexed):
+    for n in range(7):
+        await store.append(message("c1", n))
+    buckets = await db.message_buckets.find({"chat_id": "c1"}).sort("start_ts", 1).to_list(None)
+    assert [b["count"] for b in buckets] == [3, 3, 1]
+    assert [b["open"] for b in buckets] == [False, False, True]
+
+    page = await store.recent("c1", None, None, 4)
+    assert [m["id"] for m in page] == ["m0006", "m0005", "m0004", "m0003"]
+    older = await store.recent("c1", page[-1]["timestamp"], page[-1]["id"], 10)
+    assert [m["id"] for m in older] == ["m0002", "m0001", "m0000"]
+
+
+@pytest.mark.anyio
+async def test_full_bucket_left_open_by_a_crash_is_sealed_on_next_append(db, store, indexed):
+    await db.message_buckets.insert_one({"id": "b1", "chat_id": "c1", "open": True, "count": 3,
+                                         "messages": [], "start_ts": START, "end_ts": START})
+    await store.append(message("c1", 10))
+    assert await db.message_buckets.count_documents({"chat_id": "c1", "open": True}) == 1
+    assert (await db.message_buckets.find_one({"id": "b1"}))["open"] is False
+
+
+@pytest.mark.anyio
+async def test_flat_fallback_stops_once_chat_is_migrated(db, store, monkeypatch):
+    await db.chats.insert_one({"id": "c1"})
+    await db.messages.insert_many([message("c1", n) for n in range(4)])
+    assert len(await store.recent("c1", None, None, 10)) == 4  # read through during migration
+
+    assert await store.migrate_from_flat(pause=0) == 4
+    assert (await db.chats.find_one({"id": "c1"}))["messages_bucketed"] is True
+
+    async def unexpected(*args):
+        raise AssertionError("flat store queried for a migrated chat")
+    monkeypatch.setattr(server.flat_messages, "recent", unexpected)
+    assert [m["id"] for m in await store.recent("c1", None, None, 2)] == ["m0003", "m0002"]
+
+
+@pytest.mark.anyio
+async def test_recent_reads_migrated_buckets_that_overlap_the_open_one(db, store, indexed):
+    await db.chats.insert_one({"id": "c1"})
+    await store.append(message("c1", 5))
+    await store.append(message("c1", 10))
+    await db.messages.insert_many([message("c1", n) for n in range(6, 10)])
+    await store.migrate_from_flat(pause=0)  # sealed buckets 6-8 and 9, inside the open bucket's 5-10
+
+    page = await store.recent("c1", None, None, 3)
+    assert [m["id"] for m in page] == ["m0010", "m0009", "m0008"]
+    assert [m["id"] for m in await store.recent("c1", None, None, 10)][-1] == "m0005"
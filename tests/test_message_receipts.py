@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+
+def message(client_message_id="c1", content="hi"):
+    return server.Message(chat_id="chat", sender_id="alice", sender_name="Alice",
+                          content=content, client_message_id=client_message_id)
+
+
+@pytest.fixture
+async def receipts(db, monkeypatch):
+    monkeypatch.setattr(server, "message_store", server.FlatMessageStore())
+    await server.create_message_receipt_indexes()
+    return server.MessageReceipts()
+
+
+async def expire_claim(db):
+    await db.message_receipts.update_one({"client_message_id": "c1"},
+                                         {"$set": {"claimed_until": datetime.utcnow() - timedelta(seconds=1)}})
+
+
+@pytest.mark.anyio
+async def test_resend_after_confirm_is_acked(db, receipts):
+    first = message()
+    assert await receipts.claim(first) is None
+    await server.message_store.append(first.dict())
+    await receipts.confirm(first)
+
+    original = await server.MessageReceipts().claim(message())
+    assert original["message_id"] == first.id
+    assert "claimed_until" not in original
+
+
+@pytest.mark.anyio
+async def test_resend_while_in_flight_is_dropped(db, receipts):
+    first = message()
+    assert await receipts.claim(first) is None
+    pending = await receipts.claim(message())
+    assert pending["message_id"] == first.id and "claimed_until" in pending
+
+
+@pytest.mark.anyio
+async def test_expired_claim_without_message_is_taken_over(db, receipts):
+    first = message()
+    assert await receipts.claim(first) is None
+    await expire_claim(db)  # the sender died before appending
+
+    retry = message()
+    assert await receipts.claim(retry) is None
+    receipt = await db.message_receipts.find_one({"client_message_id": "c1"})
+    assert receipt["message_id"] == retry.id
+
+
+@pytest.mark.anyio
+async def test_expired_claim_with_message_is_acked(db, receipts):
+    first = message()
+    assert await receipts.claim(first) is None
+    await server.message_store.append(first.dict())
+    await expire_claim(db)  # the sender died between the append and confirm
+
+    original = await receipts.claim(message())
+    assert original["message_id"] == first.id and "claimed_until" not in original
+    assert await db.messages.count_documents({}) == 1
+    assert "claimed_until" not in await db.message_receipts.find_one({"client_message_id": "c1"})
+
+
+@pytest.mark.anyio
+async def test_release_lets_the_retry_store_it(db, receipts):
+    first = message()
+    assert await receipts.claim(first) is None
+    await receipts.release(first)
+    assert await receipts.claim(message()) is None
+
+
+@pytest.mark.anyio
+async def test_bucketed_store_finds_messages(db):
+    store = server.BucketedMessageStore()
+    stored = message()
+    await store.append(stored.dict())
+    assert await store.contains("chat", stored.id)
+    assert not await store.contains("chat", "other")
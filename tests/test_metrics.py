@@ -0,0 +1,42 @@
+from fastapi.testclient import TestClient
+
+import server
+
+
+def test_histograms_render_cumulative_buckets():
+    registry = server.MetricsRegistry()
+    registry.describe("latency", "histogram", "Latency", (0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        registry.observe("latency", value, {"route": "/a"})
+    text = registry.render()
+    assert 'latency_bucket{route="/a",le="0.1"} 1' in text
+    assert 'latency_bucket{route="/a",le="1.0"} 2' in text
+    assert 'latency_bucket{route="/a",le="+Inf"} 3' in text
+    assert 'latency_count{route="/a"} 3' in text
+
+
+def test_label_values_are_escaped():
+    registry = server.MetricsRegistry()
+    registry.describe("hits", "counter", "Hits")
+    registry.inc("hits", {"route": 'a"b\\c\nd'})
+    assert 'hits{route="a\\"b\\\\c d"} 1' in registry.render()
+
+
+def test_requests_are_labelled_by_route_template(monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "secret")
+    client = TestClient(server.app)
+    client.get("/api/health")
+    key = (("method", "GET"), ("route", "/api/health"), ("status", "200"))
+    assert server.metrics.series["http_requests_total"][key] >= 1
+    body = client.get("/api/metrics", headers={"X-Admin-Token": "secret"}).text
+    assert "# TYPE http_request_duration_seconds histogram" in body
+
+
+def test_metrics_need_the_admin_token(monkeypatch):
+    client = TestClient(server.app)
+    monkeypatch.setattr(server, "ADMIN_TOKEN", None)
+    assert client.get("/api/metrics").status_code == 403
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "secret")
+    assert client.get("/api/metrics").status_code == 403
+    assert client.get("/api/metrics", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    assert client.get("/api/metrics", headers={"X-Admin-Token": "secret"}).status_code == 200
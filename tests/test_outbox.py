@@ -0,0 +1,86 @@
+import smtplib
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+
+class BrokenProvider:
+    channel = "email"
+
+    def __init__(self):
+        self.calls = 0
+
+    async def send_batch(self, messages):
+        self.calls += 1
+        raise RuntimeError("provider bug")
+
+
+class FakeSMTP:
+    sent = []
+
+    def __init__(self, host, port, timeout=None):
+        pass
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def send_message(self, email):
+        if email["To"] == "poison@example.com":
+            raise OSError("connection reset")
+        if email["To"] == "refused@example.com":
+            raise smtplib.SMTPRecipientsRefused({email["To"]: (550, b"no such user")})
+        self.sent.append(email["To"])
+
+    def quit(self):
+        raise smtplib.SMTPServerDisconnected("gone")
+
+
+async def retry_now(db):
+    await db.outbox.update_many({}, {"$set": {"next_attempt_at": datetime.utcnow()}})
+
+
+@pytest.mark.anyio
+async def test_provider_errors_use_up_attempts(db, monkeypatch):
+    monkeypatch.setattr(server, "OUTBOX_MAX_ATTEMPTS", 3)
+    provider = BrokenProvider()
+    outbox = server.Outbox({"email": provider})
+    await outbox.enqueue("email", "u1", "a@example.com", {"subject": "s", "body": "b"})
+    for _ in range(5):
+        batch = await outbox.claim()
+        if not batch:
+            break
+        await outbox.deliver(batch)
+        await retry_now(db)
+    message = await db.outbox.find_one({})
+    assert message["status"] == "dead" and message["attempts"] == 3
+    assert provider.calls == 3
+
+
+@pytest.mark.anyio
+async def test_abandoned_last_attempt_is_dead_lettered(db, monkeypatch):
+    monkeypatch.setattr(server, "OUTBOX_MAX_ATTEMPTS", 2)
+    outbox = server.Outbox({"email": BrokenProvider()})
+    await outbox.enqueue("email", "u1", "a@example.com", {"subject": "s", "body": "b"})
+    assert [m["attempts"] for m in await outbox.claim()] == [1]
+    expired = {"$set": {"lease_until": datetime.utcnow() - timedelta(seconds=1)}}
+    await db.outbox.update_many({}, expired)  # the worker died mid-send
+    assert [m["attempts"] for m in await outbox.claim()] == [2]
+    await db.outbox.update_many({}, expired)
+    assert await outbox.claim() == []
+    assert (await db.outbox.find_one({}))["status"] == "dead"
+
+
+def test_smtp_failure_only_affects_its_message(monkeypatch):
+    monkeypatch.setattr(smtplib, "SMTP", FakeSMTP)
+    FakeSMTP.sent = []
+    messages = [{"id": str(n), "to": to, "payload": {"subject": "s", "body": "b"}}
+                for n, to in enumerate(["a@example.com", "poison@example.com", "refused@example.com", "b@example.com"])]
+    results = server.SmtpEmailProvider()._send(messages)
+    assert results["0"] is None and results["3"] is None
+    assert not results["1"].permanent and results["2"].permanent
+    assert FakeSMTP.sent == ["a@example.com", "b@example.com"]
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+@pytest.fixture
+async def resets(db):
+    await server.create_password_reset_indexes()
+    await db.users.insert_one({"id": "u1", "email": "a@example.com", "display_name": "A", "password_hash": "old"})
+
+
+@pytest.mark.anyio
+async def test_only_a_hash_is_stored_and_active_tokens_are_capped(db, resets, monkeypatch):
+    monkeypatch.setattr(server, "PASSWORD_RESET_MAX_ACTIVE", 2)
+    tokens = [await server.issue_reset_token("u1") for _ in range(3)]
+    stored = await db.password_resets.find({}, {"_id": 0}).to_list(None)
+    assert len(stored) == 2
+    assert {doc["token_hash"] for doc in stored} == {server.hash_reset_token(t) for t in tokens[1:]}
+    assert not any(token in str(doc) for doc in stored for token in tokens)
+    assert await server.redeem_reset_token(tokens[0]) is None  # the oldest was dropped
+
+
+@pytest.mark.anyio
+async def test_tokens_redeem_once_and_not_after_expiry(db, resets):
+    token = await server.issue_reset_token("u1")
+    assert (await server.redeem_reset_token(token))["user_id"] == "u1"
+    assert await server.redeem_reset_token(token) is None
+
+    expired = await server.issue_reset_token("u1")
+    await db.password_resets.update_one({"token_hash": server.hash_reset_token(expired)},
+                                        {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}})
+    assert await server.redeem_reset_token(expired) is None
+
+
+@pytest.mark.anyio
+async def test_reset_changes_the_password_and_drops_other_tokens(db, resets):
+    token, other = await server.issue_reset_token("u1"), await server.issue_reset_token("u1")
+    await server.reset_password(server.ResetPasswordRequest(token=token, new_password="n3w-Password!"))
+    assert (await db.users.find_one({"id": "u1"}))["password_hash"] != "old"
+    with pytest.raises(HTTPException) as error:
+        await server.reset_password(server.ResetPasswordRequest(token=other, new_password="again-Password!"))
+    assert error.value.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_forgot_password_answers_the_same_for_unknown_addresses(db, resets):
+    known = await server.forgot_password(server.ForgotPasswordRequest(email="a@example.com"))
+    unknown = await server.forgot_password(server.ForgotPasswordRequest(email="nobody@example.com"))
+    assert known == unknown
+    assert await db.outbox.count_documents({"to": "a@example.com"}) == 1
+
+
+@pytest.mark.anyio
+async def test_forgot_password_ignores_deleted_accounts(db, resets):
+    await db.users.update_one({"id": "u1"}, {"$set": {"deleted": True}})
+    await server.forgot_password(server.ForgotPasswordRequest(email="a@example.com"))
+    assert await db.password_resets.count_documents({}) == 0
+    assert await db.outbox.count_documents({}) == 0
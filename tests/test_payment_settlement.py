@@ -0,0 +1,115 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+
+class CountingProvider(server.SimulatedMobileMoney):
+    """The simulator, counting calls and yielding inside them like a network round trip."""
+
+    def __init__(self):
+        self.initiated = []
+        self.refunded = []
+
+    async def initiate(self, payment):
+        self.initiated.append(payment["id"])
+        await asyncio.sleep(0)
+        return await super().initiate(payment)
+
+    async def refund(self, reference):
+        self.refunded.append(reference)
+        await asyncio.sleep(0)
+        await super().refund(reference)
+
+
+@pytest.fixture
+async def provider(db, monkeypatch):
+    monkeypatch.setattr(server, "PAYMENT_SIMULATOR_FAILURE_RATE", 0.0)
+    monkeypatch.setattr(server, "PAYMENT_SIMULATOR_DELAY_SECONDS", 0.0)
+    provider = CountingProvider()
+    await provider.create_indexes()
+    return provider
+
+
+async def place_order(db, status="pending"):
+    order = {"id": "o1", "buyer_id": "buyer", "seller_id": "seller", "status": status, "total_amount": 10.0,
+             "payment_method": "mpesa", "created_at": datetime.utcnow(),
+             "products": [{"product_id": "p1", "seller_id": "seller", "quantity": 1, "subtotal": 10.0}]}
+    await db.orders.insert_one({**order})
+    return order
+
+
+async def add_payment(db, status="pending", reference=None, **fields):
+    payment = {"id": f"pay-{status}-{reference}", "order_id": "o1", "provider": "simulator", "status": status,
+               "reference": reference, "created_at": datetime.utcnow(), **fields}
+    await db.payments.insert_one({**payment})
+    return payment
+
+
+@pytest.mark.anyio
+async def test_completion_after_timeout_pays_the_order(db, provider):
+    await place_order(db)
+    await add_payment(db, "failed", "SIM-1")  # timed out before the buyer approved
+    await server.PaymentSettlementWorker(provider).settle("SIM-1", "completed", "callback")
+    assert (await db.payments.find_one({"reference": "SIM-1"}))["status"] == "completed"
+    assert (await db.orders.find_one({"id": "o1"}))["status"] == "paid"
+
+
+@pytest.mark.anyio
+async def test_completion_after_timeout_is_refunded_once_paid_again(db, provider):
+    await place_order(db, status="paid")  # the buyer paid again with a retry
+    await add_payment(db, "failed", "SIM-1")
+    worker = server.PaymentSettlementWorker(provider)
+    await worker.settle("SIM-1", "completed", "callback")
+    assert (await db.payments.find_one({"reference": "SIM-1"}))["status"] == "refund_pending"
+    # A repeat of the same outcome changes nothing
+    await worker.settle("SIM-1", "completed", "callback")
+    assert (await db.payments.find_one({"reference": "SIM-1"}))["status"] == "refund_pending"
+
+
+@pytest.mark.anyio
+async def test_racing_workers_initiate_once(db, provider):
+    payment = await add_payment(db)
+    workers = [server.PaymentSettlementWorker(provider) for _ in range(2)]
+    await asyncio.gather(*(worker._initiate() for worker in workers))
+    assert provider.initiated == [payment["id"]]
+    stored = await db.payments.find_one({"id": payment["id"]})
+    assert stored["status"] == "pending" and stored["reference"].startswith("SIM-")
+
+
+@pytest.mark.anyio
+async def test_abandoned_initiation_is_retried_with_the_same_reference(db, provider):
+    payment = await add_payment(db)
+    reference = await provider.initiate(payment)  # then the worker died before saving it
+    stale = datetime.utcnow() - timedelta(seconds=server.PAYMENT_LEASE_SECONDS + 1)
+    await db.payments.update_one({"id": payment["id"]}, {"$set": {"status": "initiating", "initiating_since": stale}})
+
+    await server.PaymentSettlementWorker(provider)._initiate()
+    assert (await db.payments.find_one({"id": payment["id"]}))["reference"] == reference
+    assert await db.simulated_payments.count_documents({}) == 1
+
+
+@pytest.mark.anyio
+async def test_live_initiation_is_left_alone(db, provider):
+    await add_payment(db, "initiating", initiating_since=datetime.utcnow())
+    await server.PaymentSettlementWorker(provider)._initiate()
+    assert provider.initiated == []
+
+
+@pytest.mark.anyio
+async def test_racing_workers_refund_once(db, provider):
+    payment = await add_payment(db, "refund_pending", "SIM-1")
+    workers = [server.PaymentSettlementWorker(provider) for _ in range(2)]
+    await asyncio.gather(*(worker._refund() for worker in workers))
+    assert provider.refunded == ["SIM-1"]
+    assert (await db.payments.find_one({"id": payment["id"]}))["status"] == "refunded"
+
+
+@pytest.mark.anyio
+async def test_outcomes_are_visible_to_other_processes(db, provider):
+    payment = await add_payment(db)
+    reference = await provider.initiate(payment)
+    other = server.SimulatedMobileMoney()
+    assert await other.poll([reference, "SIM-UNKNOWN"]) == {reference: "completed", "SIM-UNKNOWN": "failed"}
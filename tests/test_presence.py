@@ -0,0 +1,20 @@
+from datetime import datetime
+
+import pytest
+
+import server
+
+
+@pytest.mark.anyio
+async def test_presence_honours_last_seen_privacy_and_live_connections(db, monkeypatch):
+    monkeypatch.setattr(server, "privacy", server.PrivacyService())
+    monkeypatch.setattr(server, "manager", server.ConnectionManager())
+    await db.privacy_settings.insert_one({"user_id": "hidden", "last_seen_online": False})
+    server.manager.active_connections.update(hidden=object(), live=object())
+    seen = datetime(2026, 1, 2)
+    rows = [{"id": user_id, "status": "offline", "last_seen": seen} for user_id in ("hidden", "live", "away")]
+
+    view = await server.presence_view(rows)
+    assert [(u["status"], u["last_seen"]) for u in view] == [(None, None), ("online", seen), ("offline", seen)]
+    # Rows may come from the profile cache; they are copied, never changed
+    assert all(row["status"] == "offline" for row in rows)
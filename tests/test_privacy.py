@@ -0,0 +1,40 @@
+import pytest
+
+import server
+
+
+@pytest.mark.anyio
+async def test_defaults_apply_without_a_document(db):
+    service = server.PrivacyService()
+    assert await service.get("u1") == server.PrivacySettings().dict()
+    assert await db.privacy_settings.count_documents({}) == 0
+
+
+@pytest.mark.anyio
+async def test_only_changed_fields_are_stored(db):
+    service = server.PrivacyService()
+    settings = await service.update("u1", {"typing_indicators": False})
+    assert settings["typing_indicators"] is False and settings["read_receipts"] is True
+    stored = await db.privacy_settings.find_one({"user_id": "u1"}, {"_id": 0, "updated_at": 0})
+    assert stored == {"user_id": "u1", "typing_indicators": False}
+
+
+@pytest.mark.anyio
+async def test_many_users_cost_one_query_and_are_then_cached(db, monkeypatch):
+    await db.privacy_settings.insert_one({"user_id": "u2", "last_seen_online": False})
+    service = server.PrivacyService()
+    queries = []
+
+    class CountingCollection:
+        def __init__(self, collection):
+            self.collection = collection
+
+        def find(self, *args, **kwargs):
+            queries.append(args)
+            return self.collection.find(*args, **kwargs)
+
+    monkeypatch.setattr(server, "db", type("DB", (), {"privacy_settings": CountingCollection(db.privacy_settings)})())
+    settings = await service.get_settings(["u1", "u2", "u1"])
+    assert settings["u2"]["last_seen_online"] is False and settings["u1"]["last_seen_online"] is True
+    await service.get_settings(["u1", "u2"])
+    assert len(queries) == 1
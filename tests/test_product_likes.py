@@ -0,0 +1,24 @@
+import pytest
+
+import server
+
+
+@pytest.mark.anyio
+async def test_startup_backfills_legacy_like_counts_before_serving(db):
+    await db.products.insert_many([
+        {"id": "legacy", "likes": ["a", "b"]},
+        {"id": "bare"},
+        {"id": "new", "likes": ["a"], "like_count": 1},
+    ])
+    await server.start_marketplace()
+    counts = {p["id"]: p["like_count"] async for p in db.products.find({}, {"_id": 0})}
+    assert counts == {"legacy": 2, "bare": 0, "new": 1}
+
+
+@pytest.mark.anyio
+async def test_like_toggles_and_counts(db, monkeypatch):
+    monkeypatch.setattr(server, "product_views", server.ProductViewCounter())
+    await db.products.insert_one({"id": "p1", "likes": ["a"], "like_count": 1})
+    assert (await server.like_product("p1", "b"))["likes_count"] == 2
+    assert (await server.like_product("p1", "b"))["likes_count"] == 1
+    assert (await db.products.find_one({"id": "p1"}))["likes"] == ["a"]
@@ -0,0 +1,44 @@
+import pytest
+
+import server
+
+
+@pytest.mark.anyio
+async def test_views_are_deduped_per_viewer_and_flushed_in_one_write(db):
+    await db.products.insert_many([{"id": "p1", "views": 0}, {"id": "p2", "views": 5}])
+    counter = server.ProductViewCounter()
+    assert counter.record_view("p1", "user:a")
+    assert not counter.record_view("p1", "user:a")
+    assert counter.record_view("p1", "ip:1.2.3.4")
+    assert counter.record_view("p2", "user:a")
+    counter.record_like("p2", 1)
+
+    await counter.flush()
+    views = {p["id"]: p["views"] async for p in db.products.find({})}
+    assert views == {"p1": 2, "p2": 6}
+    stats = {s["product_id"]: (s["views"], s["likes"]) async for s in db.product_stats.find({})}
+    assert stats == {"p1": (2, 0), "p2": (1, 1)}
+    assert counter.views == {} and counter.likes == {}
+
+
+@pytest.mark.anyio
+async def test_failed_flush_keeps_the_counts(db, monkeypatch):
+    counter = server.ProductViewCounter()
+    counter.record_view("p1", "user:a")
+    counter.record_like("p1", -1)
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("primary stepped down")
+
+    monkeypatch.setattr(server, "UpdateOne", broken)
+    await counter.flush()
+    assert counter.views == {"p1": 1} and counter.likes == {"p1": -1}
+
+
+def test_dedupe_memory_is_bounded(monkeypatch):
+    monkeypatch.setattr(server, "PRODUCT_VIEW_DEDUPE_MAX", 3)
+    counter = server.ProductViewCounter()
+    for n in range(10):
+        counter.record_view("p1", f"user:{n}")
+    assert len(counter.seen) <= 3
+    assert counter.views == {"p1": 10}
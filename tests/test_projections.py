@@ -0,0 +1,28 @@
+import pytest
+from fastapi import HTTPException, Response
+
+import server
+
+
+def test_projection_follows_the_response_model():
+    projection = server.build_projection(server.CartProduct)
+    assert projection == {"_id": 0, **{name: 1 for name in server.CartProduct.model_fields}}
+
+
+def test_sparse_fieldsets_always_include_id():
+    projection = server.build_projection(server.ProductSummary, "price, name", {"price": {"$literal": 1}})
+    assert projection == {"_id": 0, "id": 1, "price": {"$literal": 1}, "name": 1}
+    with pytest.raises(HTTPException) as error:
+        server.build_projection(server.ProductSummary, "name,password_hash")
+    assert error.value.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_product_list_returns_counts_instead_of_like_arrays(db, monkeypatch):
+    monkeypatch.setattr(server, "product_pages", server.ProductPageCache())
+    await db.products.insert_one({"id": "p1", "name": "Radio", "is_active": True, "likes": ["a", "b"],
+                                  "like_count": 2, "created_at": server.datetime.utcnow(), "price": 5.0})
+    products = await server.get_products(Response(), fields="name,likes_count,liked_by_me", current_user="a",
+                                         category=None, search=None, seller=None, min_price=None, max_price=None,
+                                         condition=None, location=None, sort="newest", cursor=None, limit=50)
+    assert products == [{"id": "p1", "name": "Radio", "likes_count": 2, "liked_by_me": True}]
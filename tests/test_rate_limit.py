@@ -0,0 +1,56 @@
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+class DownBackend:
+    async def acquire(self, key, capacity, period):
+        raise ConnectionError("redis is down")
+
+
+def test_bucket_spends_burst_then_reports_wait(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: clock[0])
+    bucket = server.TokenBucket(capacity=2, rate=1.0)
+    assert bucket.take() == 0 and bucket.take() == 0
+    assert bucket.take() == pytest.approx(1.0)
+    clock[0] += 0.5
+    assert bucket.take() == pytest.approx(0.5)
+    clock[0] += 0.5
+    assert bucket.take() == 0
+
+
+@pytest.mark.anyio
+async def test_budgets_are_keyed_separately(monkeypatch):
+    monkeypatch.setitem(server.RATE_LIMITS, "test", (1, 60))
+    limiter = server.RateLimiter()
+    assert await limiter.hit("test", "user:a") == 0
+    assert await limiter.hit("test", "user:a") > 0
+    assert await limiter.hit("test", "user:b") == 0
+
+
+@pytest.mark.anyio
+async def test_unreachable_shared_backend_falls_back_to_process_limits(monkeypatch):
+    monkeypatch.setitem(server.RATE_LIMITS, "test", (1, 60))
+    limiter = server.RateLimiter(DownBackend())
+    assert await limiter.hit("test", "ip:1.2.3.4") == 0
+    assert await limiter.hit("test", "ip:1.2.3.4") > 0
+
+
+@pytest.mark.anyio
+async def test_rejection_carries_retry_after(monkeypatch):
+    monkeypatch.setitem(server.RATE_LIMITS, "test", (1, 60))
+    monkeypatch.setattr(server, "rate_limiter", server.RateLimiter())
+    await server.enforce_rate_limit("test", "user:a")
+    with pytest.raises(HTTPException) as error:
+        await server.enforce_rate_limit("test", "user:a")
+    assert error.value.status_code == 429
+    assert error.value.headers["Retry-After"] == "60"
+
+
+def test_idle_buckets_are_pruned_first():
+    backend = server.MemoryRateLimitBackend(max_keys=10)
+    backend.buckets = {f"k{n}": server.TokenBucket(1, 1000.0) for n in range(10)}
+    backend._prune()
+    assert backend.buckets == {}
@@ -0,0 +1,41 @@
+from datetime import datetime
+
+import pytest
+
+import server
+
+
+def order(order_id, seller_id, status, subtotal=10.0):
+    return {"id": order_id, "seller_id": seller_id, "buyer_id": "buyer", "status": status,
+            "created_at": datetime(2026, 1, 2),
+            "products": [{"product_id": f"{seller_id}-p", "seller_id": seller_id, "quantity": 1, "subtotal": subtotal}]}
+
+
+@pytest.mark.anyio
+async def test_startup_rebuilds_missing_and_partial_documents(db):
+    await db.orders.insert_many([order("o1", "partial", "pending"), order("o2", "partial", "paid"),
+                                 order("o3", "missing", "cancelled"), order("o4", "done", "paid")])
+    # Upserted by an $inc before any rebuild: only the transition it saw
+    await db.seller_stats.insert_one({"seller_id": "partial", "orders": {"pending": -1, "paid": 1}})
+    await db.seller_stats.insert_one({"seller_id": "done", "rebuilt": True, "orders": {"paid": 5}})
+
+    await server.start_seller_stats()
+    stats = {doc["seller_id"]: doc async for doc in db.seller_stats.find({}, {"_id": 0})}
+    assert stats["partial"]["orders"] == {"pending": 1, "paid": 1}
+    assert stats["partial"]["revenue_total"] == 20.0 and stats["partial"]["rebuilt"]
+    assert stats["missing"]["orders"] == {"cancelled": 1} and stats["missing"]["revenue_total"] == 0
+    assert stats["done"]["orders"] == {"paid": 5}  # already complete, left alone
+
+
+@pytest.mark.anyio
+async def test_new_seller_document_is_complete(db):
+    await server.start_seller_stats()
+    placed = order("o1", "fresh", "pending")
+    await db.orders.insert_one({**placed})
+    await server.seller_stats.order_placed(placed)
+    await server.seller_stats.order_transitioned(placed, "pending", "cancelled")
+    stats = await db.seller_stats.find_one({"seller_id": "fresh"})
+    assert stats["rebuilt"]
+    assert stats["orders"] == {"pending": 0, "cancelled": 1}
+    assert stats["revenue_total"] == 0
+    assert await server.seller_stats.backfill() == 0
@@ -0,0 +1,34 @@
+import json
+from datetime import datetime
+
+from bson import ObjectId
+from fastapi.testclient import TestClient
+
+import server
+
+
+def test_dumps_encodes_mongo_values():
+    oid = ObjectId()
+    message = server.Message(chat_id="c1", sender_id="u1", sender_name="Alice", content="hi")
+    payload = {"_id": oid, "at": datetime(2026, 1, 2, 3, 4, 5), "tags": {"x"}, "message": message, 1: "int key"}
+    decoded = json.loads(server.dumps(payload))
+    assert decoded["_id"] == str(oid)
+    assert decoded["at"] == "2026-01-02T03:04:05"
+    assert decoded["tags"] == ["x"]
+    assert decoded["message"]["content"] == "hi"
+    assert decoded["1"] == "int key"
+
+
+def test_stdlib_fallback_gives_the_same_document(monkeypatch):
+    payload = {"at": datetime(2026, 1, 2), "n": [1, 2.5, None], "s": "ü", "_id": ObjectId()}
+    fast = json.loads(server.dumps(payload))
+    monkeypatch.setattr(server, "orjson", None)
+    assert json.loads(server.dumps(payload)) == fast
+
+
+def test_routes_without_response_model_skip_jsonable_encoder():
+    route = next(r for r in server.app.routes if getattr(r, "path", None) == "/api/health")
+    assert hasattr(route.endpoint, "__wrapped__")
+    response = TestClient(server.app).get("/api/health")
+    assert response.status_code == 200
+    assert response.json()["status"] == "healthy"
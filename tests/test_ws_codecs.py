@@ -0,0 +1,44 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import server
+
+msgpack = pytest.importorskip("msgpack")
+
+
+def socket(*subprotocols, codec=None):
+    state = SimpleNamespace(codec=codec) if codec else SimpleNamespace()
+    return SimpleNamespace(scope={"subprotocols": list(subprotocols)}, state=state)
+
+
+def test_first_supported_subprotocol_wins():
+    codec, chosen = server.negotiate_codec(socket("cbor", "msgpack", "json"))
+    assert codec.name == "msgpack" and chosen == "msgpack"
+    codec, chosen = server.negotiate_codec(socket())
+    assert codec.name == "json" and chosen is None
+
+
+def test_codecs_map_values_the_same_way():
+    frame = {"type": "new_message", "at": datetime(2026, 1, 2), "ids": {"a"}}
+    via_json = server.JSONCodec.decode(server.JSONCodec.encode(frame))
+    via_msgpack = server.MsgPackCodec.decode(server.MsgPackCodec.encode(frame))
+    assert via_json == via_msgpack == {"type": "new_message", "at": "2026-01-02T00:00:00", "ids": ["a"]}
+
+
+def test_text_frames_are_json_even_on_binary_connections():
+    ws = socket(codec=server.WS_CODECS["msgpack"])
+    assert server.decode_frame(ws, {"text": '{"type": "ping"}'}) == {"type": "ping"}
+    assert server.decode_frame(ws, {"bytes": msgpack.packb({"type": "pong"})}) == {"type": "pong"}
+
+
+def test_outbound_frames_encode_once_per_codec(monkeypatch):
+    calls = []
+    real_encode = server.MsgPackCodec.encode
+    monkeypatch.setattr(server.MsgPackCodec, "encode", staticmethod(lambda m: calls.append(m) or real_encode(m)))
+    frame = server.OutboundFrame({"type": "typing", "user_id": "u1"})
+    first = frame.encode(server.WS_CODECS["msgpack"])
+    assert frame.encode(server.WS_CODECS["msgpack"]) is first
+    assert isinstance(frame.encode(server.WS_CODECS["json"]), str)
+    assert len(calls) == 1